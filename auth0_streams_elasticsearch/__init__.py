@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import functools
 import os
+import signal
+from typing import Optional, Sequence
 
 import aiohttp
 import aiomisc
 from loguru import logger
 
 from . import (
-    batcher, client, log,
-    receiver, sender, settings,
+    batcher, client, dedup, log, metrics, receiver,
+    sender, settings, sinks, transform, workers,
 )
 
 
@@ -21,32 +24,195 @@ def cleanup_runner(runner: aiohttp.web.BaseRunner):
 
 
 def start():
-    aiomisc.new_event_loop()
 
-    s = settings.Settings()
+    s = settings.Settings.load()
 
     log.configure(s)
 
-    services = [
-        batcher.BatcherService(
-            queue_max_size=s.QUEUE_MAX_SIZE,
+    if s.WORKERS > 1:
+        workers.run_workers(s.WORKERS, functools.partial(serve, s))
+    else:
+        serve(s)
+
+
+def worker_path(path: str, worker: Optional[int]) -> str:
+    """ Gives each worker process its own spool directory or dead letter
+        file, since those are written by a single process.
+    """
+
+    if not path or worker is None:
+        return path
+
+    return f"{path}.{worker}"
+
+
+def serve(s: settings.Settings, worker: Optional[int] = None):
+    """ Runs the receiver, batcher and sender on one event loop. If this
+        is one of several workers, `worker` is its number, and the receiver
+        port is shared with the other workers through SO_REUSEPORT.
+    """
+
+    aiomisc.new_event_loop()
+
+    spill_path = worker_path(s.DRAIN_SPILL_PATH, worker)
+    pipeline = transform.build_pipeline(
+        s.TRANSFORM_STAGES,
+        geoip_database_path=s.GEOIP_DATABASE_PATH,
+        prune_fields=s.PRUNE_FIELDS,
+        cache_size=s.TRANSFORM_CACHE_SIZE,
+        offload=s.TRANSFORM_OFFLOAD,
+    )
+    receiver_service = receiver.ReceiverService(
+        sock=aiomisc.bind_socket(
+            address=s.BIND_ADDRESS,
+            port=s.BIND_PORT,
+            reuse_port=worker is not None,
+            proto_name="http",
+        ),
+        bearer_token=s.BEARER_TOKEN,
+        insert_timeout=s.QUEUE_INSERT_TIMEOUT,
+        retry_after=s.QUEUE_FULL_RETRY_AFTER,
+        max_body_size=s.MAX_BODY_SIZE,
+        parse_offload_size=s.PARSE_OFFLOAD_SIZE,
+        coalesce_events=s.RECEIVER_COALESCE_EVENTS,
+        compact=s.QUEUE_COMPACT,
+        dedup=None if s.DEDUP_MODE == "off" else dedup.DedupCache(
+            window=s.DEDUP_WINDOW,
+            max_size=s.DEDUP_MAX_SIZE,
+            mode=s.DEDUP_MODE,
+            false_positive_rate=s.DEDUP_FALSE_POSITIVE_RATE,
         ),
-        client.ClientService(
+        # Compact events are transformed by the sender instead
+        pipeline=None if s.QUEUE_COMPACT else pipeline,
+    )
+    sender_service = sender.SenderService(
+        send_after_events=s.SEND_AFTER_EVENTS,
+        send_max_events=s.SEND_MAX_EVENTS,
+        send_max_bytes=s.SEND_MAX_BYTES,
+        send_target_latency=s.SEND_TARGET_LATENCY,
+        send_max_in_flight=s.SEND_MAX_IN_FLIGHT,
+        retry_max_attempts=s.RETRY_MAX_ATTEMPTS,
+        retry_backoff_base=s.RETRY_BACKOFF_BASE,
+        retry_backoff_max=s.RETRY_BACKOFF_MAX,
+        dead_letter_path=worker_path(s.DEAD_LETTER_PATH, worker),
+        drain_timeout=s.DRAIN_TIMEOUT,
+        spill_path=spill_path,
+        sink_max_backlog=s.SINK_MAX_BACKLOG,
+        pipeline=pipeline if s.QUEUE_COMPACT else None,
+        sinks=sinks.build_sinks(
+            s.SINKS,
+            archive_path=worker_path(s.ARCHIVE_PATH, worker),
+            archive_compression=s.ARCHIVE_COMPRESSION,
+        ),
+    )
+
+    batcher_service = batcher.BatcherService(
+        queue_max_size=s.QUEUE_MAX_SIZE,
+        queue_max_bytes=s.QUEUE_MAX_BYTES or None,
+        flush_size=s.SEND_AFTER_EVENTS,
+        flush_after=s.SEND_AFTER_TIME,
+        flush_bytes=s.SEND_MAX_BYTES,
+        spool_directory=worker_path(s.SPOOL_DIRECTORY, worker),
+        spool_segment_size=s.SPOOL_SEGMENT_SIZE,
+        spill_path=spill_path,
+    )
+
+    client_options = client.service_options(s)
+    services = [batcher_service]
+    if "elasticsearch" in s.SINKS:
+        services.append(client.ClientService(
             username=s.ELASTICSEARCH_USERNAME,
             password=s.ELASTICSEARCH_PASSWORD,
             hosts=s.ELASTICSEARCH_HOSTS,
             index_name=s.ELASTICSEARCH_INDEX_NAME,
-            ssl_verify=s.ELASTICSEARCH_SSL_VERIFY,
-        ),
-        receiver.ReceiverService(
-            address=s.BIND_ADDRESS,
-            bearer_token=s.BEARER_TOKEN,
-            port=s.BIND_PORT,
-        ),
-        sender.SenderService(
-            send_after_time=s.SEND_AFTER_TIME,
-            send_after_events=s.SEND_AFTER_EVENTS,
+            **client_options,
+        ))
+    if "secondary_elasticsearch" in s.SINKS:
+        if not s.SECONDARY_ELASTICSEARCH_HOSTS:
+            raise settings.SettingUnset("SECONDARY_ELASTICSEARCH_HOSTS")
+        # A second cluster written to alongside the first, ie. while
+        # migrating; anything not set for it is the same as the first
+        services.append(client.ClientService(
+            username=s.SECONDARY_ELASTICSEARCH_USERNAME or s.ELASTICSEARCH_USERNAME,
+            password=s.SECONDARY_ELASTICSEARCH_PASSWORD or s.ELASTICSEARCH_PASSWORD,
+            hosts=s.SECONDARY_ELASTICSEARCH_HOSTS,
+            index_name=s.SECONDARY_ELASTICSEARCH_INDEX_NAME or s.ELASTICSEARCH_INDEX_NAME,
+            context_key="secondary_client",
+            **client_options,
+        ))
+    services += [
+        receiver_service,
+        sender_service,
+        metrics.LoopLagService(
+            interval=s.LOOP_LAG_INTERVAL,
         ),
     ]
+    # Workers leave SIGINT to the supervisor
+    signals = (signal.SIGTERM,) if worker is not None else (signal.SIGTERM, signal.SIGINT)
+
     with aiomisc.entrypoint(*services) as loop:
+        shutdown = functools.partial(
+            begin_shutdown, loop, signals, receiver_service, sender_service,
+        )
+        for signum in signals:
+            loop.add_signal_handler(signum, shutdown)
+
+        def reload():
+            nonlocal s
+            s = reload_settings(s, [batcher_service, receiver_service, sender_service])
+
+        loop.add_signal_handler(signal.SIGHUP, reload)
         loop.run_forever()
+
+
+def reload_settings(s: settings.Settings, services: Sequence) -> settings.Settings:
+    """ Re-reads the settings on SIGHUP and hands the new snapshot to
+        each service, which applies whatever it can without a restart.
+        Only `SETTINGS_FILE` can change while the process runs; its
+        environment can not be changed from outside.
+    """
+
+    if not s.SETTINGS_FILE:
+        logger.warning("Got SIGHUP, but there is no SETTINGS_FILE to reload settings from")
+        return s
+
+    try:
+        reloaded = s.reload()
+    except Exception:
+        logger.exception("Could not reload settings, keeping the current ones")
+        return s
+
+    changes = s.changes(reloaded)
+    if not changes:
+        logger.info("Settings reloaded, nothing changed")
+        return s
+
+    for service in services:
+        service.reconfigure(reloaded)
+    logger.info(f"Settings reloaded, changed {', '.join(sorted(changes))}")
+    return reloaded
+
+
+def begin_shutdown(
+    loop: asyncio.AbstractEventLoop,
+    signals: Sequence[int],
+    receiver_service: receiver.ReceiverService,
+    sender_service: sender.SenderService,
+):
+    """ Drains on the first SIGTERM or SIGINT: new deliveries are turned
+        away with a 503 while the sender flushes the queue, then the loop
+        stops and the services shut down. A second Ctrl-C interrupts the
+        drain; anything unsent is still spilled when the sender stops.
+    """
+
+    for signum in signals:
+        loop.remove_signal_handler(signum)
+
+    async def drain():
+        receiver_service.drain()
+        try:
+            await sender_service.drain()
+        finally:
+            loop.stop()
+
+    loop.create_task(drain())
@@ -2,77 +2,538 @@
 
 import asyncio
 from collections import deque
-from typing import Iterable, List
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
 
 import aiomisc
+import ujson
 from loguru import logger
 
+from .metrics import REGISTRY
 from .settings import Settings
+from .spill import take_spill
+from .spool import Spool
+
+# Small inserts are added to the last chunk while it holds fewer events
+# than this, so single-event inserts don't make single-event chunks.
+COALESCE_SIZE = 256
 
 
 class Batcher:
     """ Batcher enqueues a series of events from the receiver to
         bulk submit into Elasticsearch.
+
+        Events are stored in chunks, one per insert, so inserting and
+        taking a batch cost one operation per chunk rather than per event.
+        A chunk is handed to the sender as-is when a batch takes all of
+        it, and split by slicing when it does not. Small inserts are
+        coalesced into the last chunk. All events of a chunk are accounted
+        at the same average size.
+
+        All callers share one event loop, so the queue is never locked.
+        `get_batch`, `insert_nowait` and the queue size checks are
+        synchronous; only an insert which has to wait for room, or for the
+        spool, needs to be awaited.
+
+        The queue is bounded by `queue_max_size` events, and by
+        `queue_max_bytes` of serialized events if given. Inserts that do
+        not fit wait for the sender to make room, and raise `BatcherFull`
+        if no room is made in time, so that nothing is silently evicted.
+
+        The batcher signals readiness to the sender when either
+        `flush_size` events or `flush_bytes` bytes are queued, or
+        `flush_after` seconds have passed since the first event of the
+        pending batch arrived. Once `drain` is called, it signals as soon
+        as anything is queued.
+
+        If a `Spool` is given, every insert is written ahead to it and
+        the insert only returns once it is durable. Batches handed to the
+        sender must then be passed back to `ack` once delivered, which
+        advances the spool checkpoint past them.
     """
 
-    queue: deque
-    _lock: asyncio.Lock
+    queue_max_size: int
+    queue_max_bytes: Optional[int]
+    flush_size: int
+    flush_after: float
+    flush_bytes: Optional[int]
+    accepted: int
+    delayed: int
+    dropped: int
+    draining: bool
+    spool: Optional[Spool]
+    _chunks: Deque["Chunk"]
+    _count: int
+    _bytes: int
+    _marks: deque
+    _inflight: Dict[int, Tuple[int, int]]
+    _inserted: int
+    _popped: int
+    _space: asyncio.Event
+    _ready: asyncio.Event
+    _deadline: Optional[asyncio.TimerHandle]
 
-    def __init__(self, queue_max_size: int):
-        self.queue = deque(maxlen=queue_max_size)
-        self._lock = asyncio.Lock()
+    def __init__(
+        self,
+        queue_max_size: int,
+        flush_size: int = 10,
+        flush_after: float = 5,
+        flush_bytes: Optional[int] = None,
+        spool: Optional[Spool] = None,
+        queue_max_bytes: Optional[int] = None,
+    ):
+        self.queue_max_size = queue_max_size
+        self.queue_max_bytes = queue_max_bytes
+        self.flush_size = flush_size
+        self.flush_after = flush_after
+        self.flush_bytes = flush_bytes
+        self.accepted = 0
+        self.delayed = 0
+        self.dropped = 0
+        self.draining = False
+        self.spool = spool
+        self._chunks = deque()
+        self._count = 0
+        self._bytes = 0
+        # (events inserted so far, spool offset) at the end of each record
+        self._marks = deque()
+        # id(batch) -> (first, last + 1) event sequence numbers of the batch
+        self._inflight = {}
+        self._inserted = 0
+        self._popped = 0
+        self._space = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._deadline = None
 
-    async def insert(self, event: dict):
+    def __len__(self) -> int:
+        return self._count
+
+    async def insert(self, event: dict, timeout: Optional[float] = None):
         """ Inserts a single event into the queue.
         """
 
-        async with self._lock:
-            self.queue.append(event)
+        await self.insert_many([event], timeout=timeout)
+
+    async def insert_many(
+        self,
+        events: Iterable[dict],
+        timeout: Optional[float] = None,
+        size: Optional[int] = None,
+    ):
+        """ Inserts a number of events into the queue.
+            If the queue does not have room for all of the events, waits up
+            to `timeout` seconds for room to be made before raising
+            `BatcherFull`. Events are inserted all-or-nothing.
 
-    async def insert_many(self, events: Iterable[dict]):
-        """ Inserts a number of events into the queue
+            `size` is the serialized size of all of the events, if known,
+            such as the length of the request body they arrived in.
+            Otherwise each event is measured by serializing it.
         """
 
-        async with self._lock:
-            self.queue.extend(events)
+        # The batcher owns its chunks, and may hand them out as batches
+        events = list(events)
+        count = len(events)
+        if size is None and self.queue_max_bytes:
+            size = measure(events)
+
+        if not self._has_room(count, size):
+            self.delayed += count
+            await self._wait_for_room(count, size, timeout)
+
+        offset = self._put(events, size)
+        self.accepted += count
+
+        # Concurrent inserts wait on the same group commit
+        if offset is not None:
+            await self.spool.flush(offset)
+
+    def insert_nowait(self, events: List[dict], size: Optional[int] = None) -> bool:
+        """ Queues events right away if there is room for them, and returns
+            whether they were queued. The batcher takes ownership of the
+            `events` list.
 
-    async def get_batch(self, batch_size: int) -> List[dict]:
-        """ Returns a batch of events up to `batch_size`.
-            If there are not `batch_size` elements in the deque,
-            all remaining elements will be returned from the deque.
+            With a spool, events must be durable before an insert returns,
+            which takes waiting for an fsync, so nothing is queued and
+            callers fall back to `insert_many`.
         """
 
-        batch_size = min(batch_size, len(self.queue))
+        if self.spool is not None:
+            return False
+
+        if size is None and self.queue_max_bytes:
+            size = measure(events)
+        if not self._has_room(len(events), size):
+            return False
+
+        self._put(events, size)
+        self.accepted += len(events)
+        return True
+
+    def restore(self, events: List[dict], offset: Optional[int] = None):
+        """ Re-queues events replayed from the spool or a spill file at
+            startup, bypassing the queue size limit.
+        """
+
+        self._enqueue(events, offset)
+
+    def get_batch(self, batch_size: int, max_bytes: Optional[int] = None) -> List[dict]:
+        """ Returns a batch of events up to `batch_size`, and up to
+            `max_bytes` in total if given. A batch always contains at least
+            one event if the queue is not empty, however large it is.
+            If there are not `batch_size` elements queued,
+            all remaining elements are returned.
+        """
+
+        batch = None
+        count = 0
+        total = 0
+        chunks = self._chunks
+        while chunks and count < batch_size:
+            chunk = chunks[0]
+            available = len(chunk.events) - chunk.start
+            take = min(available, batch_size - count)
+            if max_bytes is not None and chunk.size:
+                fits = max(max_bytes - total, 0) * available // chunk.size
+                if fits < take:
+                    # The byte budget runs out in this chunk
+                    take = max(fits, 0 if count else 1)
+                    batch_size = count + take
+
+            if take == available:
+                chunks.popleft()
+                events = chunk.events if chunk.start == 0 else chunk.events[chunk.start:]
+                size = chunk.size
+            elif take:
+                events = chunk.events[chunk.start:chunk.start + take]
+                size = chunk.size * take // available
+                chunk.start += take
+                chunk.size -= size
+            else:
+                break
+
+            if batch is None:
+                batch = events
+            else:
+                batch.extend(events)
+            count += take
+            total += size
+
+        if batch is None:
+            batch = []
 
-        async with self._lock:
-            return [self.queue.popleft() for _ in range(batch_size)]
+        self._count -= count
+        self._bytes -= total
+        if count:
+            self._space.set()
+        if self.spool is not None and batch:
+            self._inflight[id(batch)] = (self._popped, self._popped + count)
+        self._popped += count
+        # Taking a batch restarts the flush timer for whatever is left.
+        self._ready.clear()
+        self._cancel_deadline()
+        self._signal()
+        return batch
 
-    async def is_empty(self) -> bool:
+    def is_empty(self) -> bool:
         """ Returns whether or not the batcher is empty.
             Useful for waiting to stop the application.
         """
 
-        async with self._lock:
-            return len(self.queue) == 0
+        return self._count == 0
 
-    async def remaining(self) -> int:
+    def remaining(self) -> int:
         """ Returns the number of events in the queue
         """
 
-        async with self._lock:
-            return len(self.queue)
+        return self._count
+
+    def ack(self, batch: List[dict]):
+        """ Marks a batch returned by `get_batch` as delivered. The spool
+            checkpoint advances past every record whose events have all
+            been delivered.
+        """
+
+        if self._inflight.pop(id(batch), None) is None:
+            return
+
+        # Everything before the oldest batch still in flight is delivered
+        delivered = min(
+            (first for first, _ in self._inflight.values()),
+            default=self._popped,
+        )
+
+        offset = None
+        while self._marks and self._marks[0][0] <= delivered:
+            _, offset = self._marks.popleft()
+
+        if offset is not None:
+            self.spool.ack(offset)
+
+    def stats(self) -> dict:
+        """ Returns the queue depth and insert and pop counters.
+        """
+
+        return {
+            "queued": self._count,
+            "queued_bytes": self._bytes,
+            "accepted": self.accepted,
+            "delayed": self.delayed,
+            "dropped": self.dropped,
+            "popped": self._popped,
+        }
+
+    async def wait_ready(self):
+        """ Blocks until a batch should be flushed, either because the
+            size threshold was crossed or the flush deadline expired.
+        """
+
+        await self._ready.wait()
+
+    def drain(self):
+        """ Stops batching up events; from now on anything queued is ready
+            to be sent straight away.
+        """
+
+        self.draining = True
+        self._signal()
+
+    def reconfigure(
+        self,
+        queue_max_size: int,
+        flush_size: int,
+        flush_after: float,
+        flush_bytes: Optional[int],
+        queue_max_bytes: Optional[int] = None,
+    ):
+        """ Applies new limits to the queue as it is. A pending flush
+            deadline is restarted with the new `flush_after`.
+        """
+
+        self.queue_max_size = queue_max_size
+        self.queue_max_bytes = queue_max_bytes
+        self.flush_size = flush_size
+        self.flush_after = flush_after
+        self.flush_bytes = flush_bytes
+        self._space.set()
+        self._cancel_deadline()
+        self._signal()
+
+    def wake(self):
+        """ Wakes up anything blocked in `wait_ready`, regardless of
+            the queue state. Used to unblock the sender on shutdown.
+        """
+
+        self._cancel_deadline()
+        self._ready.set()
+
+    def _put(self, events: List[dict], size: Optional[int]) -> Optional[int]:
+        """ Writes events ahead to the spool, if there is one, and queues
+            them. Returns the spool offset to flush up to.
+        """
+
+        offset = None
+        if self.spool is not None:
+            offset = self.spool.write(events)
+
+        self._enqueue(events, offset, size)
+        return offset
+
+    def _enqueue(self, events: List[dict], offset: Optional[int], size: Optional[int] = None):
+        if not events:
+            return
+
+        if size is None:
+            size = measure(events)
+
+        tail = self._chunks[-1] if self._chunks else None
+        if tail is not None and len(tail.events) < COALESCE_SIZE:
+            tail.events.extend(events)
+            tail.size += size
+        else:
+            self._chunks.append(Chunk(events, size))
+        self._count += len(events)
+        self._bytes += size
+        self._inserted += len(events)
+        if offset is not None:
+            self._marks.append((self._inserted, offset))
+        self._signal()
+
+    async def _wait_for_room(self, count: int, size: Optional[int], timeout: Optional[float]):
+        """ Waits until `count` events of `size` bytes fit in the queue,
+            raising `BatcherFull` if that takes longer than `timeout`
+            seconds.
+        """
+
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self._has_room(count, size):
+            self._space.clear()
+            try:
+                await asyncio.wait_for(
+                    self._space.wait(),
+                    None if deadline is None else deadline - loop.time(),
+                )
+            except asyncio.TimeoutError:
+                self.dropped += count
+                raise BatcherFull(count, self.stats())
+
+    def _has_room(self, count: int, size: Optional[int] = None) -> bool:
+        # An oversized insert is still accepted into an empty queue,
+        # otherwise it could never succeed.
+        if not self._count:
+            return True
+        if self._count + count > self.queue_max_size:
+            return False
+
+        return not self.queue_max_bytes or size is None or self._bytes + size <= self.queue_max_bytes
+
+    def _signal(self):
+        """ Updates the ready signal after the queue has changed.
+        """
+
+        if self._count >= self.flush_size or (self.draining and self._count) or (
+            self.flush_bytes is not None and self._bytes >= self.flush_bytes
+        ):
+            self._cancel_deadline()
+            self._ready.set()
+        elif not self._count:
+            self._cancel_deadline()
+            self._ready.clear()
+        elif self._deadline is None and not self._ready.is_set():
+            loop = asyncio.get_event_loop()
+            self._deadline = loop.call_later(self.flush_after, self._expire)
+
+    def _expire(self):
+        """ Deadline timer callback; the pending batch is old enough to send.
+        """
+
+        self._deadline = None
+        logger.debug(f"Flush deadline of {self.flush_after}s expired")
+        self._ready.set()
+
+    def _cancel_deadline(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+
+
+def measure(events: List[dict]) -> int:
+    """ The serialized size of events whose size is not known.
+    """
+
+    return sum(len(ujson.dumps(event)) for event in events)
+
+
+class Chunk:
+    """ The events of one or more inserts, of which the first `start`
+        have been taken already. `size` is the serialized size of the
+        events which have not been taken.
+    """
+
+    __slots__ = ("events", "start", "size")
+
+    def __init__(self, events: List[dict], size: int):
+        self.events = events
+        self.start = 0
+        self.size = size
+
+
+class BatcherFull(Exception):
+    """ Raised when events could not be inserted into the batcher
+        before the insert timeout expired.
+    """
+
+    def __init__(self, count: int, stats: dict):
+        super().__init__(f"Batcher full, rejected {count} events ({stats})")
+        self.count = count
+        self.stats = stats
 
 
 class BatcherService(aiomisc.Service):
 
     queue_max_size: int = 200
+    queue_max_bytes: Optional[int] = None
+    flush_size: int = 10
+    flush_after: float = 5
+    flush_bytes: Optional[int] = None
+    spool_directory: Optional[str] = None
+    spool_segment_size: int = 64 * 1024 * 1024
+    spill_path: Optional[str] = None
+
+    spool: Optional[Spool] = None
+    batcher: Optional[Batcher] = None
 
     async def start(self):
         """ Registers the batcher instance into the application context.
+            If a spool directory is configured, anything left unacknowledged
+            in the spool is replayed into the batcher first, and so is
+            anything spilled by the last shutdown.
         """
 
+        if self.spool_directory:
+            self.spool = Spool(self.spool_directory, self.spool_segment_size)
+
         batcher = Batcher(
             queue_max_size=self.queue_max_size,
+            flush_size=self.flush_size,
+            flush_after=self.flush_after,
+            flush_bytes=self.flush_bytes,
+            spool=self.spool,
+            queue_max_bytes=self.queue_max_bytes,
         )
 
-        self.context["batcher"] = batcher
\ No newline at end of file
+        if self.spool is not None:
+            replayed = 0
+            for offset, events in self.spool.open():
+                batcher.restore(events, offset)
+                replayed += len(events)
+            logger.info(f"Replayed {replayed} events from spool {self.spool_directory}")
+
+        if self.spill_path:
+            spilled = take_spill(self.spill_path)
+            if spilled:
+                # Put them through the spool, if there is one, so they
+                # stay durable now that the spill file is gone.
+                offset = self.spool.write(spilled) if self.spool is not None else None
+                batcher.restore(spilled, offset)
+                if offset is not None:
+                    await self.spool.flush(offset)
+                logger.info(f"Replayed {len(spilled)} events spilled to {self.spill_path}")
+
+        self.register_metrics(batcher)
+        self.batcher = batcher
+        self.context["batcher"] = batcher
+
+    def reconfigure(self, s: Settings):
+        """ Applies reloaded queue and flush settings.
+        """
+
+        self.queue_max_size = s.QUEUE_MAX_SIZE
+        self.queue_max_bytes = s.QUEUE_MAX_BYTES or None
+        self.flush_size = s.SEND_AFTER_EVENTS
+        self.flush_after = s.SEND_AFTER_TIME
+        self.flush_bytes = s.SEND_MAX_BYTES
+        if self.batcher is not None:
+            self.batcher.reconfigure(
+                self.queue_max_size, self.flush_size, self.flush_after, self.flush_bytes, self.queue_max_bytes,
+            )
+
+    def register_metrics(self, batcher: Batcher):
+        """ Exposes the batcher's own counters, read when scraped.
+        """
+
+        for name, kind, key, help in (
+            ("auth0_batcher_queued_events", "gauge", "queued", "Events waiting to be sent."),
+            ("auth0_batcher_queued_bytes", "gauge", "queued_bytes", "Size of the events waiting to be sent."),
+            ("auth0_batcher_accepted_events_total", "counter", "accepted", "Events inserted into the queue."),
+            ("auth0_batcher_delayed_events_total", "counter", "delayed", "Events which waited for room in the queue."),
+            ("auth0_batcher_dropped_events_total", "counter", "dropped", "Events rejected because the queue was full."),
+            ("auth0_batcher_popped_events_total", "counter", "popped", "Events taken from the queue for sending."),
+        ):
+            REGISTRY.value(name, kind, help, lambda key=key: batcher.stats()[key])
+
+    async def stop(self, exception: Exception = None):
+        """ Flushes and closes the spool, if there is one.
+        """
+
+        if self.spool is not None:
+            await self.spool.close()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+from typing import Callable, Dict, Iterable, List, Tuple
+
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+except ImportError:
+    import ujson
+
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj).encode()
+
+    loads = ujson.loads
+
+NDJSON_HEADERS = {"Content-Type": "application/x-ndjson"}
+GZIP_NDJSON_HEADERS = {**NDJSON_HEADERS, "Content-Encoding": "gzip"}
+
+COMPRESSIONS = frozenset(["none", "gzip"])
+
+
+def gzip_compress(body: bytes, level: int = 3) -> bytes:
+    """ Gzips a request body. zlib with a gzip wrapper skips the Python
+        level file object `gzip.compress` goes through.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class BulkBodyBuilder:
+    """ Serializes a batch of events straight into an NDJSON bulk request
+        body, so the Elasticsearch client can send it as-is instead of
+        serializing each action and source dict itself.
+
+        The action line for an index is the same for every document apart
+        from the `_id`, so everything before the `_id` is cached per index.
+        `action` is `index`, or `create` for data streams, which also need
+        `timestamp` set: documents without an `@timestamp` are then given
+        their `date` as one, without modifying the event.
+        Uses orjson if it is installed, ujson otherwise.
+    """
+
+    action: str
+    timestamp: bool
+    _actions: Dict[str, bytes]
+    _dumps: Callable[[object], bytes]
+
+    def __init__(
+        self,
+        dumps: Callable[[object], bytes] = dumps,
+        action: str = "index",
+        timestamp: bool = False,
+    ):
+        self.action = action
+        self.timestamp = timestamp
+        self._actions = {}
+        self._dumps = dumps
+
+    def build(self, events: List[dict], index: str) -> bytes:
+        """ Returns the bulk body indexing each event's `data` into `index`
+            with its `log_id` as the document ID.
+        """
+
+        return self.build_groups([(index, events)])
+
+    def build_groups(self, groups: Iterable[Tuple[str, List[dict]]]) -> bytes:
+        """ Returns the bulk body for a number of `(index, events)` groups.
+        """
+
+        dumps = self._dumps
+        timestamp = self.timestamp
+        parts = []
+        append = parts.append
+        for index, events in groups:
+            prefix = self.action_prefix(index)
+            for event in events:
+                append(prefix)
+                append(dumps(event["log_id"]))
+                append(b"}}\n")
+                data = event["data"]
+                if timestamp and "@timestamp" not in data:
+                    data = {**data, "@timestamp": data.get("date")}
+                append(dumps(data))
+                append(b"\n")
+
+        # join sizes the result once and copies each part into it
+        return b"".join(parts)
+
+    def action_prefix(self, index: str) -> bytes:
+        """ Returns the cached start of an action line, up to `_id`.
+        """
+
+        try:
+            return self._actions[index]
+        except KeyError:
+            prefix = b'{"' + self.action.encode() + b'":{"_index":' + self._dumps(index) + b',"_id":'
+            self._actions[index] = prefix
+            return prefix
@@ -1,57 +1,214 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-from typing import Iterator, List
+from typing import List, Optional, Tuple
 
 import aioelasticsearch
+import aiohttp
 import aiomisc
 from loguru import logger
 
+from .bulk import (
+    COMPRESSIONS, GZIP_NDJSON_HEADERS, NDJSON_HEADERS,
+    BulkBodyBuilder, gzip_compress,
+)
 from .log import make_propagating_logger
+from .metrics import BULK_BYTES, BULK_COMPRESSED_BYTES, BULK_EVENTS
+from .nodes import HealthAwareTransport, NodeHealth
+from .routing import IndexRouter
 from .settings import Settings
+from .templates import TemplateBootstrap
+
+# How long startup waits on the index template before going ahead
+BOOTSTRAP_TIMEOUT = 30
+# How often indices are pre-created, and a failed template install retried
+BOOTSTRAP_INTERVAL = 60 * 60
+
+
+def bulk_builder(index_mode: str) -> BulkBodyBuilder:
+    """ Returns the body builder for writing in `index_mode`.
+    """
+
+    # Data streams require every document to have an @timestamp
+    data_stream = index_mode == "data_stream"
+    return BulkBodyBuilder(action="create" if data_stream else "index", timestamp=data_stream)
+
+
+def service_options(s: Settings) -> dict:
+    """ The `ClientService` options every cluster written to shares.
+    """
+
+    return dict(
+        index_mode=s.ELASTICSEARCH_INDEX_MODE,
+        ssl_verify=s.ELASTICSEARCH_SSL_VERIFY,
+        pool_size=s.ELASTICSEARCH_POOL_SIZE,
+        pool_size_per_host=s.ELASTICSEARCH_POOL_SIZE_PER_HOST,
+        keepalive_timeout=s.ELASTICSEARCH_KEEPALIVE_TIMEOUT,
+        compression=s.ELASTICSEARCH_COMPRESSION,
+        compression_level=s.ELASTICSEARCH_COMPRESSION_LEVEL,
+        compression_offload_size=s.ELASTICSEARCH_COMPRESSION_OFFLOAD_SIZE,
+        circuit_failures=s.ELASTICSEARCH_CIRCUIT_FAILURES,
+        circuit_open_time=s.ELASTICSEARCH_CIRCUIT_OPEN_TIME,
+        sniff_interval=s.ELASTICSEARCH_SNIFF_INTERVAL,
+        template_name=s.ELASTICSEARCH_TEMPLATE_NAME,
+        template_shards=s.ELASTICSEARCH_TEMPLATE_SHARDS,
+        template_replicas=s.ELASTICSEARCH_TEMPLATE_REPLICAS,
+        template_refresh_interval=s.ELASTICSEARCH_TEMPLATE_REFRESH_INTERVAL,
+        template_cache_path=s.ELASTICSEARCH_TEMPLATE_CACHE_PATH,
+        precreate_days=s.ELASTICSEARCH_PRECREATE_DAYS,
+    )
 
 
 class Client:
     """ Elasticsearch client for ingesting bulk data
     """
 
-    def __init__(self, username: str, password: str, hosts: str, index_name: str, ssl_verify: bool, *, loop: asyncio.AbstractEventLoop):
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        hosts: str,
+        index_name: str,
+        ssl_verify: bool,
+        *,
+        index_mode: str = "daily",
+        pool_size: int = 10,
+        pool_size_per_host: int = 0,
+        keepalive_timeout: float = 15,
+        compression: str = "none",
+        compression_level: int = 3,
+        compression_offload_size: int = 256 * 1024,
+        circuit_failures: int = 3,
+        circuit_open_time: float = 5,
+        sniff_interval: float = 0,
+        loop: asyncio.AbstractEventLoop,
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {sorted(COMPRESSIONS)}")
 
         auth = None
         if username and password:
-            auth = (username, password)
+            auth = aiohttp.BasicAuth(username, password)
+
+        # All nodes share one connection pool, so `pool_size` bounds the
+        # connections to the whole cluster and `pool_size_per_host` (0 for
+        # no limit) the connections to each node.
+        self.session = aiohttp.ClientSession(
+            auth=auth,
+            connector=aiohttp.TCPConnector(
+                limit=pool_size,
+                limit_per_host=pool_size_per_host,
+                keepalive_timeout=keepalive_timeout,
+                ssl=None if ssl_verify else False,
+            ),
+        )
 
         es_config = {
             "hosts": hosts.split(","),
             "verify_certs": ssl_verify,
+            "session": self.session,
+            "transport_class": HealthAwareTransport,
+            "health_options": {
+                "failure_threshold": circuit_failures,
+                "open_time": circuit_open_time,
+            },
         }
-
-        if auth:
-            es_config.update({"http_auth": auth})
+        if sniff_interval:
+            # Find every node of the cluster from the configured ones, at
+            # startup and then every `sniff_interval` seconds
+            es_config.update(sniff_on_start=True, sniffer_timeout=sniff_interval)
 
         self.es = aioelasticsearch.Elasticsearch(loop=loop, **es_config)
+        self.health: NodeHealth = self.es.transport.health
         self.index_name = index_name 
+        self.router = IndexRouter(index_name, index_mode)
+        self.builder = bulk_builder(index_mode)
+        self.loop = loop
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_offload_size = compression_offload_size
+        # Clients with the same key make the same body from a batch
+        self.body_key = (index_name, index_mode, compression, compression_level)
+
+    def available(self) -> bool:
+        """ Whether any node can be sent to, ie. not every node's circuit
+            is open.
+        """
+
+        return self.health.available()
 
     async def send(self, events: List[dict]):
+        """ Bulk-indexes a batch of events. Events are grouped by their
+            target index, and `events` is reordered in place to match, so
+            the items of the bulk response line up with it.
+        """
+
+        ordered, body = await self.prepare(events)
+        if ordered is not events:
+            events[:] = ordered
+
+        return await self.bulk(body)
+
+    async def prepare(self, events: List[dict]) -> Tuple[List[dict], bytes]:
+        """ Serializes (and compresses, if configured) the bulk body for
+            a batch of events, grouped by their target index. Returns the
+            events in the order of the body's items, which is the order of
+            the items of the bulk response, along with the body.
+        """
 
-        return await self.es.bulk(
-            self.iterate_docs(events),
-            index=self.index_name,
-            _source=False,
+        groups = self.router.group(events)
+        ordered = events
+        if len(groups) > 1:
+            ordered = [event for _, group in groups for event in group]
+
+        body = self.builder.build_groups(groups)
+        BULK_EVENTS.observe(len(events))
+        BULK_BYTES.observe(len(body))
+
+        if self.compression == "gzip":
+            body = await self.compress(body)
+            BULK_COMPRESSED_BYTES.observe(len(body))
+
+        return ordered, body
+
+    async def bulk(self, body: bytes) -> dict:
+        """ Sends a bulk body made by `prepare`.
+        """
+
+        # Not through `es.bulk`, which appends a newline to bodies without
+        # one, and so garbage after the trailer of a gzipped body
+        return await self.es.transport.perform_request(
+            "POST",
+            "/_bulk",
+            params={"_source": "false"},
+            body=body,
+            headers=GZIP_NDJSON_HEADERS if self.compression == "gzip" else NDJSON_HEADERS,
         )
 
-    def iterate_docs(self, events: List[dict]) -> Iterator[dict]:
+    async def compress(self, body: bytes) -> bytes:
+        """ Compresses a bulk body, in the thread pool if it is large
+            enough to hold up the event loop. zlib releases the GIL while
+            it works, so this runs alongside the loop.
+        """
+
+        if len(body) < self.compression_offload_size:
+            return gzip_compress(body, self.compression_level)
 
-        for event in events:
-            yield {"index": {
-                "_index": self.index_name,
-                "_id": event["log_id"]
-            }}
+        return await self.loop.run_in_executor(None, gzip_compress, body, self.compression_level)
 
-            yield event["data"]
+    async def close(self):
+        await self.es.close()
+        await self.session.close()
 
 
 class ClientService(aiomisc.Service):
+    """ Creates a client and registers it in the context as `context_key`.
+
+        If `template_name` is set, the index template is installed (see
+        `TemplateBootstrap`) before the client is registered, so nothing
+        is written before the mapping is in place, and indices are then
+        pre-created in the background.
+    """
 
     __required__ = frozenset([
         "username",
@@ -66,6 +223,25 @@ class ClientService(aiomisc.Service):
     hosts: str
     index_name: str
     ssl_verify: bool
+    index_mode: str = "daily"
+    pool_size: int = 10
+    pool_size_per_host: int = 0
+    keepalive_timeout: float = 15
+    compression: str = "none"
+    compression_level: int = 3
+    compression_offload_size: int = 256 * 1024
+    circuit_failures: int = 3
+    circuit_open_time: float = 5
+    sniff_interval: float = 0
+    context_key: str = "client"
+    template_name: str = ""
+    template_shards: int = 1
+    template_replicas: int = 1
+    template_refresh_interval: str = "30s"
+    template_cache_path: str = ""
+    precreate_days: int = 1
+
+    _bootstrap_task: Optional[asyncio.Task] = None
 
     async def start(self):
         """ Registers the client instance into the application context.
@@ -77,7 +253,50 @@ class ClientService(aiomisc.Service):
             self.hosts,
             self.index_name,
             self.ssl_verify,
+            index_mode=self.index_mode,
+            pool_size=self.pool_size,
+            pool_size_per_host=self.pool_size_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            compression_offload_size=self.compression_offload_size,
+            circuit_failures=self.circuit_failures,
+            circuit_open_time=self.circuit_open_time,
+            sniff_interval=self.sniff_interval,
             loop=self.loop,
         )
 
-        self.context["client"] = client
\ No newline at end of file
+        if self.template_name:
+            await self.bootstrap(client)
+
+        self.context[self.context_key] = client
+
+    async def bootstrap(self, client: Client):
+        bootstrap = TemplateBootstrap(
+            client.es,
+            client.router,
+            self.template_name,
+            self.hosts,
+            shards=self.template_shards,
+            replicas=self.template_replicas,
+            refresh_interval=self.template_refresh_interval,
+            precreate_days=self.precreate_days,
+            cache_path=self.template_cache_path,
+        )
+        try:
+            await asyncio.wait_for(bootstrap.run_once(), BOOTSTRAP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Index template {self.template_name} not installed after {BOOTSTRAP_TIMEOUT}s, going ahead")
+
+        self._bootstrap_task = self.loop.create_task(bootstrap.run(BOOTSTRAP_INTERVAL))
+
+    async def stop(self, exception: Exception = None):
+        """ Closes the client's connections.
+        """
+
+        if self._bootstrap_task is not None:
+            self._bootstrap_task.cancel()
+            await asyncio.gather(self._bootstrap_task, return_exceptions=True)
+
+        client: Client = await self.context[self.context_key]
+        await client.close()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from typing import List, Tuple
+
+import ujson
+
+
+class CompactEvent:
+    """ A queued event kept as its JSON text rather than as the tree of
+        dicts and strings it was parsed into, which takes several times
+        as much memory. ujson writes it out as that text as-is, so it can
+        be spooled or spilled like any other event, and it is read back
+        as a plain event.
+
+        The text is ASCII (ujson escapes anything else), so as a `str` it
+        takes one byte per character.
+    """
+
+    __slots__ = ("raw",)
+
+    raw: str
+
+    def __init__(self, raw: str):
+        self.raw = raw
+
+    def __json__(self) -> str:
+        return self.raw
+
+    def expand(self) -> dict:
+        return ujson.loads(self.raw)
+
+
+def pack(events: List[dict]) -> Tuple[List[CompactEvent], int]:
+    """ Turns events into compact ones. Returns them along with their
+        total serialized size.
+    """
+
+    packed = [CompactEvent(ujson.dumps(event)) for event in events]
+    return packed, sum(len(event.raw) for event in packed)
+
+
+def expand(events: list) -> bool:
+    """ Turns the compact events of a batch back into plain events, in
+        place, so the batch is still the list the batcher handed out.
+        Returns whether there were any.
+    """
+
+    if not any(type(event) is CompactEvent for event in events):
+        return False
+
+    events[:] = [event.expand() if type(event) is CompactEvent else event for event in events]
+    return True
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+from typing import Callable, List
+
+from .metrics import DEDUP_HITS, DEDUP_MISSES
+
+DEDUP_MODES = frozenset(["exact", "bloom"])
+
+# IDs are kept as their 64-bit string hash rather than the string itself
+HASH_MASK = (1 << 64) - 1
+
+
+class HashSet:
+    """ Remembers IDs by their hash in a set. A false positive needs two
+        IDs with the same 64-bit hash, so for practical purposes this is
+        exact.
+    """
+
+    def __init__(self):
+        self.items = set()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.items
+
+    def add(self, key: int):
+        self.items.add(key)
+
+
+class BloomFilter:
+    """ Remembers IDs in a bit array, sized for `capacity` IDs at the given
+        false positive rate; about 1.8MB per million IDs at 0.1%. The bit
+        positions are derived from the two halves of the ID's hash.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, key: int) -> bool:
+        bits = self.bits
+        size = self.size
+        position = key & 0xFFFFFFFF
+        step = (key >> 32) | 1
+        for _ in range(self.hashes):
+            bit = position % size
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+            position += step
+
+        return True
+
+    def add(self, key: int):
+        bits = self.bits
+        size = self.size
+        position = key & 0xFFFFFFFF
+        step = (key >> 32) | 1
+        for _ in range(self.hashes):
+            bit = position % size
+            bits[bit >> 3] |= 1 << (bit & 7)
+            position += step
+        self.count += 1
+
+
+class DedupCache:
+    """ Remembers recently seen `log_id`s so that webhook redeliveries can
+        be dropped before they are queued.
+
+        IDs are kept in two generations. New IDs go into the current one,
+        and once it is `window` seconds old or holds half of `max_size`
+        IDs, it becomes the previous generation and the old previous one is
+        dropped. So an ID is remembered for at least `window` seconds unless
+        more than `max_size / 2` IDs arrive in that time, and memory stays
+        bounded by `max_size` IDs.
+
+        In `exact` mode generations are sets of ID hashes. In `bloom` mode
+        they are Bloom filters, which take a fraction of the memory but
+        drop a new event as a duplicate at `false_positive_rate`.
+
+        IDs returned by `unseen` are reserved until they are passed to
+        `add` once queued, or to `release` if they could not be, so a
+        redelivery arriving while the first delivery still waits for room
+        in the queue is dropped too.
+    """
+
+    window: float
+    max_size: int
+    mode: str
+
+    def __init__(
+        self,
+        window: float = 3600,
+        max_size: int = 1_000_000,
+        mode: str = "exact",
+        false_positive_rate: float = 0.001,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode {mode!r}, expected one of {sorted(DEDUP_MODES)}")
+
+        self.window = window
+        self.max_size = max_size
+        self.mode = mode
+        self.false_positive_rate = false_positive_rate
+        self.capacity = max(1, max_size // 2)
+        self._clock = clock
+        self._current = self._generation()
+        self._previous = self._generation()
+        self._started = clock()
+        self._reserved = set()
+
+    def __len__(self) -> int:
+        return len(self._current) + len(self._previous)
+
+    def unseen(self, events: List[dict]) -> List[dict]:
+        """ Returns the events whose `log_id` has not been seen, dropping
+            repeats within `events` too, and reserves their IDs. IDs are
+            not remembered until they are passed to `add`, so a delivery
+            which could not be queued, and was passed to `release`, is not
+            dropped when it is redelivered.
+        """
+
+        current = self._current
+        previous = self._previous
+        reserved = self._reserved
+        unseen = []
+        for event in events:
+            key = hash(event["log_id"]) & HASH_MASK
+            if key in reserved or key in current or key in previous:
+                continue
+
+            reserved.add(key)
+            unseen.append(event)
+
+        DEDUP_HITS.inc(len(events) - len(unseen))
+        DEDUP_MISSES.inc(len(unseen))
+        return unseen
+
+    def add(self, events: List[dict]):
+        """ Remembers the `log_id`s of events which were queued.
+        """
+
+        self._rotate()
+        current = self._current
+        reserved = self._reserved
+        for event in events:
+            key = hash(event["log_id"]) & HASH_MASK
+            current.add(key)
+            reserved.discard(key)
+
+    def release(self, events: List[dict]):
+        """ Forgets the reserved `log_id`s of events which could not be
+            queued, for their redelivery to be accepted.
+        """
+
+        reserved = self._reserved
+        for event in events:
+            reserved.discard(hash(event["log_id"]) & HASH_MASK)
+
+    def _rotate(self):
+        now = self._clock()
+        if now - self._started >= self.window or len(self._current) >= self.capacity:
+            self._previous = self._current
+            self._current = self._generation()
+            self._started = now
+
+    def _generation(self):
+        if self.mode == "bloom":
+            return BloomFilter(self.capacity, self.false_positive_rate)
+
+        return HashSet()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import math
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple
+
+from loguru import logger
+
+from .batcher import BatcherFull
+from .metrics import INGEST_FLUSH_DELIVERIES
+
+# The events of a delivery (or a chunk of one), the size of the body
+# they were parsed from, the future its handler waits on, and the loop
+# time by which they must be queued
+Submission = Tuple[List[dict], Optional[int], asyncio.Future, float]
+
+# Queues events, waiting up to the given timeout for room
+Ingest = Callable[[List[dict], Optional[int], Optional[float]], Awaitable[None]]
+
+
+class IngestFailed(Exception):
+    """ Set on the future of a delivery whose events could not be queued,
+        for the handler to answer with an error. The failure has been
+        logged already.
+    """
+
+
+class IngestCoalescer:
+    """ Gathers the events of concurrent deliveries into one batch, so
+        they are transformed and inserted into the batcher together rather
+        than one delivery at a time.
+
+        Handlers `submit` their events to a staging buffer and wait on the
+        returned future. One consumer task takes whatever has been staged
+        since it last ran, once every loop tick, up to `max_events` events
+        (but always whole deliveries) at a time, and passes it to `ingest`.
+
+        If `ingest` fails, the error is logged once for the whole batch and
+        each delivery in it is retried on its own, so one bad delivery only
+        fails itself. A full batcher fails the whole batch, for every
+        delivery to be turned away and redelivered later.
+
+        Each delivery waits for room in the batcher at most the `timeout`
+        it was submitted with, counted from when it was submitted. The
+        batch gets what is left of its earliest delivery's timeout, and
+        deliveries whose time ran out while earlier batches were waiting
+        fail with `BatcherFull` without being tried.
+    """
+
+    ingest: Ingest
+    max_events: int
+    _staged: Deque[Submission]
+    _wake: asyncio.Event
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, ingest: Ingest, max_events: int = 1000):
+        self.ingest = ingest
+        self.max_events = max_events
+        self._staged = collections.deque()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """ Stops the consumer task. Deliveries still staged are cancelled.
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+        while self._staged:
+            self._staged.popleft()[2].cancel()
+
+    def submit(
+        self,
+        events: List[dict],
+        size: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> asyncio.Future:
+        """ Stages events to be queued with the next batch, within
+            `timeout` seconds if given. The returned future is resolved
+            once they are in the batcher, or set to `BatcherFull` or
+            `IngestFailed`.
+        """
+
+        loop = asyncio.get_event_loop()
+        deadline = math.inf if timeout is None else loop.time() + timeout
+        future = loop.create_future()
+        self._staged.append((events, size, future, deadline))
+        self._wake.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._staged:
+                await self.flush(self._take())
+
+    def _take(self) -> List[Submission]:
+        staged = self._staged
+        batch = [staged.popleft()]
+        count = len(batch[0][0])
+        while staged and count + len(staged[0][0]) <= self.max_events:
+            batch.append(staged.popleft())
+            count += len(batch[-1][0])
+
+        return batch
+
+    async def flush(self, batch: List[Submission]):
+        """ Queues a batch of submissions and resolves their futures.
+        """
+
+        batch = self._unexpired(batch)
+        if not batch:
+            return
+
+        INGEST_FLUSH_DELIVERIES.observe(len(batch))
+        if len(batch) == 1:
+            events, size, future, deadline = batch[0]
+        else:
+            events = [event for part, _, _, _ in batch for event in part]
+            sizes = [size for _, size, _, _ in batch]
+            size = None if None in sizes else sum(sizes)
+            deadline = min(deadline for _, _, _, deadline in batch)
+
+        try:
+            await self.ingest(events, size, remaining(deadline))
+        except BatcherFull as err:
+            for _, _, future, _ in batch:
+                resolve(future, err)
+            return
+        except Exception as err:
+            logger.opt(exception=err).error(
+                f"Could not queue {len(events)} events from {len(batch)} deliveries"
+            )
+            if len(batch) == 1:
+                resolve(batch[0][2], failed(err))
+            else:
+                await self._flush_each(batch)
+            return
+
+        for _, _, future, _ in batch:
+            resolve(future)
+
+    def _unexpired(self, batch: List[Submission]) -> List[Submission]:
+        """ Fails the submissions of a batch which are out of time, and
+            returns the rest.
+        """
+
+        return [submission for submission in batch if not expire(submission)]
+
+    async def _flush_each(self, batch: List[Submission]):
+        """ Queues the submissions of a failed batch one by one.
+        """
+
+        failures = 0
+        for submission in batch:
+            if expire(submission):
+                failures += 1
+                continue
+
+            events, size, future, deadline = submission
+            try:
+                await self.ingest(events, size, remaining(deadline))
+            except Exception as err:
+                failures += 1
+                resolve(future, err if isinstance(err, BatcherFull) else failed(err))
+            else:
+                resolve(future)
+
+        if failures:
+            logger.error(f"{failures} of {len(batch)} deliveries could not be queued on their own either")
+        else:
+            logger.info(f"All {len(batch)} deliveries were queued on their own")
+
+
+def expire(submission: Submission) -> bool:
+    """ Fails a submission with `BatcherFull` if it is out of time.
+    """
+
+    events, _, future, deadline = submission
+    if deadline > asyncio.get_event_loop().time():
+        return False
+
+    resolve(future, BatcherFull(len(events), {"waited_for": "earlier deliveries"}))
+    return True
+
+
+def remaining(deadline: float) -> Optional[float]:
+    if deadline == math.inf:
+        return None
+
+    return max(deadline - asyncio.get_event_loop().time(), 0)
+
+
+def failed(err: Exception) -> IngestFailed:
+    error = IngestFailed(repr(err))
+    error.__cause__ = err
+    return error
+
+
+def resolve(future: asyncio.Future, error: Optional[Exception] = None):
+    """ Resolves a handler's future, unless the handler has gone away.
+    """
+
+    if future.done():
+        return
+
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
@@ -1,31 +1,203 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import json
 import logging
+import multiprocessing.util
 import sys
-from typing import List
+import threading
+from typing import Deque, Optional, TextIO
 
 from loguru import logger
 
+from .metrics import REGISTRY
 from .settings import Settings
 
+# Stdlib loggers whose records are sampled, like debug messages
+SAMPLED_LOGGERS = frozenset(["aiohttp.access"])
+
+
+class Sampler:
+    """ Keeps one in every `1 / rate` messages. As a loguru filter, only
+        debug messages are sampled.
+    """
+
+    def __init__(self, rate: float):
+        self.every = round(1 / rate) if rate > 0 else 0
+        self._count = 0
+
+    def keep(self) -> bool:
+        if not self.every:
+            return False
+
+        self._count += 1
+        return self._count % self.every == 0
+
+    def __call__(self, record: dict) -> bool:
+        return record["level"].no > logging.DEBUG or self.keep()
+
 
 class InterceptHandler(logging.Handler):
+    """ Passes stdlib log records on to loguru. The origin of the message
+        is copied from the stdlib record into the loguru one, rather than
+        found by walking up the stack from here on every record.
 
-    def emit(self, record):
+        With a `sampler`, records from `SAMPLED_LOGGERS` are sampled before
+        they reach loguru.
+    """
 
-        # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+    def __init__(self, sampler: Optional[Sampler] = None):
+        super().__init__()
+        self.logger = logger.patch(self._patch)
+        self.sampler = sampler
+        self._record = None
+
+    def emit(self, record: logging.LogRecord):
+        if self.sampler is not None and record.name in SAMPLED_LOGGERS and not self.sampler.keep():
+            return
+
+        # Handler.handle holds the handler lock around emit
+        self._record = record
+        log = self.logger
+        if record.exc_info:
+            log = log.opt(exception=record.exc_info)
+
+        log.log(record.levelname, record.getMessage())
+
+    def _patch(self, entry: dict):
+        record = self._record
+        entry.update(
+            name=record.name,
+            function=record.funcName,
+            line=record.lineno,
+            module=record.module,
+        )
+
+
+class BackgroundSink:
+    """ A loguru sink which only queues messages. A thread serializes
+        them and writes them to `stream` in batches, every `flush_interval`
+        seconds or once `batch_size` are waiting, so neither serialization
+        nor a slow stdout hold up the event loop.
+
+        If `max_pending` messages are already waiting, new ones are
+        dropped and counted in `dropped`, as are messages the stream
+        fails to take.
+    """
 
-        # Find caller from where originated the logged message
-        frame, depth = logging.currentframe(), 2
-        while frame.f_code.co_filename == logging.__file__:
-            frame = frame.f_back
-            depth += 1
+    stream: TextIO
+    flush_interval: float
+    batch_size: int
+    max_pending: int
+    dropped: int
+    _pending: Deque
+
+    def __init__(
+        self,
+        stream: TextIO,
+        flush_interval: float = 0.1,
+        batch_size: int = 256,
+        max_pending: int = 100_000,
+    ):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._start()
+        # Worker processes need their own writer thread
+        multiprocessing.util.register_after_fork(self, BackgroundSink._start)
+
+    def write(self, message):
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        pending.append(message)
+        if len(pending) >= self.batch_size and not self._wake.is_set():
+            self._wake.set()
+
+    def write_pending(self):
+        """ Writes out everything queued so far, from the calling thread.
+        """
+
+        with self._lock:
+            pending = self._pending
+            lines = []
+            while pending:
+                lines.append(serialize(pending.popleft()))
+
+            if lines:
+                try:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                except Exception:
+                    self.dropped += len(lines)
+                    raise
+
+    def stop(self):
+        """ Stops the writer thread, writing out what is left first.
+            Called by loguru when the sink is removed.
+        """
+
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+        self.write_pending()
+
+    def _start(self):
+        # Anything queued before a fork was the parent's to write
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        # Worker processes exit without running atexit handlers, so
+        # loguru does not stop the sink there
+        multiprocessing.util.Finalize(self, self.write_pending, exitpriority=0)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.write_pending()
+            except Exception:
+                # Counted in `dropped`; there is nowhere left to log to
+                pass
+
+
+def serialize(message) -> str:
+    """ Renders a message as a JSON line, in the same shape as loguru's
+        own `serialize=True`.
+    """
 
-        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+    record = message.record
+    exception = record["exception"]
+    return json.dumps({
+        "text": str(message),
+        "record": {
+            "elapsed": {"repr": record["elapsed"], "seconds": record["elapsed"].total_seconds()},
+            "exception": exception and {
+                "type": exception.type.__name__,
+                "value": exception.value,
+                "traceback": bool(exception.traceback),
+            },
+            "extra": record["extra"],
+            "file": {"name": record["file"].name, "path": record["file"].path},
+            "function": record["function"],
+            "level": {"icon": record["level"].icon, "name": record["level"].name, "no": record["level"].no},
+            "line": record["line"],
+            "message": record["message"],
+            "module": record["module"],
+            "name": record["name"],
+            "process": {"id": record["process"].id, "name": record["process"].name},
+            "thread": {"id": record["thread"].id, "name": record["thread"].name},
+            "time": {"repr": record["time"], "timestamp": record["time"].timestamp()},
+        },
+    }, default=str) + "\n"
 
 
 def make_propagating_logger(path: str) -> logging.Logger:
@@ -40,8 +212,10 @@ def make_propagating_logger(path: str) -> logging.Logger:
     return logger
 
 
-def configure(settings: Settings):
-    """ Install an intercepting handler on the root logger.
+def configure(settings: Settings) -> Optional[BackgroundSink]:
+    """ Install an intercepting handler on the root logger, and a JSON
+        sink for loguru at `LOG_LEVEL`. With `LOG_BACKGROUND` set, the sink
+        is written from a background thread, which is returned.
     """
 
     root = logging.getLogger()
@@ -49,9 +223,22 @@ def configure(settings: Settings):
     list(map(root.removeHandler, root.handlers[:]))
     list(map(root.removeFilter, root.filters[:]))
 
+    # Debug messages and access log lines are sampled
+    sampler = None if settings.LOG_SAMPLE_RATE >= 1 else Sampler(settings.LOG_SAMPLE_RATE)
     log_level = logging._nameToLevel.get(settings.LOG_LEVEL, logging.INFO)
     root.setLevel(log_level)
-    root.addHandler(InterceptHandler())
+    root.addHandler(InterceptHandler(sampler))
 
     logger.remove()
-    logger.add(sys.stdout, format="{message}", serialize=True)
+    if not settings.LOG_BACKGROUND:
+        logger.add(sys.stdout, format="{message}", serialize=True, level=log_level, filter=sampler)
+        return None
+
+    sink = BackgroundSink(sys.stdout, flush_interval=settings.LOG_FLUSH_INTERVAL)
+    logger.add(sink, format="{message}", level=log_level, filter=sampler)
+    REGISTRY.value(
+        "auth0_log_messages_dropped_total", "counter",
+        "Log messages dropped because the log writer fell behind.",
+        lambda: sink.dropped,
+    )
+    return sink
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import bisect
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import aiomisc
+
+# Bulk request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Event loop lag buckets, in seconds
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# Bulk request size buckets, in events and in bytes
+EVENT_COUNT_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+BYTE_BUCKETS = tuple(1024 * 4 ** n for n in range(9))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# A sample is a metric name suffix, its labels and its value
+Sample = Tuple[str, str, float]
+
+
+class Counter:
+    """ A monotonically increasing count. Incrementing is a single
+        attribute update; it is only formatted when scraped.
+    """
+
+    value: float
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[Sample]:
+        return [("", "", self.value)]
+
+
+class LabeledCounter:
+    """ A set of counts split by the value of one label.
+    """
+
+    label: str
+    values: Dict[str, float]
+
+    def __init__(self, label: str):
+        self.label = label
+        self.values = {}
+
+    def inc(self, value, amount: float = 1):
+        try:
+            self.values[value] += amount
+        except KeyError:
+            self.values[value] = amount
+
+    def samples(self) -> List[Sample]:
+        return [
+            ("", f'{{{self.label}="{escape(str(value))}"}}', count)
+            for value, count in sorted(self.values.items(), key=lambda item: str(item[0]))
+        ]
+
+
+class Histogram:
+    """ A fixed-bucket histogram. Observing a value is a bisect and an
+        increment; cumulative counts are only computed when read.
+    """
+
+    buckets: Sequence[float]
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values over the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        """ Returns the number of observations less than or equal to each
+            bucket bound, followed by the total.
+        """
+
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], self.cumulative())),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def samples(self, labels: str = "") -> List[Sample]:
+        bounds = [*map(str, self.buckets), "+Inf"]
+        samples = [
+            ("_bucket", f'{{{labels}le="{bound}"}}', count)
+            for bound, count in zip(bounds, self.cumulative())
+        ]
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        samples.append(("_sum", labels, self.sum))
+        samples.append(("_count", labels, self.count))
+
+        return samples
+
+
+class LabeledHistogram:
+    """ A set of histograms split by the value of one label.
+    """
+
+    label: str
+    buckets: Sequence[float]
+    histograms: Dict[str, Histogram]
+
+    def __init__(self, label: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.label = label
+        self.buckets = buckets
+        self.histograms = {}
+
+    def get(self, value) -> Histogram:
+        """ Returns the histogram for a label value. Callers on a hot path
+            should keep hold of it rather than looking it up every time.
+        """
+
+        try:
+            return self.histograms[value]
+        except KeyError:
+            histogram = self.histograms[value] = Histogram(self.buckets)
+            return histogram
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        for value, histogram in sorted(self.histograms.items(), key=lambda item: str(item[0])):
+            samples.extend(histogram.samples(f'{self.label}="{escape(str(value))}",'))
+
+        return samples
+
+
+class Registry:
+    """ Holds the metrics exposed on `/metrics` and renders them in the
+        Prometheus text format. Metrics whose values already live on some
+        object, like the batcher's queue depth, are registered as collect
+        functions which read them at scrape time.
+    """
+
+    _metrics: Dict[str, Tuple[str, str, Callable[[], Iterable[Sample]]]]
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def register(self, name: str, kind: str, help: str, collect: Callable[[], Iterable[Sample]]):
+        """ Registers (or replaces) a metric read by calling `collect`.
+        """
+
+        self._metrics[name] = (kind, help, collect)
+
+    def counter(self, name: str, help: str, label: Optional[str] = None):
+        counter = LabeledCounter(label) if label else Counter()
+        self.register(name, "counter", help, counter.samples)
+        return counter
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        label: Optional[str] = None,
+    ):
+        histogram = LabeledHistogram(label, buckets) if label else Histogram(buckets)
+        self.register(name, "histogram", help, histogram.samples)
+        return histogram
+
+    def value(self, name: str, kind: str, help: str, read: Callable[[], float]):
+        """ Registers a gauge or counter whose value is read from `read`.
+        """
+
+        self.register(name, kind, help, lambda: [("", "", read())])
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, collect) in self._metrics.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in collect():
+                lines.append(f"{name}{suffix}{labels} {value}")
+
+        lines.append("")
+        return "\n".join(lines)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+
+RECEIVER_REQUESTS = REGISTRY.counter(
+    "auth0_receiver_requests_total",
+    "Log stream deliveries received, by response status.",
+    label="status",
+)
+RECEIVER_LATENCY = REGISTRY.histogram(
+    "auth0_receiver_request_duration_seconds",
+    "Time taken to receive, parse and queue a log stream delivery.",
+)
+BULK_LATENCY = REGISTRY.histogram(
+    "auth0_bulk_request_duration_seconds",
+    "Elasticsearch bulk request latency.",
+)
+SINK_LATENCY = REGISTRY.histogram(
+    "auth0_sink_delivery_duration_seconds",
+    "Time taken to deliver a batch to each sink.",
+    label="sink",
+)
+BULK_EVENTS = REGISTRY.histogram(
+    "auth0_bulk_request_events",
+    "Number of events per bulk request.",
+    EVENT_COUNT_BUCKETS,
+)
+BULK_BYTES = REGISTRY.histogram(
+    "auth0_bulk_request_bytes",
+    "Size of bulk request bodies.",
+    BYTE_BUCKETS,
+)
+BULK_COMPRESSED_BYTES = REGISTRY.histogram(
+    "auth0_bulk_request_compressed_bytes",
+    "Size of bulk request bodies after compression.",
+    BYTE_BUCKETS,
+)
+BULK_ERRORS = REGISTRY.counter(
+    "auth0_bulk_request_errors_total",
+    "Bulk requests which failed as a whole, by exception.",
+    label="type",
+)
+BULK_ITEM_ERRORS = REGISTRY.counter(
+    "auth0_bulk_item_errors_total",
+    "Bulk items which failed to index, by Elasticsearch error type.",
+    label="type",
+)
+DEAD_LETTERED = REGISTRY.counter(
+    "auth0_dead_lettered_events_total",
+    "Events given up on and sent to the dead-letter sink.",
+)
+DEDUP_HITS = REGISTRY.counter(
+    "auth0_dedup_hits_total",
+    "Redelivered events dropped because their log_id was already seen.",
+)
+DEDUP_MISSES = REGISTRY.counter(
+    "auth0_dedup_misses_total",
+    "Events whose log_id had not been seen yet.",
+)
+INGEST_FLUSH_DELIVERIES = REGISTRY.histogram(
+    "auth0_ingest_flush_deliveries",
+    "Number of deliveries queued together by each flush of the ingest coalescer.",
+    EVENT_COUNT_BUCKETS,
+)
+TRANSFORM_LATENCY = REGISTRY.histogram(
+    "auth0_transform_stage_duration_seconds",
+    "Time taken by each event transform stage to process a delivery.",
+    label="stage",
+)
+LOOP_LAG = REGISTRY.histogram(
+    "auth0_event_loop_lag_seconds",
+    "How late the event loop woke a periodic timer.",
+    LAG_BUCKETS,
+)
+
+
+class LoopLagService(aiomisc.Service):
+    """ Measures event loop lag by sleeping for `interval` and observing
+        how much later than that the loop got back to it.
+    """
+
+    interval: float = 0.5
+
+    _task: Optional[asyncio.Task] = None
+
+    async def start(self):
+
+        self._task = self.loop.create_task(self.measure())
+
+    async def stop(self, exception: Exception = None):
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def measure(self):
+
+        while True:
+            began = self.loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(0.0, self.loop.time() - began - self.interval))
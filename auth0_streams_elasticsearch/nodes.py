@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import weakref
+from itertools import count
+from typing import Callable, Dict, List, Optional, Set
+
+from aioelasticsearch import AIOHttpTransport
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, TransportError
+from loguru import logger
+
+from .metrics import REGISTRY, escape
+
+# How much lower a node's expected wait must be to be picked over the
+# next one in turn
+SIGNIFICANT = 0.8
+
+# Trackers of every live client, for the metrics below
+TRACKERS: "weakref.WeakSet[NodeHealth]" = weakref.WeakSet()
+
+
+class NodeStats:
+    """ What is known of one node: a moving average of its response
+        time, how many requests it has in flight, and its circuit breaker.
+        While the circuit is open (`open_until` is set) the node is not
+        sent anything until a probe finds it back.
+    """
+
+    __slots__ = ("latency", "in_flight", "failures", "trips", "open_until")
+
+    latency: Optional[float]
+    in_flight: int
+    failures: int
+    trips: int
+    open_until: Optional[float]
+
+    def __init__(self):
+        self.latency = None
+        self.in_flight = 0
+        # Failures in a row, and the times the circuit opened in a row
+        self.failures = 0
+        self.trips = 0
+        self.open_until = None
+
+
+class NodeHealth:
+    """ Picks the node each request goes to, by the latency and load of
+        each, and keeps failing nodes out of rotation.
+
+        Every node has a moving average of its response time, with weight
+        `alpha` for the latest. A request goes to the node with the lowest
+        average times one more than its requests in flight, so slow nodes
+        get less traffic and busy ones wait their turn. Nodes within
+        `SIGNIFICANT` of each other take turns.
+
+        After `failure_threshold` failures in a row (connection errors,
+        timeouts and 502/503/504s) a node's circuit opens for `open_time`,
+        doubled each time it opens again in a row up to `max_open_time`.
+        Then it is probed with a `HEAD /`, and closes again if that works.
+
+        `watch` callbacks are called whenever a circuit opens or closes,
+        for the sender to stop and start delivering while `available` is
+        false, ie. while every node is open-circuited.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    nodes: Dict[str, NodeStats]
+    alpha: float
+    failure_threshold: int
+    open_time: float
+    max_open_time: float
+    probe_timeout: float
+    _connections: List
+    _next: int
+    _watchers: List[Callable[[], None]]
+    _probes: Set[asyncio.Task]
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        *,
+        alpha: float = 0.3,
+        failure_threshold: int = 3,
+        open_time: float = 5,
+        max_open_time: float = 60,
+        probe_timeout: float = 2,
+    ):
+        self.loop = loop
+        self.nodes = {}
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.probe_timeout = probe_timeout
+        self._connections = []
+        self._next = 0
+        self._watchers = []
+        self._probes = set()
+        TRACKERS.add(self)
+
+    def set_connections(self, connections: List):
+        """ Sets the nodes to pick from, as after sniffing. Nodes already
+            known keep their stats.
+        """
+
+        self._connections = list(connections)
+        self.nodes = {connection.host: self.nodes.get(connection.host) or NodeStats() for connection in connections}
+        self._changed()
+
+    def available(self) -> bool:
+        return any(stats.open_until is None for stats in self.nodes.values())
+
+    def watch(self, callback: Callable[[], None]):
+        self._watchers.append(callback)
+
+    def select(self):
+        """ Returns the connection to the closed-circuit node with the
+            lowest expected wait, or raises `ConnectionError` if there is
+            none.
+        """
+
+        known = [stats.latency for stats in self.nodes.values() if stats.latency is not None]
+        # Nodes with no response yet are assumed as fast as the fastest
+        default = min(known) if known else 0.0
+        # Starting from the next node each time, and only moving off the
+        # first candidate for one clearly better, nodes about as good as
+        # each other take turns
+        connections = self._connections
+        self._next = (self._next + 1) % max(len(connections), 1)
+        best = None
+        best_score = 0.0
+        for connection in connections[self._next:] + connections[:self._next]:
+            stats = self.nodes[connection.host]
+            if stats.open_until is not None:
+                continue
+
+            latency = default if stats.latency is None else stats.latency
+            score = latency * (stats.in_flight + 1)
+            if best is None or score < best_score * SIGNIFICANT:
+                best, best_score = connection, score
+
+        if best is None:
+            raise ConnectionError("N/A", "Every Elasticsearch node is open-circuited", None)
+
+        return best
+
+    def begin(self, connection) -> NodeStats:
+        stats = self.nodes.get(connection.host) or NodeStats()
+        stats.in_flight += 1
+        return stats
+
+    def succeeded(self, connection, stats: NodeStats, elapsed: float):
+        stats.in_flight -= 1
+        stats.failures = 0
+        self._observe(stats, elapsed)
+
+    def failed(self, connection, stats: NodeStats, elapsed: float):
+        stats.in_flight -= 1
+        stats.failures += 1
+        # A refused connection fails fast, which must not make the node
+        # look fast
+        self._observe(stats, max(elapsed, 2 * (stats.latency or 0.0)))
+        if stats.failures >= self.failure_threshold and stats.open_until is None:
+            self._open(connection, stats)
+
+    def abandoned(self, stats: NodeStats):
+        """ For a request cancelled before it finished.
+        """
+
+        stats.in_flight -= 1
+
+    async def close(self):
+        for probe in self._probes:
+            probe.cancel()
+        await asyncio.gather(*self._probes, return_exceptions=True)
+
+    def _observe(self, stats: NodeStats, elapsed: float):
+        if stats.latency is None:
+            stats.latency = elapsed
+        else:
+            stats.latency += self.alpha * (elapsed - stats.latency)
+
+    def _open(self, connection, stats: NodeStats):
+        duration = min(self.open_time * 2 ** stats.trips, self.max_open_time)
+        stats.trips += 1
+        stats.open_until = self.loop.time() + duration
+        logger.warning(
+            f"Elasticsearch node {connection.host} failed {stats.failures} times in a row, "
+            f"not sending to it for {duration:g}s"
+        )
+
+        probe = self.loop.create_task(self._probe(connection, stats))
+        self._probes.add(probe)
+        probe.add_done_callback(self._probes.discard)
+        self._changed()
+
+    async def _probe(self, connection, stats: NodeStats):
+        await asyncio.sleep(stats.open_until - self.loop.time())
+        began = self.loop.time()
+        try:
+            await connection.perform_request("HEAD", "/", timeout=self.probe_timeout)
+        except Exception as err:
+            if self.nodes.get(connection.host) is not stats:
+                # Sniffed away meanwhile
+                return
+
+            logger.bind(error=repr(err)).warning(f"Elasticsearch node {connection.host} is still failing")
+            self._open(connection, stats)
+            return
+
+        if self.nodes.get(connection.host) is not stats:
+            return
+
+        stats.failures = 0
+        stats.trips = 0
+        stats.open_until = None
+        self._observe(stats, self.loop.time() - began)
+        logger.info(f"Elasticsearch node {connection.host} is back, sending to it again")
+        self._changed()
+
+    def _changed(self):
+        for callback in self._watchers:
+            callback()
+
+
+class HealthAwareTransport(AIOHttpTransport):
+    """ An aioelasticsearch transport which leaves picking nodes, and
+        taking failing ones out of rotation, to `NodeHealth` (as `health`)
+        rather than the connection pool's round robin and dead list.
+        Retries go to the next best node as usual.
+
+        Options for `NodeHealth` are given as `health_options`.
+    """
+
+    health: NodeHealth
+
+    def __init__(self, hosts, *, loop, health_options: Optional[dict] = None, **kwargs):
+        self.health = NodeHealth(loop, **(health_options or {}))
+        super().__init__(hosts, loop=loop, **kwargs)
+
+    def set_connections(self, hosts):
+        super().set_connections(hosts)
+        self.health.set_connections(self.connection_pool.connections)
+
+    async def get_connection(self):
+        if self._closed:
+            raise RuntimeError("Transport is closed")
+        if self.initial_sniff_task is not None:
+            await self.initial_sniff_task
+
+        if self.sniffer_timeout and self.loop.time() >= self.last_sniff + self.sniffer_timeout:
+            try:
+                await self.sniff_hosts()
+            except TransportError as err:
+                logger.bind(error=repr(err)).warning("Could not sniff Elasticsearch nodes, keeping the current ones")
+
+        return self.health.select()
+
+    async def _perform_request(self, method, url, params, body, ignore=(), timeout=None, headers=None):
+        health = self.health
+        for attempt in count(1):  # pragma: no branch
+            connection = await self.get_connection()
+            stats = health.begin(connection)
+            began = self.loop.time()
+            try:
+                status, response_headers, data = await connection.perform_request(
+                    method, url, params, body,
+                    ignore=ignore, timeout=timeout, headers=headers,
+                )
+            except TransportError as err:
+                elapsed = self.loop.time() - began
+                # Anything else is the node answering, if not as hoped
+                node_failed = isinstance(err, ConnectionError) or err.status_code in self.retry_on_status
+                if node_failed:
+                    health.failed(connection, stats, elapsed)
+                else:
+                    health.succeeded(connection, stats, elapsed)
+
+                if method == "HEAD" and err.status_code == 404:
+                    return False
+
+                retry = node_failed and (self.retry_on_timeout or not isinstance(err, ConnectionTimeout))
+                if not retry or attempt >= self.max_retries:
+                    raise
+                if self.sniff_on_connection_fail:
+                    await self.sniff_hosts()
+                continue
+            except BaseException:
+                health.abandoned(stats)
+                raise
+
+            health.succeeded(connection, stats, self.loop.time() - began)
+            if method == "HEAD":
+                return 200 <= status < 300
+
+            if data:
+                data = self.deserializer.loads(data, response_headers.get("content-type"))
+
+            return data
+
+    async def close(self):
+        await self.health.close()
+        await super().close()
+
+
+def collect_circuits():
+    return [
+        ("", f'{{node="{escape(host)}"}}', int(stats.open_until is not None))
+        for tracker in TRACKERS
+        for host, stats in tracker.nodes.items()
+    ]
+
+
+def collect_latencies():
+    return [
+        ("", f'{{node="{escape(host)}"}}', stats.latency)
+        for tracker in TRACKERS
+        for host, stats in tracker.nodes.items()
+        if stats.latency is not None
+    ]
+
+
+REGISTRY.register(
+    "auth0_elasticsearch_node_circuit_open", "gauge",
+    "Whether requests to each Elasticsearch node are held off after failures.",
+    collect_circuits,
+)
+REGISTRY.register(
+    "auth0_elasticsearch_node_latency_seconds", "gauge",
+    "Moving average of each Elasticsearch node's response time.",
+    collect_latencies,
+)
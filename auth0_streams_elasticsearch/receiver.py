@@ -1,83 +1,255 @@
 # -*- coding: utf-8 -*-
 
-import asyncio
-import functools
+import time
 from hmac import compare_digest
-from typing import Callable, List
+from typing import List, Optional
 
 import ujson
 from aiohttp import web
 from aiomisc.service.aiohttp import AIOHTTPService
 from loguru import logger
 
-from .batcher import Batcher
+from .batcher import Batcher, BatcherFull
+from .compact import pack
+from .dedup import DedupCache
+from .ingest import IngestCoalescer, IngestFailed
 from .log import make_propagating_logger
+from .metrics import CONTENT_TYPE, RECEIVER_LATENCY, RECEIVER_REQUESTS, REGISTRY
+from .parsing import InvalidEvent, LogsStreamParser, StreamParseError, parse_logs
 from .settings import Settings
-from .types import LOG_TYPES
+from .transform import LogTypeStage, Pipeline
+
+# Upper bound on how much of a streamed body is parsed in one go
+CHUNK_SIZE = 64 * 1024
 
 
 class ReceiverService(AIOHTTPService):
     """ Wrapper around AIOHTTPSERVER to add our own `aiohttp.web.Application`
+
+        With `compact` set, events are queued as compact events as they
+        arrived, and the sender runs the pipeline once it takes them from
+        the queue.
     """
 
     __required__ = frozenset(["bearer_token"])
 
     bearer_token: str
+    insert_timeout: float = 5
+    retry_after: int = 10
+    max_body_size: int = 32 * 1024 * 1024
+    parse_offload_size: int = 4 * 1024 * 1024
+    coalesce_events: int = 1000
+    compact: bool = False
+    pipeline: Optional[Pipeline] = None
+    dedup: Optional[DedupCache] = None
+    coalescer: Optional[IngestCoalescer] = None
+    draining: bool = False
 
     async def create_application(self) -> web.Application:
 
-        app = web.Application(logger=make_propagating_logger("aiohttp.access"))
+        app = web.Application(
+            logger=make_propagating_logger("aiohttp.access"),
+            client_max_size=self.max_body_size,
+        )
+        if self.pipeline is None and not self.compact:
+            self.pipeline = Pipeline([LogTypeStage()])
+        if self.coalesce_events:
+            self.coalescer = IngestCoalescer(self.ingest, self.coalesce_events)
+            self.coalescer.start()
+        if self.dedup is not None:
+            REGISTRY.value(
+                "auth0_dedup_cached_ids", "gauge",
+                "log_ids remembered by the dedup cache.",
+                self.dedup.__len__,
+            )
         app.add_routes([
             web.post("/", self.handler),
+            web.get("/metrics", self.metrics),
         ])
 
         return app
 
     async def handler(self, request: web.Request) -> web.Response:
+        """ Receives a log stream delivery, recording its response status
+            and how long it took.
+        """
+
+        began = time.monotonic()
+        status = 500
+        try:
+            response = await self.receive(request)
+            status = response.status
+            return response
+        except web.HTTPException as err:
+            status = err.status
+            raise
+        finally:
+            RECEIVER_REQUESTS.inc(status)
+            RECEIVER_LATENCY.observe(time.monotonic() - began)
+
+    async def stop(self, exception: Exception = None):
+        await super().stop(exception)
+        if self.coalescer is not None:
+            await self.coalescer.close()
+
+    def reconfigure(self, s: Settings):
+        """ Applies reloaded queue insert and coalescing settings.
+            Coalescing can not be turned on or off without a restart.
+        """
+
+        self.insert_timeout = s.QUEUE_INSERT_TIMEOUT
+        self.retry_after = s.QUEUE_FULL_RETRY_AFTER
+        if self.coalescer is not None and s.RECEIVER_COALESCE_EVENTS:
+            self.coalescer.max_events = s.RECEIVER_COALESCE_EVENTS
+
+    def drain(self):
+        """ Turns away new deliveries with a 503, for Auth0 to deliver them
+            to another instance or retry later, while the queue drains.
+        """
+
+        self.draining = True
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        """ Renders the metrics registry in the Prometheus text format.
+        """
+
+        return web.Response(
+            body=REGISTRY.render().encode(),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+
+    async def receive(self, request: web.Request) -> web.Response:
 
         auth = request.headers.get("authorization")
         if not auth or not compare_digest(f"Bearer {self.bearer_token}", auth):
             return web.HTTPForbidden()
 
-        if request.body_exists and request.can_read_body:
-            try:
-                events = await request.json(loads=ujson.loads)
-                task = self.loop.create_task(self.queue_events(events))
-                task.add_done_callback(self.on_queue_done)
+        if self.draining:
+            return web.HTTPServiceUnavailable(
+                headers={"Retry-After": str(self.retry_after)},
+            )
 
-                return web.json_response(
-                    {"message": "Received!"},
-                    dumps=ujson.dumps,
+        if request.body_exists and request.can_read_body:
+            length = request.content_length
+            if length is not None and length > self.max_body_size:
+                return web.HTTPRequestEntityTooLarge(
+                    max_size=self.max_body_size,
+                    actual_size=length,
                 )
-            except TypeError:
+
+            try:
+                if length is not None and length >= self.parse_offload_size:
+                    await self.receive_offloaded(request)
+                else:
+                    await self.receive_streaming(request)
+            except InvalidEvent as err:
+                logger.warning(f"Rejecting delivery: {err}")
+                return web.HTTPUnprocessableEntity(reason="Expected log events")
+            except (TypeError, StreamParseError):
                 return web.HTTPUnprocessableEntity(reason="Expected JSON body")
+            except BatcherFull as err:
+                # Auth0 retries failed deliveries, so ask it to come back
+                # later rather than accepting events we can't hold.
+                logger.bind(stats=err.stats).warning(f"Rejecting {err.count} events, queue is full")
+                return web.HTTPTooManyRequests(
+                    headers={"Retry-After": str(self.retry_after)},
+                )
+            except IngestFailed:
+                # Logged once for the batch this delivery was part of
+                return web.HTTPInternalServerError()
+
+            return web.json_response(
+                {"message": "Received!"},
+                dumps=ujson.dumps,
+            )
         else:
             return web.HTTPBadRequest()
 
-    async def queue_events(self, events: List[dict]):
-        """ Takes a list of events, transforms them, and inserts them into
-            the batcher queue.
+    async def receive_streaming(self, request: web.Request) -> int:
+        """ Parses the `logs` array of the request body as it arrives, and
+            queues the events once all of it has parsed, so a delivery
+            which is rejected is never partly queued. Returns the number
+            of events queued.
         """
 
-        batcher: Batcher = await self.context["batcher"]
+        parser = LogsStreamParser()
+        received = 0
+        events = []
+
+        async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+            received += len(chunk)
+            if received > self.max_body_size:
+                raise web.HTTPRequestEntityTooLarge(
+                    max_size=self.max_body_size,
+                    actual_size=received,
+                )
+
+            events.extend(parser.feed(chunk))
 
-        events = map(self.transform_event, events.get("logs", []))
-        return await batcher.insert_many(events)
+        events.extend(parser.close())
 
-    def transform_event(self, event: dict) -> dict:
-        """ Adds the long-form description of the type identifier,
-            along with any other transforms that should happen
+        return await self.queue_events(events, received)
+
+    async def receive_offloaded(self, request: web.Request) -> int:
+        """ Reads a large request body whole and parses it in the thread
+            pool, so the event loop keeps running while it is parsed.
+            Returns the number of events queued.
         """
 
-        data = event["data"]
-        data["type_description"] = LOG_TYPES.get(
-            data["type"], {}
-        ).get("event", "Unknown event type")
+        body = await request.read()
+        events = await self.loop.run_in_executor(None, parse_logs, body)
+
+        return await self.queue_events(events, len(body))
 
-        return event
+    async def queue_events(self, events: List[dict], size: Optional[int] = None) -> int:
+        """ Takes a list of events, drops any already seen or being
+            queued, and queues the rest through the coalescer, or straight
+            away if coalescing is off. `size` is the number of body bytes
+            the events were parsed from, if known. Returns the number of
+            events queued.
+        """
 
-    def on_queue_done(self, fut: asyncio.Future):
-        """ Logs the result of the process events task.
+        if self.dedup is not None:
+            unseen = self.dedup.unseen(events)
+            if size is not None and events:
+                size = size * len(unseen) // len(events)
+            events = unseen
+
+        if not events:
+            return 0
+
+        try:
+            if self.coalescer is not None:
+                await self.coalescer.submit(events, size, self.insert_timeout)
+            else:
+                await self.ingest(events, size)
+        except BaseException:
+            # A rejected delivery is retried, and must not be dropped then
+            if self.dedup is not None:
+                self.dedup.release(events)
+            raise
+
+        if self.dedup is not None:
+            self.dedup.add(events)
+
+        return len(events)
+
+    async def ingest(self, events: List[dict], size: Optional[int] = None, timeout: Optional[float] = None):
+        """ Transforms events and inserts them into the batcher queue,
+            either for one delivery or for a batch of them gathered by the
+            coalescer, waiting up to `timeout` (or `insert_timeout`) for
+            room.
         """
 
-        logger.info(f"Event queuing task completed: {fut.result()}")
\ No newline at end of file
+        batcher: Batcher = await self.context["batcher"]
+
+        queued = events
+        if self.compact:
+            queued, size = pack(events)
+        else:
+            await self.pipeline.run(events)
+        if timeout is None:
+            timeout = self.insert_timeout
+        await batcher.insert_many(queued, timeout=timeout, size=size)
+
+        logger.debug(f"Queued {len(events)} events")
@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import collections
+import functools
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from multiprocessing.synchronize import Barrier
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import aiomisc
+from loguru import logger
+
+from . import client, log, transform
+from .bulk import gzip_compress, loads
+from .retry import DeadLetterSink, is_retryable_error, partition_bulk_items
+from .routing import IndexRouter
+from .settings import Settings
+
+GZIP_MAGIC = b"\x1f\x8b"
+# How many unreadable lines of each chunk are logged
+MAX_REPORTED_LINES = 10
+# How often the checkpoint is written at most, in seconds
+CHECKPOINT_INTERVAL = 1
+
+# The bulk bodies a chunk was turned into, with the number of events in
+# each, the number of lines or events skipped, and why some of them were
+Parsed = Tuple[List[Tuple[int, bytes]], int, List[str]]
+
+
+def unwrap(record) -> List[dict]:
+    """ Returns the events held by one line of a replayed file: an event
+        as spilled or archived (`{"log_id": ..., "data": {...}}`), a dead
+        letter (`{"event": {...}, "error": {...}}`), a whole stream
+        delivery (`{"logs": [...]}`), or a bare log event as exported from
+        the Auth0 Management API, which is its own `data`.
+    """
+
+    if not isinstance(record, dict):
+        raise ValueError("not a JSON object")
+
+    if "event" in record and "error" in record:
+        record = record["event"]
+    if isinstance(record.get("logs"), list):
+        return record["logs"]
+    if "log_id" not in record:
+        raise ValueError("no log_id")
+    if isinstance(record.get("data"), dict):
+        return [record]
+
+    return [{"log_id": record["log_id"], "data": record}]
+
+
+class ChunkParser:
+    """ Turns chunks of NDJSON lines into bulk bodies, the way the client
+        would: events are transformed, routed to their index and
+        serialized in batches of at most `max_events`, and compressed if
+        the client compresses. One of these runs in each worker process.
+
+        Chunks of plain files are read from a memory map of the file, so
+        only their offsets are passed to the workers.
+    """
+
+    router: IndexRouter
+    pipeline: transform.Pipeline
+    max_events: int
+    _maps: Dict[str, mmap.mmap]
+
+    def __init__(self, s: Settings, max_events: int):
+        self.router = IndexRouter(s.ELASTICSEARCH_INDEX_NAME, s.ELASTICSEARCH_INDEX_MODE)
+        self.builder = client.bulk_builder(s.ELASTICSEARCH_INDEX_MODE)
+        self.pipeline = transform.build_pipeline(
+            s.TRANSFORM_STAGES,
+            geoip_database_path=s.GEOIP_DATABASE_PATH,
+            prune_fields=s.PRUNE_FIELDS,
+            cache_size=s.TRANSFORM_CACHE_SIZE,
+        )
+        self.compression = s.ELASTICSEARCH_COMPRESSION
+        self.compression_level = s.ELASTICSEARCH_COMPRESSION_LEVEL
+        self.max_events = max_events
+        self._maps = {}
+
+    def parse_range(self, path: str, start: int, end: int) -> Parsed:
+        mapped = self._maps.get(path)
+        if mapped is None:
+            with open(path, "rb") as f:
+                mapped = self._maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data = mapped[start:end]
+        # Drop the pages read from the mapping, which would otherwise count
+        # towards this process' RSS until the whole file had
+        aligned = start - start % mmap.PAGESIZE
+        mapped.madvise(mmap.MADV_DONTNEED, aligned, end - aligned)
+        return self.parse(data, start)
+
+    def parse(self, data: bytes, start: int) -> Parsed:
+        """ Parses a chunk which starts at offset `start` of its file.
+        """
+
+        events = []
+        skipped: List[str] = []
+        position = start
+        for line in data.split(b"\n"):
+            if line.strip():
+                try:
+                    events.extend(unwrap(loads(line)))
+                except ValueError as err:
+                    skipped.append(f"line at offset {position}: {err}")
+            position += len(line) + 1
+
+        bodies = []
+        for begin in range(0, len(events), self.max_events):
+            batch = self.transform(events[begin:begin + self.max_events], skipped)
+            if not batch:
+                continue
+
+            body = self.builder.build_groups(self.router.group(batch))
+            if self.compression == "gzip":
+                body = gzip_compress(body, self.compression_level)
+            bodies.append((len(batch), body))
+
+        return bodies, len(skipped), skipped[:MAX_REPORTED_LINES]
+
+    def transform(self, events: List[dict], skipped: List[str]) -> List[dict]:
+        try:
+            return self.pipeline.process(events)
+        except Exception:
+            pass
+
+        # Find the events the stages can not handle; running a stage over
+        # an event again does no harm
+        kept = []
+        for event in events:
+            try:
+                kept.extend(self.pipeline.process([event]))
+            except Exception as err:
+                skipped.append(f"event {event.get('log_id')}: {err!r}")
+
+        return kept
+
+
+# The parser of a worker process
+PARSER: Optional[ChunkParser] = None
+
+
+def init_parser(s: Settings, max_events: int):
+    global PARSER
+    PARSER = ChunkParser(s, max_events)
+
+
+def init_worker(s: Settings, max_events: int, started: Optional[Barrier] = None):
+    # A Ctrl-C in a terminal reaches the workers too; the main process
+    # decides what happens
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_parser(s, max_events)
+    if started is not None:
+        # Busy until every worker is, so each submit while starting up
+        # finds no idle worker and forks another
+        try:
+            started.wait(10)
+        except threading.BrokenBarrierError:
+            pass
+
+
+def parse_range(path: str, start: int, end: int) -> Parsed:
+    return PARSER.parse_range(path, start, end)
+
+
+def parse_bytes(data: bytes, start: int) -> Parsed:
+    return PARSER.parse(data, start)
+
+
+class FileProgress:
+    """ Which chunks of a file have been replayed. `offset` is where the
+        chunks replayed without a gap end, which is where a resumed replay
+        starts over.
+    """
+
+    path: str
+    offset: int
+    read_all: bool
+    _pending: Deque[int]
+    _done: Set[int]
+
+    def __init__(self, path: str, offset: int):
+        self.path = path
+        self.offset = offset
+        self.read_all = False
+        self._pending = collections.deque()
+        self._done = set()
+
+    @property
+    def complete(self) -> bool:
+        return self.read_all and not self._pending
+
+    def started(self, end: int):
+        self._pending.append(end)
+
+    def finished(self, end: int):
+        self._done.add(end)
+        pending = self._pending
+        while pending and pending[0] in self._done:
+            self.offset = pending.popleft()
+            self._done.discard(self.offset)
+
+
+class Checkpoint:
+    """ Records how far each file has been replayed, by its real path: the
+        offset (into the decompressed data, for gzip files) every line
+        before which has been indexed or dead-lettered, or that the whole
+        file has.
+
+        Lines after the offset may have been indexed too, and are indexed
+        again on resume. Documents are indexed by `log_id`, so that only
+        overwrites them.
+    """
+
+    path: str
+    files: Dict[str, dict]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files = self._read()
+
+    def offset(self, path: str) -> Optional[int]:
+        """ Where to resume `path` from, or None if it has been replayed.
+        """
+
+        entry = self.files.get(path, {})
+        if entry.get("complete"):
+            return None
+
+        return entry.get("offset", 0)
+
+    def update(self, progress: FileProgress):
+        self.files[progress.path] = {"offset": progress.offset, "complete": progress.complete}
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp = f"{self.path}.{os.getpid()}"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.files, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logger.warning(f"Could not write replay checkpoint {self.path}: {err}")
+
+    def _read(self) -> Dict[str, dict]:
+        if not self.path:
+            return {}
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+
+class Replay:
+    """ Bulk-indexes the events in NDJSON files, optionally gzipped, as
+        fast as the cluster takes them.
+
+        Files are cut into chunks of about `chunk_size` bytes of whole
+        lines, found in a memory map of plain files and streamed out of
+        gzip files. Chunks are parsed into bulk bodies by `ChunkParser` in
+        the `executor`'s worker processes (or on the event loop, without
+        one), and the bodies sent with the client, up to `max_in_flight`
+        at a time. Parsing runs ahead of sending by at most `max_parsing`
+        chunks.
+
+        Items rejected for retryable reasons are sent again after a
+        backoff, like the sender does, and events which fail for good or
+        run out of attempts are dead-lettered. Progress is checkpointed
+        as chunks are done (see `Checkpoint`) and logged every
+        `progress_interval` seconds.
+    """
+
+    client: client.Client
+    executor: Optional[Executor]
+    checkpoint: Checkpoint
+    dead_letter: DeadLetterSink
+    chunk_size: int
+    stopping: bool
+
+    def __init__(
+        self,
+        es_client: client.Client,
+        executor: Optional[Executor],
+        checkpoint: Checkpoint,
+        dead_letter: DeadLetterSink,
+        *,
+        chunk_size: int = 5 * 1024 * 1024,
+        max_in_flight: int = 8,
+        max_parsing: int = 2,
+        retry_max_attempts: int = 5,
+        retry_backoff_base: float = 0.5,
+        retry_backoff_max: float = 30,
+        progress_interval: float = 5,
+    ):
+        self.client = es_client
+        self.executor = executor
+        self.checkpoint = checkpoint
+        self.dead_letter = dead_letter
+        self.chunk_size = chunk_size
+        self.retry_max_attempts = retry_max_attempts
+        self.retry_backoff_base = retry_backoff_base
+        self.retry_backoff_max = retry_backoff_max
+        self.progress_interval = progress_interval
+        self.stopping = False
+        self.indexed = 0
+        self.dead_lettered = 0
+        self.skipped = 0
+        self.replayed_bytes = 0
+        self.reading: Tuple[str, float] = ("", 0.0)
+        self._bulk_slots = asyncio.Semaphore(max_in_flight)
+        # Chunks being parsed or sent
+        self._chunk_slots = asyncio.Semaphore(max_parsing + max_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+        self._saved = 0.0
+        self._began = 0.0
+
+    def stop(self):
+        """ Stops reading, so the replay ends once the chunks under way
+            are done.
+        """
+
+        self.stopping = True
+
+    async def run(self, paths: List[str]) -> bool:
+        """ Replays each file in turn. Returns whether all of them were.
+        """
+
+        self._began = time.monotonic()
+        reporter = asyncio.ensure_future(self.report())
+        try:
+            for path in paths:
+                if self.stopping:
+                    break
+                await self.replay_file(path)
+
+            await asyncio.gather(*self._tasks)
+        finally:
+            reporter.cancel()
+            self.checkpoint.save()
+            self.log_progress("Replay stopped" if self.stopping else "Replay finished")
+
+        return not self.stopping
+
+    async def replay_file(self, path: str):
+        path = os.path.realpath(path)
+        offset = self.checkpoint.offset(path)
+        if offset is None:
+            logger.info(f"Skipping {path}, it has been replayed already")
+            return
+        if offset:
+            logger.info(f"Resuming {path} from offset {offset}")
+
+        with open(path, "rb") as f:
+            gzipped = f.read(2) == GZIP_MAGIC
+
+        progress = FileProgress(path, offset)
+        chunks = self.read_gzip(path, offset) if gzipped else self.read_plain(path, offset)
+        try:
+            async for start, end, parse, args in chunks:
+                await self._chunk_slots.acquire()
+                if self.stopping:
+                    self._chunk_slots.release()
+                    return
+
+                progress.started(end)
+                task = asyncio.ensure_future(self.replay_chunk(progress, start, end, parse, args))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            await chunks.aclose()
+
+        progress.read_all = True
+        self.checkpoint.update(progress)
+
+    async def read_plain(self, path: str, offset: int) -> AsyncIterator[tuple]:
+        """ Yields chunks of a plain file as offsets into it, for the
+            workers to read from their own memory map.
+        """
+
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = offset
+                while start < size:
+                    newline = mapped.find(b"\n", min(start + self.chunk_size, size) - 1)
+                    end = size if newline < 0 else newline + 1
+                    self.reading = (path, end / size)
+                    yield start, end, parse_range, (path, start, end)
+                    start = end
+
+    async def read_gzip(self, path: str, offset: int) -> AsyncIterator[tuple]:
+        """ Yields chunks of a gzip file as their decompressed lines.
+            Decompressing happens in the thread pool.
+        """
+
+        loop = asyncio.get_event_loop()
+        size = os.path.getsize(path)
+        with gzip.open(path, "rb") as f:
+            if offset:
+                await loop.run_in_executor(None, f.seek, offset)
+
+            start = offset
+            rest = b""
+            while True:
+                data = await loop.run_in_executor(None, f.read, self.chunk_size)
+                self.reading = (path, f.fileobj.tell() / size)
+                if not data:
+                    if rest:
+                        yield start, start + len(rest), parse_bytes, (rest, start)
+                    return
+
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                if not cut:
+                    rest = data
+                    continue
+
+                rest = data[cut:]
+                yield start, start + cut, parse_bytes, (data[:cut], start)
+                start += cut
+
+    async def replay_chunk(self, progress: FileProgress, start: int, end: int, parse: Callable, args: tuple):
+        try:
+            if self.executor is None:
+                bodies, skipped, reasons = parse(*args)
+            else:
+                bodies, skipped, reasons = await asyncio.get_event_loop().run_in_executor(self.executor, parse, *args)
+
+            for reason in reasons:
+                logger.warning(f"Skipping {reason} in {progress.path}")
+            self.skipped += skipped
+
+            await asyncio.gather(*(self.index(count, body) for count, body in bodies))
+            # The chunk is only checkpointed once its dead letters are saved
+            await self.dead_letter.flush()
+        except Exception:
+            # The chunk is not checkpointed, so it is replayed on resume
+            logger.exception(f"Could not replay {progress.path} from offset {start}, stopping")
+            self.stop()
+            return
+        finally:
+            self._chunk_slots.release()
+
+        self.replayed_bytes += end - start
+        progress.finished(end)
+        self.checkpoint.update(progress)
+        now = time.monotonic()
+        if now - self._saved >= CHECKPOINT_INTERVAL:
+            self._saved = now
+            self.checkpoint.save()
+
+    async def index(self, count: int, body: bytes):
+        """ Sends a bulk body made by a `ChunkParser`, until each of its
+            events has been indexed or dead-lettered.
+        """
+
+        attempts = max(self.retry_max_attempts, 1)
+        for attempt in range(1, attempts + 1):
+            async with self._bulk_slots:
+                try:
+                    response = await self.client.bulk(body)
+                except Exception as err:
+                    response = err
+
+            items = list(range(count))
+            if isinstance(response, Exception):
+                reason = repr(response)
+                if is_retryable_error(response):
+                    retryable, failed = items, []
+                else:
+                    logger.bind(error=response).error(f"Could not index {count} events")
+                    error = {"type": type(response).__name__, "reason": str(response)}
+                    retryable, failed = [], [(item, error) for item in items]
+            else:
+                reason = "items rejected"
+                _, retryable, failed = partition_bulk_items(items, response)
+                # A document created again in a data stream conflicts with
+                # the copy already there, which is as good as indexed
+                failed = [(item, result) for item, result in failed if result.get("status") != 409]
+
+            if retryable and attempt == attempts:
+                failed += [(item, {"type": "retries_exhausted", "reason": reason}) for item in retryable]
+                retryable = []
+
+            self.indexed += count - len(retryable) - len(failed)
+            if not retryable and not failed:
+                return
+
+            lines = self.lines(body)
+            if failed:
+                self.dead_lettered += len(failed)
+                self.dead_letter.write([(self.event(lines, item), error) for item, error in failed])
+            if not retryable:
+                return
+
+            body = b"".join(lines[2 * item] + b"\n" + lines[2 * item + 1] + b"\n" for item in retryable)
+            if self.client.compression == "gzip":
+                body = await self.client.compress(body)
+            count = len(retryable)
+
+            delay = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff_base * 2 ** attempt))
+            logger.warning(f"Retrying {count} events in {delay:.2f}s (attempt {attempt}): {reason}")
+            await asyncio.sleep(delay)
+
+    def lines(self, body: bytes) -> List[bytes]:
+        """ The action and source lines of a bulk body, two per event.
+        """
+
+        if self.client.compression == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        return body.split(b"\n")
+
+    def event(self, lines: List[bytes], item: int) -> dict:
+        action = next(iter(loads(lines[2 * item]).values()))
+        return {"log_id": action["_id"], "data": loads(lines[2 * item + 1])}
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.log_progress("Replaying")
+
+    def log_progress(self, message: str):
+        elapsed = max(time.monotonic() - self._began, 1e-9)
+        path, fraction = self.reading
+        logger.bind(
+            indexed=self.indexed,
+            dead_lettered=self.dead_lettered,
+            skipped=self.skipped,
+            replayed_bytes=self.replayed_bytes,
+            events_per_s=round(self.indexed / elapsed),
+            mb_per_s=round(self.replayed_bytes / elapsed / 1e6, 1),
+            elapsed_s=round(elapsed, 1),
+        ).info(
+            f"{message}: {self.indexed} events indexed ({self.indexed / elapsed:.0f}/s, "
+            f"{self.replayed_bytes / elapsed / 1e6:.1f} MB/s), "
+            f"{self.dead_lettered} dead-lettered, {self.skipped} skipped, {path} {fraction:.1%} read"
+        )
+
+
+def main(argv: Optional[List[str]] = None):
+    """ Replays NDJSON files into Elasticsearch, with the same settings
+        as the service.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="auth0-streams-elasticsearch-replay",
+        description="Bulk-imports Auth0 log events from NDJSON files, optionally gzipped: "
+                    "Auth0 log exports, spill files, archives or dead letters.",
+    )
+    parser.add_argument("paths", nargs="+", metavar="FILE")
+    parser.add_argument(
+        "--checkpoint", default="auth0-streams-replay.checkpoint",
+        help="file recording how far each file has been replayed, to resume from (default: %(default)s)",
+    )
+    parser.add_argument("--restart", action="store_true", help="replay every file from the start")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1,
+        help="parser processes, or 0 to parse on the event loop (default: %(default)s)",
+    )
+    parser.add_argument("--in-flight", type=int, help="bulk requests in flight (default: SEND_MAX_IN_FLIGHT)")
+    parser.add_argument("--chunk-size", type=int, help="bytes of input per chunk (default: SEND_MAX_BYTES)")
+    parser.add_argument("--dead-letter", help="where to write events which fail (default: DEAD_LETTER_PATH)")
+    parser.add_argument("--progress-interval", type=float, default=5, help="seconds (default: %(default)s)")
+    args = parser.parse_args(argv)
+    for path in args.paths:
+        if not os.path.isfile(path):
+            parser.error(f"{path} is not a file")
+
+    # Nothing is received, so no token is needed
+    s = Settings.load({"BEARER_TOKEN": "", **os.environ})
+    log.configure(s)
+
+    in_flight = args.in_flight or s.SEND_MAX_IN_FLIGHT
+    options = client.service_options(s)
+    options["pool_size"] = max(options["pool_size"], in_flight)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.restart:
+        checkpoint.files.clear()
+
+    executor = None
+    if args.workers > 0:
+        context = multiprocessing.get_context("fork")
+        executor = ProcessPoolExecutor(
+            args.workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(s, s.SEND_MAX_EVENTS, context.Barrier(args.workers)),
+        )
+        # Fork the workers before the event loop and its threads exist.
+        # Python 3.9 and 3.10 fork one on each submit that finds none
+        # idle, so submit one task per worker
+        for future in [executor.submit(int) for _ in range(args.workers)]:
+            future.result()
+    else:
+        init_parser(s, s.SEND_MAX_EVENTS)
+
+    aiomisc.new_event_loop()
+    service = client.ClientService(
+        username=s.ELASTICSEARCH_USERNAME,
+        password=s.ELASTICSEARCH_PASSWORD,
+        hosts=s.ELASTICSEARCH_HOSTS,
+        index_name=s.ELASTICSEARCH_INDEX_NAME,
+        **options,
+    )
+    try:
+        with aiomisc.entrypoint(service) as loop:
+            replay = Replay(
+                loop.run_until_complete(aiomisc.get_context()["client"]),
+                executor,
+                checkpoint,
+                DeadLetterSink(args.dead_letter if args.dead_letter is not None else s.DEAD_LETTER_PATH),
+                chunk_size=args.chunk_size or s.SEND_MAX_BYTES,
+                max_in_flight=in_flight,
+                max_parsing=2 * args.workers or 1,
+                retry_max_attempts=s.RETRY_MAX_ATTEMPTS,
+                retry_backoff_base=s.RETRY_BACKOFF_BASE,
+                retry_backoff_max=s.RETRY_BACKOFF_MAX,
+                progress_interval=args.progress_interval,
+            )
+
+            signals = (signal.SIGTERM, signal.SIGINT)
+            for signum in signals:
+                loop.add_signal_handler(signum, functools.partial(interrupt, loop, signals, replay))
+
+            completed = loop.run_until_complete(replay.run(args.paths))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    sys.exit(0 if completed else 1)
+
+
+def interrupt(loop: asyncio.AbstractEventLoop, signals: Tuple[int, ...], replay: Replay):
+    """ Stops reading on the first SIGTERM or SIGINT, so the replay ends
+        once the chunks under way are sent and checkpointed. A second
+        Ctrl-C stops it there and then; the checkpoint then only lags.
+    """
+
+    for signum in signals:
+        loop.remove_signal_handler(signum)
+
+    logger.warning("Stopping once the chunks under way are replayed, interrupt again to stop now")
+    replay.stop()
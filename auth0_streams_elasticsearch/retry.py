@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import ujson
+from elasticsearch.exceptions import ConnectionError, TransportError
+from loguru import logger
+
+from .metrics import BULK_ITEM_ERRORS, DEAD_LETTERED
+
+# Bulk item statuses which mean "try again later" rather than "this
+# document is bad": 429 is es_rejected_execution_exception from a full
+# write queue, the 5xx are transient node or proxy failures.
+RETRYABLE_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def is_retryable_error(err: Exception) -> bool:
+    """ Returns whether a failed bulk request as a whole is worth retrying.
+    """
+
+    if isinstance(err, ConnectionError):
+        return True
+
+    return isinstance(err, TransportError) and err.status_code in RETRYABLE_STATUSES
+
+
+def partition_bulk_items(
+    batch: List[dict],
+    response: dict,
+) -> Tuple[List[dict], List[dict], List[Tuple[dict, dict]]]:
+    """ Splits the events of a batch by their per-item bulk result into
+        the events which were indexed, the events which failed for a
+        retryable reason, and the events which failed permanently along
+        with their item result. Bulk items are returned in the same order
+        as the request.
+    """
+
+    if not response.get("errors"):
+        return batch, [], []
+
+    succeeded = []
+    retryable = []
+    failed = []
+    for event, item in zip(batch, response["items"]):
+        # The item is keyed by the action, ie. {"index": {...}}
+        result = next(iter(item.values()))
+        error = result.get("error")
+        if error is None:
+            succeeded.append(event)
+            continue
+
+        BULK_ITEM_ERRORS.inc(error.get("type", "unknown") if isinstance(error, dict) else "unknown")
+        if result.get("status") in RETRYABLE_STATUSES:
+            retryable.append(event)
+        else:
+            failed.append((event, result))
+
+    return succeeded, retryable, failed
+
+
+class DeadLetterSink:
+    """ Receives events which could not be indexed. They are always logged,
+        and if a path is given, appended to it as NDJSON for later replay.
+        Appending happens in the thread pool, one write at a time; events
+        dead-lettered meanwhile are appended together by the next one.
+    """
+
+    path: Optional[str]
+    _pending: List[Tuple[dict, dict]]
+    _writing: Optional[asyncio.Future]
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._pending = []
+        self._writing = None
+
+    def write(self, events: List[Tuple[dict, dict]]):
+        """ Records a list of `(event, error)` pairs.
+        """
+
+        DEAD_LETTERED.inc(len(events))
+        for event, error in events:
+            logger.bind(log_id=event.get("log_id"), error=error).error("Dead-lettering event")
+
+        if not self.path:
+            return
+
+        self._pending.extend(events)
+        if self._writing is None:
+            self._writing = asyncio.ensure_future(self._append())
+
+    async def flush(self):
+        """ Waits for every event recorded so far to be appended.
+        """
+
+        if self._writing is not None:
+            await asyncio.shield(self._writing)
+
+    async def _append(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._pending:
+                events, self._pending = self._pending, []
+                try:
+                    await loop.run_in_executor(None, self._append_lines, events)
+                except OSError:
+                    logger.exception(f"Could not write {len(events)} dead-lettered events to {self.path}")
+        finally:
+            self._writing = None
+
+    def _append_lines(self, events: List[Tuple[dict, dict]]):
+        with open(self.path, "a") as f:
+            for event, error in events:
+                f.write(ujson.dumps({"event": event, "error": error}))
+                f.write("\n")
+
+
+class Retrier:
+    """ Hands events which failed to deliver for retryable reasons back to
+        `requeue` after a jittered exponential backoff. Events which
+        exhaust `max_attempts` are sent to the dead-letter sink instead.
+    """
+
+    requeue: Callable[[List[dict], Any], None]
+    dead_letter: DeadLetterSink
+    max_attempts: int
+    backoff_base: float
+    backoff_max: float
+    _attempts: Dict[str, int]
+    _waiting: Set[asyncio.Task]
+
+    def __init__(
+        self,
+        requeue: Callable[[List[dict], Any], None],
+        dead_letter: DeadLetterSink,
+        max_attempts: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+    ):
+        self.requeue = requeue
+        self.dead_letter = dead_letter
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._attempts = {}
+        self._waiting = set()
+
+    @property
+    def waiting(self) -> int:
+        """ The number of retries waiting on a backoff.
+        """
+
+        return len(self._waiting)
+
+    def delay(self, attempt: int) -> float:
+        """ Full-jitter exponential backoff for the given attempt number.
+        """
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def completed(self, batch: List[dict]):
+        """ Forgets the attempt count of events which have been delivered.
+        """
+
+        if self._attempts:
+            for event in batch:
+                self._attempts.pop(event["log_id"], None)
+
+    def retry(self, events: List[dict], reason: str, batch: Any) -> bool:
+        """ Schedules events to be passed to `requeue`, along with the
+            `batch` they came from, after a backoff. Events over the attempt
+            budget are dead-lettered. Returns whether any will be retried.
+        """
+
+        retrying = []
+        exhausted = []
+        attempt = 0
+        for event in events:
+            attempts = self._attempts.get(event["log_id"], 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(event["log_id"], None)
+                exhausted.append((event, {"type": "retries_exhausted", "reason": reason}))
+            else:
+                self._attempts[event["log_id"]] = attempts
+                retrying.append(event)
+                attempt = max(attempt, attempts)
+
+        if exhausted:
+            self.dead_letter.write(exhausted)
+
+        if not retrying:
+            return False
+
+        delay = self.delay(attempt)
+        logger.warning(f"Retrying {len(retrying)} events in {delay:.2f}s (attempt {attempt}): {reason}")
+        task = asyncio.ensure_future(self._requeue(retrying, delay, batch))
+        self._waiting.add(task)
+        task.add_done_callback(self._waiting.discard)
+        return True
+
+    def fail(self, failed: List[Tuple[dict, dict]]):
+        """ Dead-letters events which failed permanently.
+        """
+
+        for event, _ in failed:
+            self._attempts.pop(event["log_id"], None)
+
+        self.dead_letter.write(failed)
+
+    async def close(self):
+        """ Requeues everything waiting on a backoff immediately, for the
+            sender to send or spill on shutdown, and waits for dead letters
+            to be written.
+        """
+
+        for task in list(self._waiting):
+            task.cancel()
+
+        await asyncio.gather(*self._waiting, return_exceptions=True)
+        await self.dead_letter.flush()
+
+    async def _requeue(self, events: List[dict], delay: float, batch: Any):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.requeue(events, batch)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import re
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Tuple
+
+# How much of an Auth0 `date` (ie. 2020-01-01T00:00:00.000Z) an index
+# pattern depends on, from the finest strftime directive it uses.
+GRANULARITIES = (
+    (re.compile(r"%[SsfTXc]"), "%Y-%m-%dT%H:%M:%S"),
+    (re.compile(r"%[MR]"), "%Y-%m-%dT%H:%M"),
+    (re.compile(r"%[HIpkl]"), "%Y-%m-%dT%H"),
+)
+DAY_GRANULARITY = "%Y-%m-%d"
+
+INDEX_MODES = frozenset(["daily", "alias", "data_stream"])
+
+
+class IndexRouter:
+    """ Picks the index each event is written to.
+
+        In `daily` mode the index name is a strftime pattern expanded with
+        the event's own `data.date`, so late or replayed events land in the
+        index for the day they happened. Only the part of the date which
+        the pattern depends on is used as the key of an LRU cache of index
+        names, so strftime runs once per day (or hour, ...) rather than per
+        event. Events without a usable date fall back to the current time.
+
+        In `alias` and `data_stream` modes the index name is used as-is,
+        as an ILM write alias or data stream name.
+    """
+
+    pattern: str
+    mode: str
+
+    def __init__(self, pattern: str, mode: str = "daily", cache_size: int = 1024):
+        if mode not in INDEX_MODES:
+            raise ValueError(f"Unknown index mode {mode!r}, expected one of {sorted(INDEX_MODES)}")
+
+        self.pattern = pattern
+        self.mode = mode
+        self.static = mode != "daily" or "%" not in pattern
+
+        self._key_format = next(
+            (fmt for directive, fmt in GRANULARITIES if directive.search(pattern)),
+            DAY_GRANULARITY,
+        )
+        # strftime output is as long as the format with 2 characters per
+        # directive, except %Y which is 4
+        self._key_length = len(datetime(2000, 1, 1).strftime(self._key_format))
+        self._expand = functools.lru_cache(maxsize=cache_size)(self._expand_key)
+
+    def index_for(self, event: dict) -> str:
+        """ Returns the index name for an event.
+        """
+
+        if self.static:
+            return self.pattern
+
+        date = event["data"].get("date")
+        if isinstance(date, str) and len(date) >= self._key_length:
+            try:
+                return self._expand(date[:self._key_length])
+            except ValueError:
+                pass
+
+        return datetime.utcnow().strftime(self.pattern)
+
+    def group(self, events: List[dict]) -> List[Tuple[str, List[dict]]]:
+        """ Groups events by index name, in order of first appearance.
+        """
+
+        if self.static:
+            return [(self.pattern, events)]
+
+        groups = OrderedDict()
+        for event in events:
+            index = self.index_for(event)
+            try:
+                groups[index].append(event)
+            except KeyError:
+                groups[index] = [event]
+
+        return list(groups.items())
+
+    def _expand_key(self, key: str) -> str:
+        return datetime.strptime(key, self._key_format).strftime(self.pattern)
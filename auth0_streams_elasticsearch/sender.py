@@ -1,29 +1,289 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import collections
 import time
-from datetime import timedelta
-from typing import List
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
 
 import aiomisc
 from loguru import logger
 
 from .batcher import Batcher
-from .client import Client
+from .compact import expand
+from .metrics import BULK_LATENCY, REGISTRY, SINK_LATENCY, escape
+from .retry import DeadLetterSink, Retrier
 from .settings import Settings
+from .sinks import ElasticsearchSink, Payload, Sink
+from .sizing import BatchSizer
+from .spill import write_spill
+from .transform import Pipeline
+
+
+class SinkWorker:
+    """ Delivers batches to one sink. Each worker has its own backlog of
+        batches the sink has yet to get to, its own in-flight limit and
+        its own retries, so a slow or failing sink falls behind on its own
+        rather than holding up the others. A sink which has fallen behind
+        catches up by taking the batches in its backlog together, up to
+        `max_events` events per delivery. While the sink is not
+        available, nothing is delivered and batches wait in the backlog.
+
+        Failed events are retried to this sink only, and dead-lettered to
+        `dead_letter` once they run out of attempts. `on_done` is called
+        with each batch the sink has finished with, and `on_change` when
+        the worker frees up an in-flight slot.
+    """
+
+    sink: Sink
+    max_in_flight: int
+    max_events: int
+    retrier: Retrier
+    backlog: Deque[Tuple[Payload, List[dict]]]
+    backlog_events: int
+    tasks: Dict[asyncio.Task, List[Tuple[Payload, List[dict]]]]
+    _parts: Dict[Payload, int]
+    _closed: bool
+
+    def __init__(
+        self,
+        sink: Sink,
+        dead_letter: DeadLetterSink,
+        *,
+        max_in_flight: int,
+        max_events: int,
+        on_done: Callable[[Payload], None],
+        on_change: Callable[[], None],
+        observe: Optional[Callable[[float, bool], None]] = None,
+        retry_max_attempts: int = 5,
+        retry_backoff_base: float = 0.5,
+        retry_backoff_max: float = 30,
+    ):
+        self.sink = sink
+        self.max_in_flight = sink.max_in_flight or max_in_flight
+        self.max_events = max_events
+        self.retrier = Retrier(
+            self.requeue,
+            dead_letter,
+            max_attempts=retry_max_attempts,
+            backoff_base=retry_backoff_base,
+            backoff_max=retry_backoff_max,
+        )
+        self.on_done = on_done
+        self.on_change = on_change
+        self.observe = observe
+        self.latency = SINK_LATENCY.get(sink.name)
+        self.backlog = collections.deque()
+        self.backlog_events = 0
+        self.tasks = {}
+        # The number of parts of each batch not yet delivered or given up
+        # on: the batch itself, then whatever of it is being retried
+        self._parts = {}
+        self._closed = False
+        sink.watch(self.on_available)
+
+    def idle(self) -> bool:
+        """ Whether the sink could take a batch straight away.
+        """
+
+        return not self.backlog and len(self.tasks) < self.max_in_flight and self.sink.available()
+
+    def on_available(self):
+        """ Called when the sink may have become available, or stopped
+            being.
+        """
+
+        self.pump()
+        self.on_change()
+
+    def offer(self, payload: Payload):
+        """ Adds a batch to the end of the backlog.
+        """
+
+        self._parts[payload] = 1
+        self.backlog.append((payload, payload.events))
+        self.backlog_events += len(payload.events)
+        self.pump()
+
+    def requeue(self, events: List[dict], payload: Payload):
+        """ Puts events back at the front of the backlog once their retry
+            backoff is over.
+        """
+
+        self.backlog.appendleft((payload, events))
+        self.backlog_events += len(events)
+        self.pump()
+
+    def pump(self):
+        """ Starts deliveries from the backlog while there are in-flight
+            slots free.
+        """
+
+        loop = asyncio.get_event_loop()
+        backlog = self.backlog
+        available = self.sink.available()
+        while backlog and len(self.tasks) < self.max_in_flight and available and not self._closed:
+            parts = [backlog.popleft()]
+            count = len(parts[0][1])
+            while backlog and count + len(backlog[0][1]) <= self.max_events:
+                parts.append(backlog.popleft())
+                count += len(parts[-1][1])
+
+            self.backlog_events -= count
+            task = loop.create_task(self.send(parts))
+            task.add_done_callback(self.on_send_done)
+            self.tasks[task] = parts
+
+    async def send(self, parts: List[Tuple[Payload, List[dict]]]) -> dict:
+        """ Delivers one or more parts of batches, each either a whole
+            batch or the events of one being retried, and sorts out what
+            becomes of each event.
+        """
+
+        events = parts[0][1] if len(parts) == 1 else [event for _, part in parts for event in part]
+        began = time.monotonic()
+        try:
+            succeeded, retryable, failed = await self.sink.deliver(await self.prepare(parts, events))
+            reason = f"{len(retryable)} items rejected by {self.sink.name}"
+        except Exception as err:
+            if not self.sink.is_retryable(err):
+                logger.bind(error=err).error(f"Could not deliver {len(events)} events to {self.sink.name}")
+                succeeded, retryable, failed = [], [], [
+                    (event, {"type": type(err).__name__, "reason": str(err)}) for event in events
+                ]
+            else:
+                succeeded, retryable, failed = [], events, []
+            reason = repr(err)
+
+        latency = time.monotonic() - began
+        self.latency.observe(latency)
+        if self.observe is not None:
+            self.observe(latency, bool(retryable))
+
+        # Only the events which failed for retryable reasons are sent again,
+        # the rest are either delivered or dead-lettered.
+        self.retrier.completed(succeeded)
+        if failed:
+            self.retrier.fail(failed)
+        if retryable:
+            for payload, retrying in self.by_batch(parts, retryable):
+                if self.retrier.retry(retrying, reason, payload):
+                    self._parts[payload] += 1
+
+        for payload, _ in parts:
+            self._finish_part(payload)
+
+        return {"succeeded": len(succeeded), "retrying": len(retryable), "failed": len(failed)}
+
+    async def prepare(self, parts: List[Tuple[Payload, List[dict]]], events: List[dict]):
+        """ Prepares the parts for the sink, sharing what other sinks
+            prepared for whole batches where possible.
+        """
+
+        if len(parts) == 1:
+            payload, part = parts[0]
+            if part is payload.events:
+                return await payload.prepare(self.sink)
+            return await self.sink.prepare(part)
+
+        if self.sink.combinable:
+            return self.sink.combine([await self.prepare([part], part[1]) for part in parts])
+
+        for payload, part in parts:
+            if part is payload.events:
+                payload.skip()
+        return await self.sink.prepare(events)
+
+    @staticmethod
+    def by_batch(
+        parts: List[Tuple[Payload, List[dict]]],
+        events: List[dict],
+    ) -> List[Tuple[Payload, List[dict]]]:
+        """ Splits events from a delivery by the batch they are part of.
+        """
+
+        if len(parts) == 1:
+            return [(parts[0][0], events)]
+
+        owners = {id(event): number for number, (_, part) in enumerate(parts) for event in part}
+        split = {}
+        for event in events:
+            split.setdefault(owners[id(event)], []).append(event)
+
+        return [(parts[number][0], part) for number, part in split.items()]
+
+    def on_send_done(self, task: asyncio.Task):
+        """ Reaps a finished send task and logs its result.
+        """
+
+        self.tasks.pop(task, None)
+        self.pump()
+        self.on_change()
+
+        task_log = logger.bind(task=task, sink=self.sink.name)
+        if task.cancelled():
+            task_log.warning("Cancelled before completion")
+            return
+
+        err = task.exception()
+        if err is not None:
+            task_log.bind(error=err).error("Completed unsuccessfully with errors")
+        else:
+            task_log.bind(result=task.result()).debug("Completed successfully")
+
+    async def close(self):
+        """ Stops starting deliveries, and moves retries waiting on their
+            backoff into the backlog.
+        """
+
+        self._closed = True
+        await self.retrier.close()
+
+    def _finish_part(self, payload: Payload):
+        parts = self._parts[payload] - 1
+        if parts:
+            self._parts[payload] = parts
+            return
+
+        del self._parts[payload]
+        self.on_done(payload)
 
 
 class SenderService(aiomisc.Service):
+    """ Takes batches from the batcher and delivers each to every sink.
+        Batches are taken at the pace of the primary (first) sink: when
+        it has an in-flight slot free and nothing waiting, and no other
+        sink is `sink_max_backlog` events behind.
+
+        If the receiver queues compact events (see `ReceiverService`), the
+        sender is given the `pipeline` to run on each batch it takes.
+    """
 
     send_after_events: int
-    send_after_time: int
-    send_loop_wait: float = 0.1
-    tasks: List[asyncio.Task] = []
-    _stop: asyncio.Event = asyncio.Event()
+    send_max_events: int = 5000
+    send_max_bytes: Optional[int] = None
+    send_target_latency: float = 1
+    send_max_in_flight: int = 8
+    sink_max_backlog: int = 50000
+    retry_max_attempts: int = 5
+    retry_backoff_base: float = 0.5
+    retry_backoff_max: float = 30
+    dead_letter_path: Optional[str] = None
+    drain_timeout: float = 30
+    spill_path: Optional[str] = None
+    sinks: Sequence[Sink] = ()
+    pipeline: Optional[Pipeline] = None
+    batcher: Optional[Batcher] = None
+    workers: List[SinkWorker]
+    payloads: Dict[Payload, None]
+    sizer: BatchSizer
+    _room: asyncio.Event
+    _stop: Optional[asyncio.Event] = None
+    _stopped: asyncio.Event
+    _deadline: Optional[float] = None
+    _draining: bool = False
 
     __required__ = frozenset([
         "send_after_events",
-        "send_after_time",
     ])
 
     async def start(self):
@@ -32,119 +292,284 @@ class SenderService(aiomisc.Service):
 
         logger.info("Sender started!")
 
-        batcher: Batcher = await self.context["batcher"]
-        begin = None
-        while not self._stop.is_set():
-            # During this loop, we need to keep track of time.
-            # Each iteration, we will need to do a few things:
-            # - If the timer is None and the batcher has items, start the timer.
-            # - Check if there's a current batch that's larger than `self.send_after_events`
-            #   - If greater, get the batch, send, and update begin time.
-            # - Check if the current time is greater than `begin + self.send_after_time`
-            #   - If greater, get a batch > 0 from the batcher, send, and update begin time.
-            # - Poll the results of all pending send tasks.
-            # - Sleep for a short amount of time and continue.
-            events = None
-            if not (await batcher.is_empty()):
-                # Non-empty batcher triggers the timer
-                if begin is None:
-                    begin = time.monotonic()
-                    await asyncio.sleep(self.send_loop_wait)
-                    continue
-
-                if (items := await batcher.remaining()) > self.send_after_events:
-                    logger.debug(f"Fetching batch due to {items} queue > {self.send_after_events} threshold")
-                    events = await batcher.get_batch(self.send_after_events)
-                elif (now := time.monotonic()) > (begin + self.send_after_time):
-                    logger.debug(f"Fetching batch due to time trigger ({now} > {begin} + {self.send_after_time})")
-                    events = await batcher.get_batch(self.send_after_events)
-                else:
-                    logger.debug("Wait for threshold")
-                    await asyncio.sleep(self.send_loop_wait)
-                    continue
-
-                # Ship the events and restart the timer
-                begin = None
-                logger.debug(f"Starting task to ship {len(events)} events")
-                self.tasks.append(self.loop.create_task(self.send(events)))
-
-            await self.poll_sending_tasks()
-            await asyncio.sleep(self.send_loop_wait)
-
-        self._stop.clear()
+        # Batches not every sink has finished with, in the order taken
+        self.payloads = {}
+        self.workers = []
+        self._stop = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._room = asyncio.Event()
+        try:
+            await self._run()
+        finally:
+            self._stopped.set()
+
         logger.debug("Sender loop closing")
 
-    async def stop(self):
-        """ Stops the main loop of the sending service and waits for all
-            pending tasks to complete.
-        """
+    async def _run(self):
+        batcher = self.batcher = await self.context["batcher"]
+        self.sizer = BatchSizer(
+            min_events=self.send_after_events,
+            max_events=self.send_max_events,
+            target_latency=self.send_target_latency,
+            latency=BULK_LATENCY,
+        )
+
+        sinks = list(self.sinks) or [ElasticsearchSink("elasticsearch")]
+        for number, sink in enumerate(sinks):
+            await sink.start(self.context)
+            # The primary sink's dead letters go to `dead_letter_path`, and
+            # the others' next to it, suffixed with the sink name
+            dead_letter_path = self.dead_letter_path
+            if dead_letter_path and number:
+                dead_letter_path = f"{dead_letter_path}.{sink.name}"
+
+            self.workers.append(SinkWorker(
+                sink,
+                DeadLetterSink(dead_letter_path),
+                max_in_flight=self.send_max_in_flight,
+                max_events=self.send_max_events,
+                on_done=self.on_done,
+                on_change=self._room.set,
+                # The primary sink's latency and rejections size the batches
+                observe=None if number else self.sizer.observe,
+                retry_max_attempts=self.retry_max_attempts,
+                retry_backoff_base=self.retry_backoff_base,
+                retry_backoff_max=self.retry_backoff_max,
+            ))
+
+        REGISTRY.value(
+            "auth0_bulk_size_target_events", "gauge",
+            "Number of events the next bulk request is sized for.",
+            lambda: self.sizer.size,
+        )
+        REGISTRY.value(
+            "auth0_bulk_size_target_latency_seconds", "gauge",
+            "Bulk request latency the batch size is adjusted towards.",
+            lambda: self.sizer.target_latency,
+        )
+        REGISTRY.value(
+            "auth0_bulk_size_last_latency_seconds", "gauge",
+            "Latency of the bulk request the batch size was last adjusted after.",
+            lambda: self.sizer.last_latency,
+        )
+        REGISTRY.register(
+            "auth0_bulk_size_cuts_total", "counter",
+            "Times the batch size was cut, by whether items were rejected or latency was over target.",
+            self.sizer.cuts.samples,
+        )
+        REGISTRY.value(
+            "auth0_bulk_requests_in_flight", "gauge",
+            "Bulk requests currently in flight.",
+            lambda: sum(len(worker.tasks) for worker in self.workers),
+        )
+        REGISTRY.register(
+            "auth0_sink_backlog_events", "gauge",
+            "Events waiting for each sink to deliver them.",
+            lambda: [
+                ("", f'{{sink="{escape(worker.sink.name)}"}}', worker.backlog_events)
+                for worker in self.workers
+            ],
+        )
+
+        # The loop below runs until `stop`; let the entrypoint finish starting.
+        self.start_event.set()
 
-        self._stop.set()
+        while not self._stop.is_set():
+            # Wait for the primary sink to be able to take a batch. Until
+            # then, events stay in the batcher, whose bounded queue pushes
+            # back on the receiver.
+            await self._wait_for_room()
+
+            # The batcher sets its ready signal once `send_after_events` events
+            # are queued or `send_after_time` has passed since the first
+            # pending event arrived. Sleep until one of those happens.
+            await batcher.wait_ready()
+            if self._stop.is_set():
+                break
+
+            # Batches are cut at the adaptive size, or at the byte budget
+            # if that comes first. Under load events keep accumulating
+            # while bulk requests are in flight, so batches grow to it.
+            # When draining, the queue is emptied in the largest batches.
+            size = self.send_max_events if self._draining else self.sizer.size
+            events = batcher.get_batch(size, self.send_max_bytes)
+            if not events:
+                continue
 
-        # Once the sending loop stops, we'll handle polling the tasks to completion.
-        await self._stop.wait()
+            # In place, as the batch is acknowledged by identity
+            expand(events)
+            if self.pipeline is not None:
+                # Every stage is idempotent, so events which were spilled
+                # after being transformed can go through it again
+                await self.pipeline.run(events)
+
+            logger.debug(f"Shipping {len(events)} events to {len(self.workers)} sinks")
+            payload = Payload(events, len(self.workers))
+            self.payloads[payload] = None
+            for worker in self.workers:
+                worker.offer(payload)
+
+    def on_done(self, payload: Payload):
+        """ Called by each worker once its sink is finished with a batch.
+            The batch is acknowledged to the batcher when every sink is.
+        """
 
-        while self.tasks:
-            logger.info(f"Waiting for pending tasks to complete.. ({len(self.tasks)} remaining)")
-            await self.poll_sending_tasks()
-            await asyncio.sleep(1)
+        payload.pending -= 1
+        if not payload.pending:
+            del self.payloads[payload]
+            self.batcher.ack(payload.events)
 
-    async def poll_sending_tasks(self):
-        """ Poll all tasks attached to this sender instance and update
-            the list of tasks as they are finished.
+    def reconfigure(self, s: Settings):
+        """ Applies reloaded batch size, concurrency, backlog and retry
+            settings. Raising the in-flight limit takes effect straight
+            away, and lowering it as soon as enough deliveries have finished.
         """
 
-        next_tasks = []
-        for task in self.tasks:
-            task_log = logger.bind(task=task)
-            try:
-                result = task.result()
-                task_log.bind(result=result).debug(f"Completed successfully")
-            except asyncio.InvalidStateError:
-                task_log.debug("Still running")
-                next_tasks.append(task)
-            except Exception as err:
-                task_log.bind(error=err).error(f"Completed unsuccessfully with errors")
-
-        self.tasks = next_tasks
+        self.send_after_events = s.SEND_AFTER_EVENTS
+        self.send_max_events = s.SEND_MAX_EVENTS
+        self.send_max_bytes = s.SEND_MAX_BYTES
+        self.send_target_latency = s.SEND_TARGET_LATENCY
+        self.send_max_in_flight = s.SEND_MAX_IN_FLIGHT
+        self.sink_max_backlog = s.SINK_MAX_BACKLOG
+        self.retry_max_attempts = s.RETRY_MAX_ATTEMPTS
+        self.retry_backoff_base = s.RETRY_BACKOFF_BASE
+        self.retry_backoff_max = s.RETRY_BACKOFF_MAX
+        self.drain_timeout = s.DRAIN_TIMEOUT
+
+        self.sizer.reconfigure(self.send_after_events, self.send_max_events, self.send_target_latency)
+        for worker in self.workers:
+            worker.max_in_flight = worker.sink.max_in_flight or self.send_max_in_flight
+            worker.max_events = self.send_max_events
+            worker.retrier.max_attempts = self.retry_max_attempts
+            worker.retrier.backoff_base = self.retry_backoff_base
+            worker.retrier.backoff_max = self.retry_backoff_max
+            worker.pump()
+
+        self._room.set()
+
+    async def drain(self, timeout: Optional[float] = None):
+        """ Sends everything still queued, at full concurrency and in the
+            largest batches, then stops the main loop. Whatever could not
+            be sent within `timeout` seconds (`drain_timeout` by default),
+            including deliveries still in flight, is spilled.
+        """
 
-    async def send(self, batch: List[dict]) -> dict:
-        """ Given a batch of events, bulk-submits them to Elasticsearch
-            via the client.
+        timeout = self.drain_timeout if timeout is None else timeout
+        batcher: Batcher = await self.context["batcher"]
+        logger.info(f"Draining {batcher.remaining()} queued events (up to {timeout}s)")
+
+        self._draining = True
+        batcher.drain()
+
+        deadline = self._deadline = self.loop.time() + timeout
+        while not batcher.is_empty() or self.payloads:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+
+            tasks = [task for worker in self.workers for task in worker.tasks]
+            if tasks:
+                await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                # The main loop is about to take a batch, or a retry is
+                # waiting on its backoff.
+                await asyncio.sleep(min(remaining, 0.01))
+
+        await self._stop_loop(deadline)
+        await self._finish_deliveries(deadline)
+        await self.close(batcher)
+
+    async def stop(self, exception: Exception = None):
+        """ Stops the main loop of the sending service, gives deliveries
+            in flight until the drain deadline to finish (`drain_timeout`
+            from now, if no drain was started), and spills everything
+            unsent.
         """
 
-        client = await self.context["client"]
+        if self._stop is None:
+            # `start` never ran
+            return
+
+        if self._deadline is None:
+            self._deadline = self.loop.time() + self.drain_timeout
+
+        await self._stop_loop(self._deadline)
+        if self.batcher is not None:
+            await self._finish_deliveries(self._deadline)
+            await self.close(self.batcher)
 
-        # This is the bulk API response from Elasticsearch
-        response = await client.send(batch)
+    async def _stop_loop(self, deadline: float):
+        """ Stops the main loop and waits for it to hand over the batch it
+            is taking, until `deadline`. Once woken it stops within a tick
+            or a pipeline run, so it gets a second even past the deadline.
+        """
 
-        # Check for errors
-        if response["errors"]:
-            raise BulkSendingError(response)
+        self._stop.set()
+        self._room.set()
+        if self.batcher is not None:
+            self.batcher.wake()
+
+        try:
+            await asyncio.wait_for(self._stopped.wait(), max(1.0, deadline - self.loop.time()))
+        except asyncio.TimeoutError:
+            logger.warning("Sender loop did not stop in time")
+
+    async def _finish_deliveries(self, deadline: float):
+        """ Stops the workers starting deliveries, waits for those in
+            flight until `deadline`, and cancels the rest. Batches some
+            sink has not finished with stay in `payloads` to be spilled;
+            resending them later is harmless, as `_id` is the log_id.
+        """
 
-        return response
+        for worker in self.workers:
+            await worker.close()
 
+        tasks = [task for worker in self.workers for task in worker.tasks]
+        remaining = deadline - self.loop.time()
+        if tasks and remaining > 0:
+            logger.info(f"Waiting for {len(tasks)} deliveries in flight (up to {remaining:.1f}s)")
+            _, tasks = await asyncio.wait(tasks, timeout=remaining)
 
-class BulkSendingError(Exception):
-    """ Raised when Elasticsearch returns an error or errors 
-        for a bulk insertion
-    """
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.warning(f"Abandoning {len(tasks)} deliveries in flight")
+            await asyncio.wait(tasks)
 
-    def __init__(self, response: dict):
-        self.errors = response["items"]
+    async def close(self, batcher: Batcher):
+        """ Closes the workers, and spills every batch some sink has not
+            finished with, along with anything left in the batcher.
+        """
 
-    def __repr__(self):
-        description = ""
-        for item in self.errors:
-            item_id = item["index"]["_id"]
-            index = item["index"]
-            if not index.get("error"):
-                continue
+        for worker in self.workers:
+            await worker.close()
 
-            error_type = index["error"]["type"]
-            error_reason = index["error"]["reason"]
-            description += f"\tError processing bulk item {item_id}: {error_type}\n\t\t{error_reason}\n\n"
+        # A spilled batch goes to every sink again when it is read back.
+        # Elasticsearch indexes it under the same `_id`s as before.
+        unsent = [event for payload in self.payloads for event in payload.events]
+        self.payloads.clear()
+        unsent.extend(batcher.get_batch(batcher.remaining()))
+        self.spill(batcher, unsent)
 
-        return description
+    def spill(self, batcher: Batcher, events: List[dict]):
+        """ Saves events which were not sent before shutdown for the next
+            start. With a spool they are in it already, unacknowledged.
+        """
 
-    __str__ = __repr__
\ No newline at end of file
+        if not events:
+            return
+
+        if batcher.spool is not None:
+            logger.info(f"Leaving {len(events)} unsent events in the spool")
+        elif self.spill_path:
+            write_spill(self.spill_path, events)
+        else:
+            logger.error(f"Dropping {len(events)} unsent events, no spill path is configured")
+
+    async def _wait_for_room(self):
+        primary, *others = self.workers
+        while not self._stop.is_set() and not (
+            primary.idle() and all(worker.backlog_events < self.sink_max_backlog for worker in others)
+        ):
+            self._room.clear()
+            await self._room.wait()
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import os
-from typing import Any, Optional
+from dataclasses import dataclass, fields, replace
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set
 
-import aiomisc
+from loguru import logger
 
 
 def strbool(s: str) -> bool:
@@ -16,64 +17,265 @@ def strbool(s: str) -> bool:
         raise ValueError(f"{s} can not be converted to boolean")
 
 
+def strlist(s: str) -> List[str]:
+    return [item.strip() for item in s.split(",") if item.strip()]
+
+
+@dataclass(frozen=True)
 class Settings:
-    """ Settings contains all setting defaults.
-        When an attribute is accessed on an instance of Settings,
-        values from `os.environ` will be returned first, if they exist.
+    """ Settings is an immutable snapshot of every setting, resolved and
+        converted to its type once by `Settings.load`. Values come from
+        the `KEY=value` lines of `SETTINGS_FILE`, if one is given, then
+        from `os.environ`, then from `defaults`.
+
+        `reload` resolves a new snapshot, keeping the old value of any
+        setting which can only change with a restart, ie. anything not in
+        `hot`.
     """
 
+    ARCHIVE_COMPRESSION: str
+    ARCHIVE_PATH: str
+    BEARER_TOKEN: str
+    BIND_ADDRESS: str
+    BIND_PORT: int
+    DEAD_LETTER_PATH: str
+    DEDUP_FALSE_POSITIVE_RATE: float
+    DEDUP_MAX_SIZE: int
+    DEDUP_MODE: str
+    DEDUP_WINDOW: float
+    DRAIN_SPILL_PATH: str
+    DRAIN_TIMEOUT: float
+    ELASTICSEARCH_CIRCUIT_FAILURES: int
+    ELASTICSEARCH_CIRCUIT_OPEN_TIME: float
+    ELASTICSEARCH_COMPRESSION: str
+    ELASTICSEARCH_COMPRESSION_LEVEL: int
+    ELASTICSEARCH_COMPRESSION_OFFLOAD_SIZE: int
+    ELASTICSEARCH_HOSTS: str
+    ELASTICSEARCH_INDEX_MODE: str
+    ELASTICSEARCH_INDEX_NAME: str
+    ELASTICSEARCH_KEEPALIVE_TIMEOUT: float
+    ELASTICSEARCH_PASSWORD: str
+    ELASTICSEARCH_POOL_SIZE: int
+    ELASTICSEARCH_POOL_SIZE_PER_HOST: int
+    ELASTICSEARCH_PRECREATE_DAYS: int
+    ELASTICSEARCH_SNIFF_INTERVAL: float
+    ELASTICSEARCH_SSL_VERIFY: bool
+    ELASTICSEARCH_TEMPLATE_CACHE_PATH: str
+    ELASTICSEARCH_TEMPLATE_NAME: str
+    ELASTICSEARCH_TEMPLATE_REFRESH_INTERVAL: str
+    ELASTICSEARCH_TEMPLATE_REPLICAS: int
+    ELASTICSEARCH_TEMPLATE_SHARDS: int
+    ELASTICSEARCH_USERNAME: str
+    GEOIP_DATABASE_PATH: str
+    LOG_BACKGROUND: bool
+    LOG_FLUSH_INTERVAL: float
+    LOG_LEVEL: str
+    LOG_SAMPLE_RATE: float
+    LOOP_LAG_INTERVAL: float
+    MAX_BODY_SIZE: int
+    PARSE_OFFLOAD_SIZE: int
+    PRUNE_FIELDS: List[str]
+    QUEUE_COMPACT: bool
+    QUEUE_FULL_RETRY_AFTER: int
+    QUEUE_INSERT_TIMEOUT: float
+    QUEUE_MAX_BYTES: int
+    QUEUE_MAX_SIZE: int
+    RECEIVER_COALESCE_EVENTS: int
+    RETRY_BACKOFF_BASE: float
+    RETRY_BACKOFF_MAX: float
+    RETRY_MAX_ATTEMPTS: int
+    SEND_AFTER_EVENTS: int
+    SEND_AFTER_TIME: float
+    SEND_MAX_BYTES: int
+    SEND_MAX_EVENTS: int
+    SEND_MAX_IN_FLIGHT: int
+    SEND_TARGET_LATENCY: float
+    SECONDARY_ELASTICSEARCH_HOSTS: str
+    SECONDARY_ELASTICSEARCH_INDEX_NAME: str
+    SECONDARY_ELASTICSEARCH_PASSWORD: str
+    SECONDARY_ELASTICSEARCH_USERNAME: str
+    SETTINGS_FILE: str
+    SINK_MAX_BACKLOG: int
+    SINKS: List[str]
+    SPOOL_DIRECTORY: str
+    SPOOL_SEGMENT_SIZE: int
+    TRANSFORM_CACHE_SIZE: int
+    TRANSFORM_OFFLOAD: bool
+    TRANSFORM_STAGES: List[str]
+    WORKERS: int
+
+    __slots__ = tuple(__annotations__)
+
     defaults = {
+        "ARCHIVE_COMPRESSION": "gzip",
+        "ARCHIVE_PATH": "auth0-events-%Y-%m-%d.ndjson.gz",
         "BEARER_TOKEN": None,
         "BIND_ADDRESS": "0.0.0.0",
         "BIND_PORT": "3000",
+        "DEAD_LETTER_PATH": "",
+        "DEDUP_FALSE_POSITIVE_RATE": "0.001",
+        "DEDUP_MAX_SIZE": "1000000",
+        "DEDUP_MODE": "exact",
+        "DEDUP_WINDOW": "3600",
+        "DRAIN_SPILL_PATH": "auth0-streams-spill.ndjson",
+        "DRAIN_TIMEOUT": "30",
+        "ELASTICSEARCH_CIRCUIT_FAILURES": "3",
+        "ELASTICSEARCH_CIRCUIT_OPEN_TIME": "5",
+        "ELASTICSEARCH_COMPRESSION": "none",
+        "ELASTICSEARCH_COMPRESSION_LEVEL": "3",
+        "ELASTICSEARCH_COMPRESSION_OFFLOAD_SIZE": "262144",
+        "ELASTICSEARCH_HOSTS": "http://localhost:9200",
+        "ELASTICSEARCH_INDEX_MODE": "daily",
         "ELASTICSEARCH_INDEX_NAME": "auth0-events-%Y.%m.%d",
+        "ELASTICSEARCH_KEEPALIVE_TIMEOUT": "30",
         "ELASTICSEARCH_PASSWORD": "",
+        "ELASTICSEARCH_POOL_SIZE": "10",
+        "ELASTICSEARCH_POOL_SIZE_PER_HOST": "0",
+        "ELASTICSEARCH_PRECREATE_DAYS": "1",
+        "ELASTICSEARCH_SNIFF_INTERVAL": "0",
         "ELASTICSEARCH_SSL_VERIFY": "true",
-        "ELASTICSEARCH_URL": "http://localhost:9200",
+        "ELASTICSEARCH_TEMPLATE_CACHE_PATH": "",
+        "ELASTICSEARCH_TEMPLATE_NAME": "",
+        "ELASTICSEARCH_TEMPLATE_REFRESH_INTERVAL": "30s",
+        "ELASTICSEARCH_TEMPLATE_REPLICAS": "1",
+        "ELASTICSEARCH_TEMPLATE_SHARDS": "1",
         "ELASTICSEARCH_USERNAME": "",
+        "GEOIP_DATABASE_PATH": "",
+        "LOG_BACKGROUND": "true",
+        "LOG_FLUSH_INTERVAL": "0.1",
         "LOG_LEVEL": "INFO",
-        "QUEUE_MAX_SIZE": "50",
+        "LOG_SAMPLE_RATE": "1",
+        "LOOP_LAG_INTERVAL": "0.5",
+        "MAX_BODY_SIZE": "33554432",
+        "PARSE_OFFLOAD_SIZE": "4194304",
+        "PRUNE_FIELDS": "",
+        "QUEUE_COMPACT": "false",
+        "QUEUE_FULL_RETRY_AFTER": "10",
+        "QUEUE_INSERT_TIMEOUT": "5",
+        "QUEUE_MAX_BYTES": "0",
+        "QUEUE_MAX_SIZE": "10000",
+        "RECEIVER_COALESCE_EVENTS": "1000",
+        "RETRY_BACKOFF_BASE": "0.5",
+        "RETRY_BACKOFF_MAX": "30",
+        "RETRY_MAX_ATTEMPTS": "5",
         "SEND_AFTER_EVENTS": "10",
         "SEND_AFTER_TIME": "5",
+        "SEND_MAX_BYTES": "5242880",
+        "SEND_MAX_EVENTS": "5000",
+        "SEND_MAX_IN_FLIGHT": "8",
+        "SEND_TARGET_LATENCY": "1",
+        "SECONDARY_ELASTICSEARCH_HOSTS": "",
+        "SECONDARY_ELASTICSEARCH_INDEX_NAME": "",
+        "SECONDARY_ELASTICSEARCH_PASSWORD": "",
+        "SECONDARY_ELASTICSEARCH_USERNAME": "",
+        "SETTINGS_FILE": "",
+        "SINK_MAX_BACKLOG": "50000",
+        "SINKS": "elasticsearch",
+        "SPOOL_DIRECTORY": "",
+        "SPOOL_SEGMENT_SIZE": "67108864",
+        "TRANSFORM_CACHE_SIZE": "4096",
+        "TRANSFORM_OFFLOAD": "false",
+        "TRANSFORM_STAGES": "log_type",
+        "WORKERS": "1",
     }
 
-    converters = {
-        "BIND_PORT": int,
-        "ELASTICSEARCH_SSL_VERIFY": strbool,
-        "QUEUE_MAX_SIZE": int,
-        "QUEUE_MAX_TIME": int,
-        "SEND_AFTER_EVENTS": int,
-        "SEND_AFTER_TIME": int,
-    }
+    # Settings which take effect on reload, without a restart
+    hot = frozenset([
+        "DRAIN_TIMEOUT",
+        "QUEUE_FULL_RETRY_AFTER",
+        "QUEUE_INSERT_TIMEOUT",
+        "QUEUE_MAX_BYTES",
+        "QUEUE_MAX_SIZE",
+        "RECEIVER_COALESCE_EVENTS",
+        "RETRY_BACKOFF_BASE",
+        "RETRY_BACKOFF_MAX",
+        "RETRY_MAX_ATTEMPTS",
+        "SEND_AFTER_EVENTS",
+        "SEND_AFTER_TIME",
+        "SEND_MAX_BYTES",
+        "SEND_MAX_EVENTS",
+        "SEND_MAX_IN_FLIGHT",
+        "SEND_TARGET_LATENCY",
+        "SINK_MAX_BACKLOG",
+    ])
 
-    def __init__(self):
-        # Check for required setting values at initialization
-        for setting in Settings.defaults.keys():
-            self.__getattr__(setting)
+    @classmethod
+    def load(cls, environ: Optional[Mapping[str, str]] = None) -> "Settings":
+        """ Resolves and converts every setting, raising `SettingUnset`
+            or `WrongSettingType` for the first one which is missing or
+            invalid.
+        """
+
+        values = dict(os.environ if environ is None else environ)
+        if "ELASTICSEARCH_HOSTS" not in values and "ELASTICSEARCH_URL" in values:
+            # The name this setting was documented under before
+            values["ELASTICSEARCH_HOSTS"] = values["ELASTICSEARCH_URL"]
+
+        settings_file = values.get("SETTINGS_FILE") or cls.defaults["SETTINGS_FILE"]
+        if settings_file:
+            values.update(read_settings_file(settings_file))
 
-    def __getattr__(self, name) -> Any:
-        value = self.get_value(name)
-        if value is None:
-            # This is a setting that we can not set a sane default for.
-            # When a value is none, we should raise
-            raise SettingUnset(name)
+        resolved = {}
+        for field in fields(cls):
+            value = values.get(field.name, cls.defaults[field.name])
+            if value is None:
+                # This is a setting that we can not set a sane default for.
+                # When a value is none, we should raise
+                raise SettingUnset(field.name)
 
-        if (converter := Settings.converters.get(name)) is not None:
             try:
-                return converter(value)
+                resolved[field.name] = CONVERTERS.get(field.type, field.type)(value)
             except Exception as err:
-                raise WrongSettingType(name) from err
+                raise WrongSettingType(field.name) from err
 
-        return value
+        return cls(**resolved)
 
-    def get_value(self, name) -> Any:
-        """ Returns the setting value for `name`.
+    def reload(self, environ: Optional[Mapping[str, str]] = None) -> "Settings":
+        """ Loads a new snapshot. Changes to settings which need a restart
+            are logged and left out of it.
         """
 
-        try:
-            return os.environ[name]
-        except KeyError:
-            return Settings.defaults[name]
+        settings = Settings.load(environ)
+        cold = {name: getattr(self, name) for name in self.changes(settings) - self.hot}
+        if cold:
+            logger.warning(f"Ignoring changes to {', '.join(sorted(cold))} until restarted")
+            settings = replace(settings, **cold)
+
+        return settings
+
+    def changes(self, other: "Settings") -> Set[str]:
+        """ The names of the settings whose values differ in `other`.
+        """
+
+        return {
+            field.name for field in fields(self)
+            if getattr(self, field.name) != getattr(other, field.name)
+        }
+
+
+def read_settings_file(path: str) -> Dict[str, str]:
+    """ Reads `KEY=value` lines, skipping blank lines and `#` comments.
+    """
+
+    values = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            name, sep, value = line.partition("=")
+            if not sep:
+                raise ValueError(f"{path}:{number}: expected KEY=value")
+            values[name.strip()] = value.strip()
+
+    return values
+
+
+CONVERTERS: Dict[Any, Callable[[str], Any]] = {
+    bool: strbool,
+    List[str]: strlist,
+}
 
 
 class SettingUnset(Exception):
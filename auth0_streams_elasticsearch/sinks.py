@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+import abc
+import asyncio
+import os
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import aiomisc
+
+from .bulk import COMPRESSIONS, dumps, gzip_compress
+from .client import Client
+from .metrics import BULK_ERRORS
+from .retry import is_retryable_error, partition_bulk_items
+from .routing import IndexRouter
+
+# The outcome of a delivery: the events which were delivered, the events
+# which failed for a retryable reason, and the events which failed for
+# good along with their error
+Outcome = Tuple[List[dict], List[dict], List[Tuple[dict, dict]]]
+
+
+class Sink(abc.ABC):
+    """ Somewhere batches of events are delivered to. Delivering is split
+        in two: `prepare` serializes a batch, and `deliver` sends what
+        `prepare` made. Sinks with the same `key` serialize a batch to the
+        same bytes, so a batch going to several of them is only prepared
+        once (see `Payload`).
+
+        A sink which has fallen behind is sent several batches at once. If
+        it is `combinable`, `combine` joins what `prepare` made for each of
+        them, otherwise they are prepared again together.
+
+        `max_in_flight` is the most deliveries the sender will have under
+        way to the sink at once, or None for `SEND_MAX_IN_FLIGHT`. While a
+        sink is not `available`, the sender holds its deliveries back.
+    """
+
+    name: str
+    key: Hashable
+    combinable: bool = False
+    max_in_flight: Optional[int] = None
+
+    async def start(self, context: aiomisc.Context):
+        """ Called by the sender when it starts, to look up anything the
+            sink needs from the context.
+        """
+
+    def available(self) -> bool:
+        """ Whether delivering could work at all right now.
+        """
+
+        return True
+
+    def watch(self, callback: Callable[[], None]):
+        """ Registers `callback` to be called when `available` may have
+            changed.
+        """
+
+    @abc.abstractmethod
+    async def prepare(self, events: List[dict]) -> Any:
+        """ Serializes a batch for `deliver`.
+        """
+
+    @abc.abstractmethod
+    def combine(self, prepared: List[Any]) -> Any:
+        """ Joins what `prepare` made for several batches into one
+            delivery. Only called on `combinable` sinks.
+        """
+
+    @abc.abstractmethod
+    async def deliver(self, prepared: Any) -> Outcome:
+        """ Sends what `prepare` or `combine` made, and sorts its events
+            by outcome.
+        """
+
+    def is_retryable(self, err: Exception) -> bool:
+        """ Returns whether a delivery which raised `err` as a whole is
+            worth retrying.
+        """
+
+        return False
+
+
+class ElasticsearchSink(Sink):
+    """ Bulk-indexes batches with the client registered in the context as
+        `context_key`.
+    """
+
+    client: Client
+
+    def __init__(self, name: str, context_key: str = "client"):
+        self.name = name
+        self.context_key = context_key
+
+    async def start(self, context: aiomisc.Context):
+        self.client = await context[self.context_key]
+        self.key = ("elasticsearch", *self.client.body_key)
+        # Elasticsearch does not take several gzip members in one body
+        self.combinable = self.client.compression == "none"
+
+    def available(self) -> bool:
+        # Not while every node's circuit is open
+        return self.client.available()
+
+    def watch(self, callback: Callable[[], None]):
+        self.client.health.watch(callback)
+
+    async def prepare(self, events: List[dict]) -> Tuple[List[dict], bytes]:
+        return await self.client.prepare(events)
+
+    def combine(self, prepared: List[Tuple[List[dict], bytes]]) -> Tuple[List[dict], bytes]:
+        # Bulk bodies are NDJSON, so they join into one
+        return (
+            [event for events, _ in prepared for event in events],
+            b"".join(body for _, body in prepared),
+        )
+
+    async def deliver(self, prepared: Tuple[List[dict], bytes]) -> Outcome:
+        events, body = prepared
+        try:
+            response = await self.client.bulk(body)
+        except Exception as err:
+            BULK_ERRORS.inc(type(err).__name__)
+            raise
+
+        # Bulk items come back in the order of `events`
+        return partition_bulk_items(events, response)
+
+    def is_retryable(self, err: Exception) -> bool:
+        return is_retryable_error(err)
+
+
+class FileSink(Sink):
+    """ Appends batches to local NDJSON files, one event per line, for
+        cold storage. `path` is a strftime pattern expanded with each
+        event's date, like a daily index name, so events are archived by
+        the day they happened. With gzip compression each batch is
+        appended as a gzip member; a file of several members reads back
+        as one gzip stream.
+
+        Writes happen in the thread pool, one at a time so batches are
+        appended whole and in order.
+    """
+
+    combinable = True
+    max_in_flight = 1
+
+    def __init__(self, name: str, path: str, compression: str = "gzip", compression_level: int = 6):
+        if not path:
+            raise ValueError("The file sink needs a path")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {sorted(COMPRESSIONS)}")
+
+        self.name = name
+        self.path = path
+        self.router = IndexRouter(path)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.key = ("file", path, compression, compression_level)
+
+    async def prepare(self, events: List[dict]) -> Tuple[List[dict], List[Tuple[str, bytes]]]:
+        loop = asyncio.get_event_loop()
+        return events, await loop.run_in_executor(None, self.encode, self.router.group(events))
+
+    def encode(self, groups: List[Tuple[str, List[dict]]]) -> List[Tuple[str, bytes]]:
+        """ Serializes each `(path, events)` group to the bytes appended
+            to that file.
+        """
+
+        chunks = []
+        for path, events in groups:
+            data = b"".join([dumps(event) + b"\n" for event in events])
+            if self.compression == "gzip":
+                data = gzip_compress(data, self.compression_level)
+            chunks.append((path, data))
+
+        return chunks
+
+    def combine(
+        self,
+        prepared: List[Tuple[List[dict], List[Tuple[str, bytes]]]],
+    ) -> Tuple[List[dict], List[Tuple[str, bytes]]]:
+        return (
+            [event for events, _ in prepared for event in events],
+            [chunk for _, chunks in prepared for chunk in chunks],
+        )
+
+    async def deliver(self, prepared: Tuple[List[dict], List[Tuple[str, bytes]]]) -> Outcome:
+        events, chunks = prepared
+        await asyncio.get_event_loop().run_in_executor(None, self.write, chunks)
+        return events, [], []
+
+    def write(self, chunks: List[Tuple[str, bytes]]):
+        for path, data in chunks:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            with open(path, "ab") as f:
+                f.write(data)
+
+    def is_retryable(self, err: Exception) -> bool:
+        # A full disk or an unmounted volume may well come back
+        return isinstance(err, OSError)
+
+
+class Payload:
+    """ A batch taken from the batcher once and delivered to every sink.
+        `prepare` serializes it for a sink, sharing the result with every
+        other sink of the same `key`, so a batch is serialized (and
+        compressed) once per distinct output rather than once per sink.
+
+        `pending` counts the sinks which have not finished with the batch.
+    """
+
+    __slots__ = ("events", "pending", "_readers", "_prepared")
+
+    events: List[dict]
+    pending: int
+    _readers: int
+    _prepared: Dict[Hashable, asyncio.Future]
+
+    def __init__(self, events: List[dict], sinks: int):
+        self.events = events
+        self.pending = sinks
+        self._readers = sinks
+        self._prepared = {}
+
+    async def prepare(self, sink: Sink) -> Any:
+        """ Returns the batch as prepared by `sink`, or by an earlier sink
+            with the same key. Each sink calls this, or `skip`, once.
+        """
+
+        future = self._prepared.get(sink.key)
+        self.skip()
+        if future is None and not self._readers:
+            # This is the last sink to read it
+            return await sink.prepare(self.events)
+
+        if future is None:
+            future = self._prepared[sink.key] = asyncio.ensure_future(sink.prepare(self.events))
+
+        # A sink giving up on the batch does not cancel it for the others
+        return await asyncio.shield(future)
+
+    def skip(self):
+        """ Called instead of `prepare` by a sink which prepares the batch
+            its own way.
+        """
+
+        self._readers -= 1
+        if not self._readers:
+            self._prepared.clear()
+
+
+def build_sinks(
+    names: Sequence[str],
+    *,
+    archive_path: str = "",
+    archive_compression: str = "gzip",
+) -> List[Sink]:
+    """ Builds the sinks from a list of names. The first is the primary,
+        whose pace the sender takes batches at.
+    """
+
+    if not names:
+        raise ValueError("At least one sink is required")
+
+    factories = {
+        "elasticsearch": lambda: ElasticsearchSink("elasticsearch", "client"),
+        "secondary_elasticsearch": lambda: ElasticsearchSink("secondary_elasticsearch", "secondary_client"),
+        "file": lambda: FileSink("file", archive_path, archive_compression),
+    }
+
+    sinks = []
+    for name in names:
+        factory = factories.get(name)
+        if factory is None:
+            raise ValueError(f"Unknown sink {name!r}, expected one of {sorted(factories)}")
+        sinks.append(factory())
+
+    return sinks
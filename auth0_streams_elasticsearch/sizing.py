@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from typing import Optional
+
+from loguru import logger
+
+from .metrics import Histogram, LabeledCounter
+
+
+class BatchSizer:
+    """ BatchSizer picks the number of events for the next bulk request with
+        an additive-increase, multiplicative-decrease controller: while bulk
+        requests finish under `target_latency`, the size grows by `increase`
+        events each time, and when Elasticsearch rejects items or latency
+        goes over target it is cut by `decrease`. `last_latency` is the
+        latency of the bulk request the current size was picked after, and
+        `cuts` counts the cuts by why they were made.
+    """
+
+    min_events: int
+    max_events: int
+    target_latency: float
+    increase: int
+    decrease: float
+    size: int
+    last_latency: float
+    latency: Histogram
+    cuts: LabeledCounter
+
+    def __init__(
+        self,
+        min_events: int,
+        max_events: int,
+        target_latency: float,
+        increase: int = None,
+        decrease: float = 0.5,
+        latency: Optional[Histogram] = None,
+    ):
+        self.min_events = min_events
+        self.max_events = max(max_events, min_events)
+        self.target_latency = target_latency
+        self.increase = increase or min_events
+        self.decrease = decrease
+        self.size = min_events
+        self.last_latency = 0.0
+        self.latency = latency if latency is not None else Histogram()
+        self.cuts = LabeledCounter("reason")
+
+    def observe(self, latency: float, rejected: bool = False):
+        """ Updates the batch size from the outcome of a bulk request.
+        """
+
+        self.latency.observe(latency)
+        self.last_latency = latency
+
+        previous = self.size
+        if rejected or latency > self.target_latency:
+            self.cuts.inc("rejected" if rejected else "latency")
+            self.size = max(self.min_events, int(self.size * self.decrease))
+        else:
+            self.size = min(self.max_events, self.size + self.increase)
+
+        if self.size != previous:
+            logger.debug(f"Bulk size {previous} -> {self.size} (latency {latency:.3f}s, rejected: {rejected})")
+
+    def reconfigure(self, min_events: int, max_events: int, target_latency: float):
+        """ Applies new bounds and target, keeping the current size within
+            the new bounds.
+        """
+
+        self.min_events = min_events
+        self.max_events = max(max_events, min_events)
+        self.target_latency = target_latency
+        self.size = min(self.max_events, max(self.min_events, self.size))
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "last_latency": self.last_latency,
+            "latency": self.latency.stats(),
+        }
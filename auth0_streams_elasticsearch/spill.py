@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import os
+from typing import List
+
+import ujson
+from loguru import logger
+
+
+def write_spill(path: str, events: List[dict]):
+    """ Appends events which could not be sent before shutdown to `path`,
+        one JSON event per line, and fsyncs it.
+    """
+
+    if not events:
+        return
+
+    with open(path, "a") as f:
+        for event in events:
+            f.write(ujson.dumps(event))
+            f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    logger.warning(f"Spilled {len(events)} unsent events to {path}")
+
+
+def take_spill(path: str) -> List[dict]:
+    """ Reads back the events spilled to `path` by a previous run and
+        removes the file. A torn last line is skipped.
+    """
+
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    events = []
+    for number, line in enumerate(lines, 1):
+        try:
+            events.append(ujson.loads(line))
+        except ValueError:
+            logger.error(f"Skipping unreadable line {number} of spill file {path}")
+
+    os.remove(path)
+    return events
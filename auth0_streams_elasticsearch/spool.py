@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import ujson
+from loguru import logger
+
+# Each record is framed as a little-endian (payload length, crc32) header
+# followed by the ujson-encoded list of events.
+FRAME_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_NAME = "checkpoint"
+
+
+class Spool:
+    """ Spool is an append-only, segment-rotated write-ahead log of event
+        batches.
+
+        Positions in the spool are global byte offsets; each segment file is
+        named after the offset of its first byte. Appends are buffered and
+        made durable by a group commit: every writer waiting at the same time
+        shares a single fsync. Once Elasticsearch has acknowledged everything
+        up to an offset, `ack` checkpoints it and removes segments which are
+        entirely behind the checkpoint. That happens in the thread pool,
+        one checkpoint at a time; acks arriving meanwhile are written
+        together by the next one.
+    """
+
+    directory: Path
+    segment_size: int
+    _file: Optional[BinaryIO]
+    _base: int
+    _position: int
+    _synced: int
+    _acked: int
+    _checkpointed: int
+    _retired: List[BinaryIO]
+    _syncing: Optional[asyncio.Future]
+    _checkpointing: Optional[asyncio.Future]
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self._file = None
+        self._base = 0
+        self._position = 0
+        self._synced = 0
+        self._acked = 0
+        self._checkpointed = 0
+        self._retired = []
+        self._syncing = None
+        self._checkpointing = None
+
+    def open(self) -> List[Tuple[int, List[dict]]]:
+        """ Opens the spool for appending and returns every record which was
+            written but never acknowledged, as `(end offset, events)`.
+        """
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._acked = self._checkpointed = self._read_checkpoint()
+
+        pending = []
+        end = self._acked
+        segments = self._segments()
+        for (base, path), (next_base, _) in zip(segments, segments[1:] + [(None, None)]):
+            if next_base is not None and next_base <= self._acked:
+                continue
+
+            for end, events in self._read_segment(base, path):
+                if end > self._acked:
+                    pending.append((end, events))
+
+        self._position = self._synced = max(end, self._acked)
+        self._open_segment()
+
+        return pending
+
+    def write(self, events: List[dict]) -> int:
+        """ Appends a record to the current segment without waiting for it
+            to reach the disk. Returns the offset at the end of the record,
+            which can be passed to `flush` and later `ack`.
+        """
+
+        if self._position - self._base >= self.segment_size:
+            # The retired segment is fsynced and closed by the next commit
+            self._retired.append(self._file)
+            self._open_segment()
+
+        payload = ujson.dumps(events).encode()
+        self._file.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._position += FRAME_HEADER.size + len(payload)
+
+        return self._position
+
+    async def flush(self, offset: int):
+        """ Waits until everything up to `offset` has been fsynced.
+        """
+
+        while self._synced < offset:
+            if self._syncing is None:
+                self._syncing = asyncio.ensure_future(self._sync())
+            await asyncio.shield(self._syncing)
+
+    async def append(self, events: List[dict]) -> int:
+        """ Writes a record and waits for it to be durable.
+        """
+
+        offset = self.write(events)
+        await self.flush(offset)
+
+        return offset
+
+    def ack(self, offset: int):
+        """ Records that everything up to `offset` has been delivered. The
+            checkpoint is written and segments which are no longer needed
+            are removed in the background.
+        """
+
+        if offset <= self._acked:
+            return
+
+        self._acked = offset
+        if self._checkpointing is None:
+            self._checkpointing = asyncio.ensure_future(self._checkpoint())
+
+    async def close(self):
+        """ Flushes and closes the spool.
+        """
+
+        if self._file is None:
+            return
+
+        if self._checkpointing is not None:
+            await self._checkpointing
+        await self.flush(self._position)
+        self._file.close()
+        self._file = None
+
+    async def _sync(self):
+        """ Flushes and fsyncs the current and any retired segments.
+            Only one sync runs at a time; writers arriving while it is in
+            flight wait for it and are batched into the next one.
+        """
+
+        try:
+            position = self._position
+            files = self._retired + [self._file]
+            self._retired = []
+
+            for f in files:
+                f.flush()
+
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, lambda: [os.fsync(f.fileno()) for f in files]
+            )
+
+            for f in files[:-1]:
+                f.close()
+
+            self._synced = position
+        finally:
+            self._syncing = None
+
+    async def _checkpoint(self):
+        """ Writes checkpoints in the thread pool until the latest ack is
+            written. A failed write is logged and left to the next ack.
+        """
+
+        loop = asyncio.get_event_loop()
+        try:
+            while self._checkpointed < self._acked:
+                offset = self._acked
+                await loop.run_in_executor(None, self._write_checkpoint, offset)
+                self._checkpointed = offset
+        except OSError:
+            logger.exception(f"Could not checkpoint spool {self.directory}")
+        finally:
+            self._checkpointing = None
+
+    def _write_checkpoint(self, offset: int):
+        # The checkpoint is not fsynced: losing it only means some
+        # already-indexed events are replayed, and they are indexed by
+        # `log_id` so the replay is idempotent.
+        tmp = self.directory / f"{CHECKPOINT_NAME}.tmp"
+        tmp.write_text(str(offset))
+        os.replace(tmp, self.directory / CHECKPOINT_NAME)
+
+        segments = self._segments()
+        for (base, path), (next_base, _) in zip(segments, segments[1:]):
+            if next_base <= offset:
+                logger.debug(f"Removing acknowledged spool segment {path.name}")
+                path.unlink()
+
+    def _open_segment(self):
+        self._base = self._position
+        path = self.directory / f"{self._base:020d}{SEGMENT_SUFFIX}"
+        self._file = open(path, "ab")
+
+    def _segments(self) -> List[Tuple[int, Path]]:
+        return sorted(
+            (int(path.stem), path)
+            for path in self.directory.glob(f"*{SEGMENT_SUFFIX}")
+        )
+
+    def _read_checkpoint(self) -> int:
+        try:
+            return int((self.directory / CHECKPOINT_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _read_segment(self, base: int, path: Path) -> Iterator[Tuple[int, List[dict]]]:
+        """ Reads all complete records from a segment through a memory map.
+            A torn or corrupt tail left by a crash is truncated away.
+        """
+
+        size = path.stat().st_size
+        if size == 0:
+            path.unlink()
+            return
+
+        valid = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            while valid + FRAME_HEADER.size <= size:
+                length, crc = FRAME_HEADER.unpack_from(buf, valid)
+                start = valid + FRAME_HEADER.size
+                payload = buf[start:start + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+
+                valid = start + length
+                yield base + valid, ujson.loads(payload)
+
+        if valid != size:
+            logger.warning(f"Truncating corrupt spool segment {path.name} at {valid} of {size} bytes")
+            os.truncate(path, valid)
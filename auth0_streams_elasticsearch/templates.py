@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import re
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from elasticsearch.exceptions import NotFoundError, RequestError
+from loguru import logger
+
+from .routing import IndexRouter
+
+# How long a template found up to date is trusted without asking the
+# cluster again
+CACHE_TTL = 24 * 60 * 60
+
+KEYWORD = {"type": "keyword", "ignore_above": 1024}
+
+# The fields of an Auth0 log event that we search and aggregate on, and
+# the ones the transform stages add. Free-form subtrees are kept in
+# `_source` but not indexed, since every distinct key in them would
+# otherwise become a field of its own.
+PROPERTIES = {
+    "@timestamp": {"type": "date"},
+    "date": {"type": "date"},
+    "type": KEYWORD,
+    "type_description": KEYWORD,
+    "level": {"type": "byte"},
+    "description": {"type": "text"},
+    "log_id": KEYWORD,
+    "client_id": KEYWORD,
+    "client_name": KEYWORD,
+    "connection": KEYWORD,
+    "connection_id": KEYWORD,
+    "strategy": KEYWORD,
+    "strategy_type": KEYWORD,
+    "hostname": KEYWORD,
+    "audience": KEYWORD,
+    "scope": KEYWORD,
+    "user_id": KEYWORD,
+    "user_name": KEYWORD,
+    "tenant_name": KEYWORD,
+    "ip": KEYWORD,
+    "user_agent": KEYWORD,
+    "isMobile": {"type": "boolean"},
+    "user_agent_details": {
+        "properties": {
+            "name": KEYWORD,
+            "version": KEYWORD,
+            "os": KEYWORD,
+            "os_version": KEYWORD,
+            "device": KEYWORD,
+        },
+    },
+    "geoip": {
+        "properties": {
+            "country_iso_code": KEYWORD,
+            "country_name": KEYWORD,
+            "region_name": KEYWORD,
+            "city_name": KEYWORD,
+            "location": {"type": "geo_point"},
+        },
+    },
+    "details": {"type": "object", "dynamic": False},
+    "auth0_client": {"type": "object", "dynamic": False},
+    "location_info": {"type": "object", "dynamic": False},
+}
+
+
+def index_patterns(index_name: str, index_mode: str = "daily") -> List[str]:
+    """ The index patterns a template for `index_name` applies to: the
+        strftime pattern with each directive as a wildcard in `daily`
+        mode, the backing indices of the write alias in `alias` mode, and
+        the data stream itself in `data_stream` mode.
+    """
+
+    if index_mode == "alias":
+        return [f"{index_name}-*"]
+
+    if index_mode == "daily":
+        return [re.sub(r"(%.)+", "*", index_name)]
+
+    return [index_name]
+
+
+def build_template(
+    index_name: str,
+    index_mode: str = "daily",
+    *,
+    shards: int = 1,
+    replicas: int = 1,
+    refresh_interval: str = "30s",
+) -> dict:
+    """ Builds a composable index template for bulk ingest of Auth0 log
+        events. Its `version` is a checksum of the rest of it, so any
+        change to the template or the settings it is built from is a new
+        version.
+    """
+
+    template = {
+        "index_patterns": index_patterns(index_name, index_mode),
+        # Above the built-in `logs-*-*` template
+        "priority": 200,
+        "template": {
+            "settings": {
+                "number_of_shards": shards,
+                "number_of_replicas": replicas,
+                "refresh_interval": refresh_interval,
+            },
+            "mappings": {
+                # Unknown strings are keywords rather than text with a
+                # keyword subfield
+                "dynamic_templates": [
+                    {"strings": {"match_mapping_type": "string", "mapping": KEYWORD}},
+                ],
+                "properties": PROPERTIES,
+            },
+        },
+        "_meta": {"managed_by": "auth0-streams-elasticsearch"},
+    }
+    if index_mode == "data_stream":
+        template["data_stream"] = {}
+
+    checksum = zlib.crc32(json.dumps(template, sort_keys=True).encode())
+    # Template versions are signed 32 bit integers
+    template["version"] = checksum & 0x7FFFFFFF
+    return template
+
+
+class TemplateBootstrap:
+    """ Installs the index template on a cluster and creates daily
+        indices ahead of time.
+
+        The template is only put if the cluster's copy is missing or of
+        another version. With `cache_path` set, a template found up to
+        date is remembered there for `CACHE_TTL`, so restarts (and every
+        worker) skip even the version check.
+
+        In `daily` mode, `precreate` creates the indices for the next
+        `precreate_days` days (or their hours, for an hourly pattern), so
+        the first write after midnight does not wait on index creation.
+    """
+
+    es: object
+    router: IndexRouter
+    name: str
+    template: dict
+    precreate_days: int
+    cache_path: str
+    installed: bool
+    _cache_key: str
+    _created: Set[str]
+
+    def __init__(
+        self,
+        es,
+        router: IndexRouter,
+        name: str,
+        hosts: str,
+        *,
+        shards: int = 1,
+        replicas: int = 1,
+        refresh_interval: str = "30s",
+        precreate_days: int = 1,
+        cache_path: str = "",
+    ):
+        self.es = es
+        self.router = router
+        self.name = name
+        self.template = build_template(
+            router.pattern,
+            router.mode,
+            shards=shards,
+            replicas=replicas,
+            refresh_interval=refresh_interval,
+        )
+        self.precreate_days = precreate_days
+        self.cache_path = cache_path
+        self.installed = False
+        self._cache_key = f"{hosts} {name} {self.template['version']}"
+        self._created = set()
+
+    async def run_once(self):
+        """ Installs the template if that has not been done yet, then
+            pre-creates indices. Failures are logged, to be tried again
+            on the next run.
+        """
+
+        try:
+            if not self.installed:
+                await self.ensure_template()
+            created = await self.precreate()
+        except Exception:
+            logger.exception(f"Could not bootstrap index template {self.name}, will try again")
+            return
+
+        if created:
+            logger.info(f"Created indices {', '.join(created)} ahead of time")
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.run_once()
+
+    async def ensure_template(self) -> bool:
+        """ Puts the template unless the cluster has this version of it.
+            Returns whether it was put.
+        """
+
+        if self.cached():
+            self.installed = True
+            return False
+
+        transport = self.es.transport
+        version = self.template["version"]
+        try:
+            response = await transport.perform_request(
+                "GET",
+                f"/_index_template/{self.name}",
+                params={"filter_path": "index_templates.index_template.version"},
+            )
+        except NotFoundError:
+            current = None
+        else:
+            templates = response.get("index_templates") or [{}]
+            current = templates[0].get("index_template", {}).get("version")
+
+        put = current != version
+        if put:
+            await transport.perform_request("PUT", f"/_index_template/{self.name}", body=self.template)
+            logger.info(f"Installed index template {self.name} version {version} (was {current})")
+
+        self.installed = True
+        self.remember()
+        return put
+
+    async def precreate(self, now: Optional[datetime] = None) -> List[str]:
+        """ Creates the indices events will be written to over the next
+            `precreate_days`, once the template is installed. Returns the
+            names of the indices created.
+        """
+
+        if self.router.static or not self.installed or self.precreate_days <= 0:
+            return []
+
+        now = now or datetime.utcnow()
+        names = []
+        for hours in range(self.precreate_days * 24 + 1):
+            name = (now + timedelta(hours=hours)).strftime(self.router.pattern)
+            if name not in self._created and name not in names:
+                names.append(name)
+
+        created = []
+        for name in names:
+            try:
+                await self.es.transport.perform_request("PUT", f"/{name}")
+            except RequestError as err:
+                if err.error != "resource_already_exists_exception":
+                    raise
+            else:
+                created.append(name)
+            self._created.add(name)
+
+        return created
+
+    def cached(self) -> bool:
+        return time.time() - self._read_cache().get(self._cache_key, 0) < CACHE_TTL
+
+    def remember(self):
+        if not self.cache_path:
+            return
+
+        entries = self._read_cache()
+        now = time.time()
+        entries = {key: checked for key, checked in entries.items() if now - checked < CACHE_TTL}
+        entries[self._cache_key] = now
+
+        # Several workers may write it at once
+        tmp = f"{self.cache_path}.{os.getpid()}"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as err:
+            logger.warning(f"Could not write template cache {self.cache_path}: {err}")
+
+    def _read_cache(self) -> Dict[str, float]:
+        if not self.cache_path:
+            return {}
+
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import abc
+import asyncio
+import functools
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from .metrics import TRANSFORM_LATENCY
+from .types import LOG_TYPES
+
+try:
+    import geoip2.database
+    import geoip2.errors
+except ImportError:
+    geoip2 = None
+
+try:
+    from ua_parser import user_agent_parser
+except ImportError:
+    user_agent_parser = None
+
+UNKNOWN_EVENT_TYPE = "Unknown event type"
+
+
+class Stage(abc.ABC):
+    """ A step of the transform pipeline. Stages process a whole delivery's
+        events at once, modifying each event's `data` in place.
+
+        Stages marked `expensive` are run in the thread pool when the
+        pipeline is set to offload.
+    """
+
+    name: str = ""
+    expensive: bool = False
+
+    @abc.abstractmethod
+    def process(self, events: List[dict]):
+        """ Transforms `events` in place.
+        """
+
+
+class LogTypeStage(Stage):
+    """ Adds the long-form description of the event's type identifier as
+        `type_description`, and its severity as `level` if it has one.
+        Both come from tables built once from `LOG_TYPES`.
+    """
+
+    name = "log_type"
+
+    def __init__(self):
+        self.descriptions = {
+            log_type: details.get("event", UNKNOWN_EVENT_TYPE)
+            for log_type, details in LOG_TYPES.items()
+        }
+        self.levels = {
+            log_type: details["level"]
+            for log_type, details in LOG_TYPES.items()
+            if "level" in details
+        }
+
+    def process(self, events: List[dict]):
+        descriptions = self.descriptions
+        levels = self.levels
+        for event in events:
+            data = event["data"]
+            log_type = data.get("type")
+            data["type_description"] = descriptions.get(log_type, UNKNOWN_EVENT_TYPE)
+            level = levels.get(log_type)
+            if level is not None:
+                data["level"] = level
+
+
+class UserAgentStage(Stage):
+    """ Parses `user_agent` into its browser, OS and device, added as
+        `user_agent_details`. Deliveries repeat the same handful of user
+        agents, so parses are kept in an LRU cache. Needs `ua-parser`.
+    """
+
+    name = "user_agent"
+    expensive = True
+
+    def __init__(self, cache_size: int = 4096):
+        if user_agent_parser is None:
+            raise RuntimeError("The user_agent transform needs the `ua-parser` package")
+
+        self.parse = functools.lru_cache(maxsize=cache_size)(self._parse)
+
+    def process(self, events: List[dict]):
+        parse = self.parse
+        for event in events:
+            data = event["data"]
+            user_agent = data.get("user_agent")
+            if user_agent:
+                data["user_agent_details"] = parse(user_agent)
+
+    def _parse(self, user_agent: str) -> dict:
+        parsed = user_agent_parser.Parse(user_agent)
+        browser = parsed["user_agent"]
+        os = parsed["os"]
+
+        return {
+            "name": browser["family"],
+            "version": ".".join(filter(None, (browser["major"], browser["minor"], browser["patch"]))),
+            "os": os["family"],
+            "os_version": ".".join(filter(None, (os["major"], os["minor"], os["patch"]))),
+            "device": parsed["device"]["family"],
+        }
+
+
+class GeoIPStage(Stage):
+    """ Looks up `ip` in a local MaxMind city database, added as `geoip`.
+        Lookups are kept in an LRU cache. Needs `geoip2`.
+    """
+
+    name = "geoip"
+    expensive = True
+
+    def __init__(self, database_path: str, cache_size: int = 4096):
+        if geoip2 is None:
+            raise RuntimeError("The geoip transform needs the `geoip2` package")
+        if not database_path:
+            raise RuntimeError("The geoip transform needs GEOIP_DATABASE_PATH to be set")
+
+        self.reader = geoip2.database.Reader(database_path)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def process(self, events: List[dict]):
+        lookup = self.lookup
+        for event in events:
+            data = event["data"]
+            ip = data.get("ip")
+            if ip and (location := lookup(ip)) is not None:
+                data["geoip"] = location
+
+    def _lookup(self, ip: str) -> Optional[dict]:
+        try:
+            city = self.reader.city(ip)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return None
+
+        return {
+            "country_iso_code": city.country.iso_code,
+            "country_name": city.country.name,
+            "region_name": city.subdivisions.most_specific.name,
+            "city_name": city.city.name,
+            "location": {
+                "lat": city.location.latitude,
+                "lon": city.location.longitude,
+            },
+        }
+
+
+class PruneStage(Stage):
+    """ Removes fields from `data`. Nested fields are given with dots,
+        ie. `details.body`.
+    """
+
+    name = "prune"
+
+    def __init__(self, fields: Sequence[str]):
+        self.fields = [field.split(".") for field in fields]
+
+    def process(self, events: List[dict]):
+        for event in events:
+            data = event["data"]
+            for *parents, key in self.fields:
+                target = data
+                for parent in parents:
+                    target = target.get(parent)
+                    if not isinstance(target, dict):
+                        break
+                else:
+                    target.pop(key, None)
+
+
+class Pipeline:
+    """ Runs each stage over all events of a delivery in turn, recording
+        how long every stage takes. If `offload` is set, expensive stages
+        run in the default thread pool so the event loop is free meanwhile.
+    """
+
+    stages: List[Stage]
+    offload: bool
+
+    def __init__(self, stages: Sequence[Stage], offload: bool = False):
+        self.stages = list(stages)
+        self.offload = offload
+        self._timings = [TRANSFORM_LATENCY.get(stage.name) for stage in self.stages]
+
+    async def run(self, events: List[dict]) -> List[dict]:
+        loop = asyncio.get_event_loop()
+        for stage, timing in zip(self.stages, self._timings):
+            began = time.perf_counter()
+            if self.offload and stage.expensive:
+                await loop.run_in_executor(None, stage.process, events)
+            else:
+                stage.process(events)
+            timing.observe(time.perf_counter() - began)
+
+        return events
+
+    def process(self, events: List[dict]) -> List[dict]:
+        """ Runs every stage in this thread, for callers without an event
+            loop, like the worker processes of a replay.
+        """
+
+        for stage in self.stages:
+            stage.process(events)
+
+        return events
+
+
+def build_pipeline(
+    stages: Sequence[str],
+    *,
+    geoip_database_path: str = "",
+    prune_fields: Sequence[str] = (),
+    cache_size: int = 4096,
+    offload: bool = False,
+) -> Pipeline:
+    """ Builds a pipeline from a list of stage names, in order.
+    """
+
+    factories: Dict[str, Callable[[], Stage]] = {
+        LogTypeStage.name: LogTypeStage,
+        UserAgentStage.name: lambda: UserAgentStage(cache_size),
+        GeoIPStage.name: lambda: GeoIPStage(geoip_database_path, cache_size),
+        PruneStage.name: lambda: PruneStage(prune_fields),
+    }
+
+    pipeline = []
+    for name in stages:
+        factory = factories.get(name)
+        if factory is None:
+            raise ValueError(f"Unknown transform stage {name!r}, expected one of {sorted(factories)}")
+        pipeline.append(factory())
+
+    return Pipeline(pipeline, offload=offload)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+from typing import Callable, Dict
+
+from loguru import logger
+
+
+def run_workers(count: int, target: Callable[[int], None], restart: bool = True):
+    """ Runs `target(worker)` in `count` forked worker processes and
+        supervises them until told to stop.
+
+        Each worker runs the whole pipeline - receiver, batcher and sender -
+        on its own event loop, and binds the receiver port with SO_REUSEPORT
+        so the kernel spreads incoming connections across them. Workers
+        which exit unexpectedly are restarted.
+
+        On SIGTERM or SIGINT every worker is sent SIGTERM and waited on,
+        so each one stops accepting deliveries and drains its sender before
+        the supervisor returns. Workers ignore SIGINT so that a Ctrl-C in a
+        terminal reaches them only through the supervisor. SIGHUP is passed
+        on to every worker, to reload its settings.
+    """
+
+    context = multiprocessing.get_context("fork")
+    processes: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def spawn(worker: int):
+        process = context.Process(
+            target=_run_worker,
+            args=(target, worker),
+            name=f"worker-{worker}",
+        )
+        process.start()
+        processes[worker] = process
+        logger.info(f"Started worker {worker} (pid {process.pid})")
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+
+        stopping = True
+        logger.info(f"Stopping {len(processes)} workers")
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def reload(signum, frame):
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    for worker in range(count):
+        spawn(worker)
+
+    previous = {
+        signum: signal.signal(signum, shutdown)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    previous[signal.SIGHUP] = signal.signal(signal.SIGHUP, reload)
+
+    try:
+        while processes:
+            sentinels = {process.sentinel: worker for worker, process in processes.items()}
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                worker = sentinels[sentinel]
+                process = processes.pop(worker)
+                process.join()
+                if stopping:
+                    logger.info(f"Worker {worker} exited with code {process.exitcode}")
+                elif restart:
+                    logger.error(f"Worker {worker} exited unexpectedly with code {process.exitcode}, restarting")
+                    # Don't spin if a worker fails at startup
+                    time.sleep(1)
+                    spawn(worker)
+                else:
+                    logger.error(f"Worker {worker} exited unexpectedly with code {process.exitcode}")
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def _run_worker(target: Callable[[int], None], worker: int):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Until the worker's event loop takes it over
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    target(worker)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+""" Measures raw Batcher insert and pop throughput at 100k events:
+    inserting deliveries of 100 events and single events (awaited, and
+    through the synchronous `insert_nowait`), and popping batches of 500
+    with and without a byte budget.
+
+    Usage: python benchmarks/batcher_throughput.py
+"""
+
+import asyncio
+import time
+
+from auth0_streams_elasticsearch.batcher import Batcher
+
+TOTAL_EVENTS = 100_000
+EVENTS_PER_REQUEST = 100
+EVENT_SIZE = 600
+BATCH_SIZE = 500
+ROUNDS = 5
+
+
+def make_events(count: int) -> list:
+    return [{"log_id": str(n), "data": {"type": "s"}} for n in range(count)]
+
+
+async def insert_deliveries(batcher: Batcher, events: list):
+    size = EVENT_SIZE * EVENTS_PER_REQUEST
+    for start in range(0, len(events), EVENTS_PER_REQUEST):
+        await batcher.insert_many(events[start:start + EVENTS_PER_REQUEST], size=size)
+
+
+async def insert_singles(batcher: Batcher, events: list):
+    for event in events:
+        await batcher.insert_many([event], size=EVENT_SIZE)
+
+
+async def insert_singles_nowait(batcher: Batcher, events: list):
+    for event in events:
+        assert batcher.insert_nowait([event], size=EVENT_SIZE)
+
+
+def pop_all(batcher: Batcher, max_bytes=None) -> int:
+    popped = 0
+    while batch := batcher.get_batch(BATCH_SIZE, max_bytes):
+        popped += len(batch)
+
+    return popped
+
+
+async def measure(insert, max_bytes=None) -> dict:
+    events = make_events(TOTAL_EVENTS)
+    insert_time = pop_time = 0.0
+    for _ in range(ROUNDS):
+        batcher = Batcher(queue_max_size=TOTAL_EVENTS, flush_size=BATCH_SIZE)
+
+        began = time.perf_counter()
+        await insert(batcher, events)
+        insert_time += time.perf_counter() - began
+
+        began = time.perf_counter()
+        assert pop_all(batcher, max_bytes) == TOTAL_EVENTS
+        pop_time += time.perf_counter() - began
+
+    return {
+        "insert_events_per_s": round(TOTAL_EVENTS * ROUNDS / insert_time),
+        "pop_events_per_s": round(TOTAL_EVENTS * ROUNDS / pop_time),
+    }
+
+
+async def main():
+    for name, insert, max_bytes in (
+        ("deliveries", insert_deliveries, None),
+        ("deliveries_byte_budget", insert_deliveries, EVENT_SIZE * BATCH_SIZE // 3),
+        ("single_events", insert_singles, None),
+        ("single_events_nowait", insert_singles_nowait, None),
+    ):
+        result = await measure(insert, max_bytes)
+        print(name, " ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" Bytes on the wire and CPU cost of gzipping bulk bodies of Auth0
+    events at a few compression levels and batch sizes, then an end to end
+    check that a gzipped bulk request is indexed by the fake Elasticsearch.
+
+    Usage: python benchmarks/bulk_compression.py
+"""
+
+import asyncio
+import random
+import time
+
+from loguru import logger
+
+from auth0_streams_elasticsearch.bulk import BulkBodyBuilder, gzip_compress
+from auth0_streams_elasticsearch.client import Client
+from fake_es import FakeElasticsearch
+
+BATCH_SIZES = (500, 5000)
+LEVELS = (1, 3, 6, 9)
+INDEX = "auth0-events"
+TYPES = ("s", "f", "fp", "sapi", "seacft", "du")
+
+
+def make_events(count: int, seed: int = 0) -> list:
+    rand = random.Random(seed)
+    return [{
+        "log_id": f"90020200101{rand.getrandbits(160):045d}"[:56],
+        "data": {
+            "date": f"2020-01-01T{rand.randrange(24):02d}:{rand.randrange(60):02d}:{rand.randrange(60):02d}.{rand.randrange(1000):03d}Z",
+            "type": rand.choice(TYPES),
+            "type_description": "Success Login",
+            "connection": "Username-Password-Authentication",
+            "client_id": rand.choice(["AaiyAPdpYdesoKnqjj8HJqRn4T5titww", "xO7Wc8Aq0gKkcrrPq5nDYsWc8CgRDtTz"]),
+            "client_name": "My application",
+            "ip": f"203.0.{rand.randrange(256)}.{rand.randrange(256)}",
+            "user_agent": "Mozilla/5.0 (X11; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0",
+            "details": {"prompts": [{"name": "lock-password-authenticate", "elapsedTime": rand.randrange(500)}]},
+            "user_id": f"auth0|{rand.getrandbits(96):024x}",
+            "user_name": f"user{rand.randrange(10 ** 6)}@example.com",
+            "strategy": "auth0",
+            "strategy_type": "database",
+        },
+    } for _ in range(count)]
+
+
+def measure():
+    builder = BulkBodyBuilder()
+    for batch_size in BATCH_SIZES:
+        body = builder.build(make_events(batch_size), INDEX)
+        rounds = max(1, 50_000 // batch_size)
+        for level in LEVELS:
+            began = time.process_time()
+            for _ in range(rounds):
+                compressed = gzip_compress(body, level)
+            cpu = (time.process_time() - began) / rounds
+            print(
+                f"batch={batch_size} level={level} bytes={len(body)} compressed={len(compressed)} "
+                f"reduction={1 - len(compressed) / len(body):.1%} cpu_ms_per_batch={cpu * 1000:.2f} "
+                f"cpu_ms_per_mb={cpu * 1000 / (len(body) / 1024 ** 2):.1f}"
+            )
+
+
+async def end_to_end():
+    fake = FakeElasticsearch()
+    url = await fake.start()
+    events = make_events(5000, seed=1)
+    for compression in ("none", "gzip"):
+        before = fake.bytes_received
+        client = Client(
+            "", "", url, f"{INDEX}-{compression}", True,
+            compression=compression, compression_offload_size=64 * 1024,
+            loop=asyncio.get_event_loop(),
+        )
+        response = await client.send([dict(event) for event in events])
+        await client.close()
+        assert not response["errors"]
+        print(
+            f"end_to_end compression={compression} indexed={len(fake.docs[f'{INDEX}-{compression}'])} "
+            f"wire_bytes={fake.bytes_received - before}"
+        )
+
+    await fake.close()
+
+
+if __name__ == "__main__":
+    logger.remove()
+    measure()
+    asyncio.run(end_to_end())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" Cost of building a bulk request body for 1k Auth0 events: the old path
+    (action/source dicts serialized one by one by the elasticsearch client's
+    JSONSerializer and joined) against BulkBodyBuilder with ujson and orjson.
+
+    Usage: python benchmarks/bulk_serialization.py
+"""
+
+import timeit
+
+import ujson
+from elasticsearch.client.utils import _bulk_body
+from elasticsearch.serializer import JSONSerializer
+
+from auth0_streams_elasticsearch import bulk
+
+EVENTS = 1000
+ROUNDS = 200
+INDEX = "auth0-events-2020.01.01"
+
+
+def make_events():
+    return [{
+        "log_id": f"9002020010100000000000000000000000000000000000000{n:07d}",
+        "data": {
+            "date": "2020-01-01T00:00:00.000Z",
+            "type": "s",
+            "type_description": "Success Login",
+            "connection": "Username-Password-Authentication",
+            "client_id": "AaiyAPdpYdesoKnqjj8HJqRn4T5titww",
+            "client_name": "My application",
+            "ip": "203.0.113.5",
+            "user_agent": "Mozilla/5.0 (X11; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0",
+            "details": {"prompts": [{"name": "lock-password-authenticate", "elapsedTime": 120}]},
+            "user_id": f"auth0|{n:024d}",
+            "user_name": f"user{n}@example.com",
+            "strategy": "auth0",
+            "strategy_type": "database",
+        },
+    } for n in range(EVENTS)]
+
+
+def iterate_docs(events):
+    for event in events:
+        yield {"index": {"_index": INDEX, "_id": event["log_id"]}}
+        yield event["data"]
+
+
+def main():
+    events = make_events()
+    serializer = JSONSerializer()
+    candidates = {
+        "dicts+json": lambda: _bulk_body(serializer, iterate_docs(events)).encode(),
+        "builder+ujson": lambda: bulk.BulkBodyBuilder(lambda o: ujson.dumps(o).encode()).build(events, INDEX),
+    }
+    if "orjson" in bulk.__dict__:
+        candidates["builder+orjson"] = lambda: bulk.BulkBodyBuilder(bulk.orjson.dumps).build(events, INDEX)
+
+    baseline = None
+    for name, build in candidates.items():
+        size = len(build())
+        seconds = min(timeit.repeat(build, number=ROUNDS, repeat=3)) / ROUNDS
+        baseline = baseline or seconds
+        print(f"{name} ms_per_1k={seconds * 1000:.3f} speedup={baseline / seconds:.1f}x bytes={size}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+""" Measures the memory and lookup cost of the log_id dedup cache in
+    exact and Bloom filter mode, with one and three million IDs cached.
+    Also reports the observed false positive rate of the Bloom filter.
+
+    Usage: python benchmarks/dedup_cache.py
+"""
+
+import time
+import tracemalloc
+
+from auth0_streams_elasticsearch.dedup import DedupCache
+
+DELIVERY_SIZE = 100
+LOOKUPS = 200_000
+
+
+def make_events(start: int, count: int) -> list:
+    # Auth0 log_ids are 56 digit strings
+    return [{"log_id": f"900{n:053d}"} for n in range(start, start + count)]
+
+
+def measure(mode: str, cached: int) -> dict:
+    events = make_events(0, cached)
+
+    tracemalloc.start()
+    cache = DedupCache(window=3600, max_size=cached * 2, mode=mode)
+    for start in range(0, cached, DELIVERY_SIZE):
+        cache.add(events[start:start + DELIVERY_SIZE])
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    hits = events[:LOOKUPS]
+    misses = make_events(cached, LOOKUPS)
+    timings = {}
+    for name, lookups in (("hit", hits), ("miss", misses)):
+        began = time.perf_counter()
+        for start in range(0, LOOKUPS, DELIVERY_SIZE):
+            cache.unseen(lookups[start:start + DELIVERY_SIZE])
+        timings[name] = (time.perf_counter() - began) / LOOKUPS
+
+    # Misses were reserved as if being queued
+    cache.release(misses)
+    false_positives = LOOKUPS - len(cache.unseen(misses))
+
+    return {
+        "mode": mode,
+        "cached_ids": cached,
+        "memory_mb": round(memory / 1024 ** 2, 1),
+        "bytes_per_id": round(memory / cached, 1),
+        "hit_ns": round(timings["hit"] * 1e9),
+        "miss_ns": round(timings["miss"] * 1e9),
+        "false_positive_rate": false_positives / LOOKUPS,
+    }
+
+
+def main():
+    for cached in (1_000_000, 3_000_000):
+        for mode in ("exact", "bloom"):
+            result = measure(mode, cached)
+            print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" Sends SIGTERM to the app in the middle of a steady load against a slow
+    fake Elasticsearch, and checks that the shutdown loses nothing: new
+    deliveries are turned away with a 503 while the queue drains, and
+    every delivery that was accepted ends up indexed.
+
+    Runs twice: once with enough drain time to send everything before
+    exiting, and once with a drain timeout too short for that, where the
+    rest is spilled to disk and sent by the next start of the app.
+
+    Usage: python benchmarks/drain_under_load.py
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from multicore_throughput import TOKEN, free_port, make_delivery, wait_for_port
+from fake_es import FakeElasticsearch
+
+EVENTS_PER_REQUEST = 100
+CONCURRENCY = 8
+LOAD_SECONDS = 2
+ES_LATENCY = 0.2
+
+
+def run_fake_es(port: int):
+    async def serve():
+        fake = FakeElasticsearch(latency=ES_LATENCY, workers=2)
+        await fake.start(port=port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def indexed(es_url: str) -> int:
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{es_url}/_fake/stats") as resp:
+                return (await resp.json())["indexed"]
+
+    return asyncio.run(fetch())
+
+
+def start_app(port: int, es_url: str, spill_path: str, drain_timeout: float) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BEARER_TOKEN=TOKEN,
+        BIND_ADDRESS="127.0.0.1",
+        BIND_PORT=str(port),
+        DRAIN_SPILL_PATH=spill_path,
+        DRAIN_TIMEOUT=str(drain_timeout),
+        ELASTICSEARCH_HOSTS=es_url,
+        LOG_LEVEL="WARNING",
+        QUEUE_MAX_SIZE="50000",
+        SEND_AFTER_TIME="1",
+        SEND_MAX_IN_FLIGHT="2",
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-c", "import auth0_streams_elasticsearch; auth0_streams_elasticsearch.start()"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return app
+
+
+async def load(url: str, app: subprocess.Popen) -> dict:
+    """ Posts deliveries until the app stops listening, sending it SIGTERM
+        after `LOAD_SECONDS`.
+    """
+
+    headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+    counts = {"accepted": 0, "unavailable": 0, "throttled": 0}
+    next_start = 0
+    stopped = asyncio.Event()
+
+    async def post(session: aiohttp.ClientSession):
+        nonlocal next_start
+        while not stopped.is_set():
+            start = next_start
+            next_start += EVENTS_PER_REQUEST
+            try:
+                async with session.post(url, data=make_delivery(start), headers=headers) as resp:
+                    status = resp.status
+            except aiohttp.ClientError:
+                stopped.set()
+                return
+
+            if status == 200:
+                counts["accepted"] += 1
+            elif status == 503:
+                counts["unavailable"] += 1
+                await asyncio.sleep(0.01)
+            else:
+                assert status == 429, status
+                counts["throttled"] += 1
+                await asyncio.sleep(0.05)
+
+    async def terminate():
+        await asyncio.sleep(LOAD_SECONDS)
+        app.send_signal(signal.SIGTERM)
+        counts["terminated_at"] = time.monotonic()
+
+    sessions = [aiohttp.ClientSession() for _ in range(CONCURRENCY)]
+    try:
+        await asyncio.gather(terminate(), *map(post, sessions))
+    finally:
+        for session in sessions:
+            await session.close()
+
+    return counts
+
+
+def run(name: str, drain_timeout: float) -> dict:
+    es_port = free_port()
+    fake_es = multiprocessing.Process(target=run_fake_es, args=(es_port,), daemon=True)
+    fake_es.start()
+    wait_for_port(es_port)
+    es_url = f"http://127.0.0.1:{es_port}"
+
+    spill_path = os.path.join(tempfile.mkdtemp(), "spill.ndjson")
+    port = free_port()
+    try:
+        app = start_app(port, es_url, spill_path, drain_timeout)
+        counts = asyncio.run(load(f"http://127.0.0.1:{port}/", app))
+        exit_code = app.wait(timeout=drain_timeout + 30)
+        shutdown = time.monotonic() - counts.pop("terminated_at")
+        indexed_at_exit = indexed(es_url)
+        spilled = 0
+        if os.path.exists(spill_path):
+            with open(spill_path) as f:
+                spilled = sum(1 for _ in f)
+
+        # The next start sends whatever was spilled
+        app = start_app(port, es_url, spill_path, drain_timeout)
+        accepted = counts["accepted"] * EVENTS_PER_REQUEST
+        deadline = time.monotonic() + 60
+        while indexed(es_url) < accepted and time.monotonic() < deadline:
+            time.sleep(0.1)
+        app.send_signal(signal.SIGTERM)
+        app.wait(timeout=drain_timeout + 30)
+
+        return {
+            "scenario": name,
+            "accepted_events": accepted,
+            "unavailable_responses": counts["unavailable"],
+            "throttled_responses": counts["throttled"],
+            "shutdown_s": round(shutdown, 2),
+            "exit_code": exit_code,
+            "indexed_at_exit": indexed_at_exit,
+            "spilled": spilled,
+            "indexed_after_restart": indexed(es_url),
+            "lost": max(0, accepted - indexed(es_url)),
+        }
+    finally:
+        fake_es.terminate()
+
+
+def main():
+    for name, drain_timeout in (("drain", 60), ("spill", 0.5)):
+        result = run(name, drain_timeout)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+        assert result["exit_code"] == 0, result
+        assert result["lost"] == 0, result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+""" End to end benchmark of the whole service graph. For each scenario
+    the app is started with `start()` in a subprocess, pointed at an
+    in-process fake Elasticsearch with that scenario's latency and
+    failures, and fed synthetic Auth0 deliveries from `loadgen`.
+
+    Reports throughput, ingest-to-ack latency (from sending the delivery
+    which was accepted to the fake Elasticsearch first indexing the
+    event), the app's peak RSS and its event loop lag as JSON, so runs
+    can be kept and compared to spot regressions in the batcher, sender
+    or client.
+
+    Usage: python benchmarks/e2e.py [--events N] [--scenario NAME ...]
+                                    [--rate DELIVERIES_PER_S]
+                                    [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from fake_es import FakeElasticsearch
+from loadgen import LogGenerator, run_load
+from multicore_throughput import free_port, wait_for_port
+
+TOKEN = "benchmark"
+
+# Fake Elasticsearch settings and extra app settings for each scenario
+SCENARIOS = {
+    "baseline": {"es": {"latency": 0.005}, "env": {}},
+    "slow_es": {"es": {"latency": 0.1, "workers": 2}, "env": {}},
+    "rejections": {"es": {"latency": 0.005, "reject_rate": 0.05}, "env": {}},
+    "partial_failures": {"es": {"latency": 0.005, "reject_rate": 0.02, "error_rate": 0.01}, "env": {}},
+    "unavailable": {"es": {"latency": 0.005, "unavailable_rate": 0.05}, "env": {}},
+    "gzip": {"es": {"latency": 0.005}, "env": {"ELASTICSEARCH_COMPRESSION": "gzip"}},
+}
+
+LAG_METRIC = "auth0_event_loop_lag_seconds"
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def rss_kb(pid: int, field: str = "VmRSS") -> int:
+    """ The resident set size of `pid` and its direct children, which
+        are the worker processes if there are several.
+    """
+
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+
+    for each in pids:
+        try:
+            with open(f"/proc/{each}/status") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+
+    return total
+
+
+def parse_histogram(text: str, name: str) -> Dict[str, float]:
+    """ Reads the cumulative buckets, sum and count of an unlabeled
+        histogram from Prometheus text.
+    """
+
+    result = {"buckets": []}
+    for line in text.splitlines():
+        match = re.match(rf'{name}_bucket{{le="([^"]+)"}} (\S+)', line)
+        if match:
+            result["buckets"].append((float(match.group(1)), float(match.group(2))))
+        elif line.startswith(f"{name}_sum "):
+            result["sum"] = float(line.split()[1])
+        elif line.startswith(f"{name}_count "):
+            result["count"] = float(line.split()[1])
+
+    return result
+
+
+def histogram_quantile(histogram: Dict[str, float], q: float) -> Optional[float]:
+    """ The upper bound of the bucket holding the `q` quantile, or None
+        if it is over the largest bucket.
+    """
+
+    count = histogram.get("count", 0)
+    for bound, cumulative in histogram["buckets"]:
+        if count and cumulative >= q * count:
+            return bound
+
+    return None
+
+
+def dead_lettered(path: str) -> int:
+    try:
+        with open(path) as f:
+            return sum(1 for _ in f)
+    except FileNotFoundError:
+        return 0
+
+
+async def run(name: str, events: int, rate: float, workers: int, overrides: Optional[dict] = None) -> dict:
+    scenario = SCENARIOS[name]
+    fake = FakeElasticsearch(seed=0, track_times=True, **scenario["es"])
+    es_url = await fake.start()
+
+    port = free_port()
+    workdir = tempfile.mkdtemp()
+    dead_letter_path = os.path.join(workdir, "dead-letter.ndjson")
+    env = dict(
+        os.environ,
+        BEARER_TOKEN=TOKEN,
+        BIND_ADDRESS="127.0.0.1",
+        BIND_PORT=str(port),
+        DEAD_LETTER_PATH=dead_letter_path,
+        DRAIN_SPILL_PATH=os.path.join(workdir, "spill.ndjson"),
+        ELASTICSEARCH_HOSTS=es_url,
+        LOG_LEVEL="ERROR",
+        RETRY_BACKOFF_BASE="0.05",
+        RETRY_BACKOFF_MAX="1",
+        SEND_AFTER_TIME="1",
+        WORKERS=str(workers),
+        **scenario["env"],
+    )
+    env.update(overrides or {})
+    app = subprocess.Popen(
+        [sys.executable, "-c", "import auth0_streams_elasticsearch; auth0_streams_elasticsearch.start()"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, wait_for_port, port)
+        # Let the workers come up too
+        await asyncio.sleep(0.5 if workers > 1 else 0)
+
+        began = time.monotonic()
+        load = await run_load(
+            f"http://127.0.0.1:{port}/", TOKEN, LogGenerator(seed=0),
+            events, concurrency=16, rate=rate,
+        )
+        accepted_at = load.pop("accepted_at")
+        accepted = len(accepted_at)
+
+        # Dead-lettered events are never indexed, but are done with
+        deadline = time.monotonic() + 120
+        while len(fake.indexed_at) + dead_lettered(dead_letter_path) < accepted:
+            if time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.05)
+        done = time.monotonic() - began
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                lag = parse_histogram(await resp.text(), LAG_METRIC)
+        peak_rss = rss_kb(app.pid, "VmHWM")
+    finally:
+        app.send_signal(signal.SIGTERM)
+        await asyncio.get_event_loop().run_in_executor(None, app.wait, 60)
+        await fake.close()
+
+    lag_p99 = histogram_quantile(lag, 0.99)
+    latencies = sorted(
+        fake.indexed_at[log_id] - sent
+        for log_id, sent in accepted_at.items()
+        if log_id in fake.indexed_at
+    )
+    return {
+        "scenario": name,
+        "workers": workers,
+        "events": accepted,
+        "deliveries": load["deliveries"],
+        "payload_mb": round(load["bytes"] / 1024 ** 2, 1),
+        "throttled": load["throttled"],
+        "received_events_per_s": round(accepted / load["seconds"]),
+        "indexed_events_per_s": round(len(latencies) / done),
+        "indexed": len(latencies),
+        "dead_lettered": dead_lettered(dead_letter_path),
+        "lost": accepted - len(latencies) - dead_lettered(dead_letter_path),
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "latency_max_ms": round(latencies[-1] * 1000 if latencies else 0, 1),
+        "bulk_requests": fake.requests,
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "loop_lag_mean_ms": round(lag.get("sum", 0) / max(1, lag.get("count", 0)) * 1000, 2),
+        "loop_lag_p99_ms": None if lag_p99 is None else lag_p99 * 1000,
+        "exit_code": app.returncode,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark against a fake Elasticsearch.")
+    parser.add_argument("--events", type=int, default=50_000)
+    parser.add_argument("--rate", type=float, default=None, help="deliveries per second, default as fast as possible")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "events": args.events,
+        "rate": args.rate,
+        "results": [],
+    }
+    for name in args.scenario or SCENARIOS:
+        result = asyncio.run(run(name, args.events, args.rate, args.workers))
+        print(json.dumps(result), file=sys.stderr)
+        report["results"].append(result)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
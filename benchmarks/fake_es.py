@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+""" An in-process stand-in for the Elasticsearch bulk API.
+
+    It indexes documents into memory and can inject latency, per-item
+    rejections (429 es_rejected_execution_exception), per-item mapping
+    errors (400 mapper_parsing_exception) and whole-request 503s.
+    With `workers` set, only that many bulk requests are processed at a
+    time and the rest queue, like a cluster's write thread pool.
+    With `track_times` set, the time each document was first indexed is
+    kept in `indexed_at`, by `_id`.
+    Composable index templates can be put and read back, and indices
+    created explicitly; a bulk request writing to an index which does not
+    exist yet waits `create_latency` while it is created, as creating an
+    index needs a cluster state update.
+    With `store_sources` unset, only the `_id`s of documents are kept, for
+    runs with more documents than fit in memory.
+"""
+
+import asyncio
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+import ujson
+from aiohttp import web
+
+PRODUCT_HEADERS = {"X-Elastic-Product": "Elasticsearch"}
+
+
+class FakeElasticsearch:
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        workers: Optional[int] = None,
+        reject_rate: float = 0.0,
+        error_rate: float = 0.0,
+        unavailable_rate: float = 0.0,
+        seed: Optional[int] = None,
+        track_times: bool = False,
+        create_latency: float = 0.0,
+        store_sources: bool = True,
+    ):
+        self.latency = latency
+        self.workers = asyncio.Semaphore(workers) if workers else None
+        self.reject_rate = reject_rate
+        self.error_rate = error_rate
+        self.unavailable_rate = unavailable_rate
+        self.random = random.Random(seed)
+        self.docs: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        self.indexed_at: Optional[Dict[str, float]] = {} if track_times else None
+        self.create_latency = create_latency
+        self.store_sources = store_sources
+        self.templates: Dict[str, dict] = {}
+        self.indices: Set[str] = set()
+        self.admin_requests: Dict[str, int] = defaultdict(int)
+        self.requests = 0
+        # Documents received, counting every time one is sent again
+        self.received = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_received = 0
+        self.url = None
+        self.cluster = []
+        self._runner = None
+
+    @property
+    def indexed(self) -> int:
+        return sum(len(docs) for docs in self.docs.values())
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes([
+            web.get("/", self.info),
+            web.get("/_fake/stats", self.stats),
+            web.get("/_nodes/_all/http", self.nodes),
+            web.post("/_bulk", self.bulk),
+            web.post("/{index}/_bulk", self.bulk),
+            web.get("/_index_template/{name}", self.get_template),
+            web.put("/_index_template/{name}", self.put_template),
+            web.put("/{index}", self.create_index),
+        ])
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    async def info(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "version": {"number": "7.17.0", "build_flavor": "default"},
+            "tagline": "You Know, for Search",
+        }, headers=PRODUCT_HEADERS)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        """ Lets a benchmark in another process see what was indexed.
+        """
+
+        return web.json_response({
+            "indexed": self.indexed,
+            "requests": self.requests,
+            "received": self.received,
+            "max_in_flight": self.max_in_flight,
+            "bytes_received": self.bytes_received,
+        })
+
+    async def nodes(self, request: web.Request) -> web.Response:
+        nodes = {}
+        for number, url in enumerate(self.cluster or [self.url]):
+            address = url.split("://", 1)[-1]
+            nodes[f"node-{number}"] = {
+                "name": f"node-{number}",
+                "roles": ["data", "ingest", "master"],
+                "http": {"publish_address": address},
+            }
+
+        return web.json_response({"nodes": nodes}, headers=PRODUCT_HEADERS)
+
+    async def get_template(self, request: web.Request) -> web.Response:
+        self.admin_requests["get_template"] += 1
+        name = request.match_info["name"]
+        if name not in self.templates:
+            return error_response(404, "resource_not_found_exception", f"index template matching [{name}] not found")
+
+        return web.json_response(
+            {"index_templates": [{"name": name, "index_template": self.templates[name]}]},
+            headers=PRODUCT_HEADERS,
+        )
+
+    async def put_template(self, request: web.Request) -> web.Response:
+        self.admin_requests["put_template"] += 1
+        await asyncio.sleep(self.create_latency)
+        self.templates[request.match_info["name"]] = await request.json()
+        return web.json_response({"acknowledged": True}, headers=PRODUCT_HEADERS)
+
+    async def create_index(self, request: web.Request) -> web.Response:
+        self.admin_requests["create_index"] += 1
+        index = request.match_info["index"]
+        if index in self.indices:
+            return error_response(400, "resource_already_exists_exception", f"index [{index}] already exists")
+
+        await asyncio.sleep(self.create_latency)
+        self.indices.add(index)
+        return web.json_response({"acknowledged": True, "index": index}, headers=PRODUCT_HEADERS)
+
+    async def bulk(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = await request.read()
+            # aiohttp decompresses gzipped bodies; count what was on the wire
+            self.bytes_received += request.content_length or len(body)
+            if self.workers is not None:
+                async with self.workers:
+                    await asyncio.sleep(self.latency)
+            elif self.latency:
+                await asyncio.sleep(self.latency)
+
+            if self.random.random() < self.unavailable_rate:
+                return web.json_response(
+                    {"error": {"type": "unavailable_shards_exception"}, "status": 503},
+                    status=503,
+                    headers=PRODUCT_HEADERS,
+                )
+
+            response = self.index(body, request.match_info.get("index"))
+            new = {next(iter(item.values()))["_index"] for item in response["items"]} - self.indices
+            if new:
+                self.indices |= new
+                await asyncio.sleep(self.create_latency)
+
+            return web.json_response(response, dumps=ujson.dumps, headers=PRODUCT_HEADERS)
+        finally:
+            self.in_flight -= 1
+
+    def index(self, body: bytes, default_index: Optional[str]) -> dict:
+        lines = [line for line in body.split(b"\n") if line]
+        items = []
+        errors = False
+        for action_line, source_line in zip(lines[::2], lines[1::2]):
+            action, meta = next(iter(ujson.loads(action_line).items()))
+            index = meta.get("_index", default_index)
+            result = {"_index": index, "_id": meta.get("_id")}
+
+            roll = self.random.random()
+            if roll < self.reject_rate:
+                errors = True
+                result.update(status=429, error={
+                    "type": "es_rejected_execution_exception",
+                    "reason": "rejected execution of coordinating operation",
+                })
+            elif roll < self.reject_rate + self.error_rate:
+                errors = True
+                result.update(status=400, error={
+                    "type": "mapper_parsing_exception",
+                    "reason": "failed to parse field [details]",
+                })
+            else:
+                created = result["_id"] not in self.docs[index]
+                if self.indexed_at is not None:
+                    self.indexed_at.setdefault(result["_id"], time.monotonic())
+                self.docs[index][result["_id"]] = ujson.loads(source_line) if self.store_sources else None
+                result.update(status=201 if created else 200, result="created" if created else "updated")
+
+            items.append({action: result})
+
+        self.received += len(items)
+        return {"took": 1, "errors": errors, "items": items}
+
+
+def error_response(status: int, error_type: str, reason: str) -> web.Response:
+    return web.json_response(
+        {"error": {"root_cause": [{"type": error_type, "reason": reason}], "type": error_type, "reason": reason}, "status": status},
+        status=status,
+        headers=PRODUCT_HEADERS,
+    )
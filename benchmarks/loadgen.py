@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+""" A synthetic Auth0 log stream. Events follow a rough production mix of
+    log types (mostly logins and token exchanges, a tail of failures and
+    management events), with the optional fields, user agents and
+    `details` payloads that make real events vary from a few hundred
+    bytes to a few kilobytes.
+
+    Can also be run on its own to load an instance of the receiver:
+
+    Usage: python benchmarks/loadgen.py URL [--token T] [--events N]
+                                            [--rate DELIVERIES_PER_S]
+                                            [--concurrency C]
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import ujson
+
+from auth0_streams_elasticsearch.types import LOG_TYPES
+
+# Relative frequency of the common log types; the rest share `OTHER_WEIGHT`
+TYPE_WEIGHTS = {
+    "s": 40, "seacft": 18, "seccft": 10, "slo": 6, "sapi": 4, "fp": 4,
+    "f": 2, "fu": 2, "feacft": 1.5, "w": 1, "ss": 1, "scp": 0.5, "sv": 0.5,
+    "du": 0.2, "api_limit": 0.2,
+}
+OTHER_WEIGHT = 0.1
+
+# Auth0 delivers up to 100 events per request, usually far fewer
+MAX_DELIVERY_SIZE = 100
+
+CLIENTS = [
+    ("AaiyAPdpYdesoKnqjj8HJqRn4T5titww", "Dashboard"),
+    ("xO7Wc8Aq0gKkcrrPq5nDYsWc8CgRDtTz", "Mobile app"),
+    ("q5nDYsWc8CgRDtTzxO7Wc8Aq0gKkcrrP", "Billing API"),
+]
+CONNECTIONS = [
+    ("Username-Password-Authentication", "auth0", "database"),
+    ("google-oauth2", "google-oauth2", "social"),
+    ("corp-saml", "samlp", "enterprise"),
+]
+USER_AGENTS = [
+    "Mozilla/5.0 (X11; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_3) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Version/13.0.5 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/80.0.3987.122 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 13_3_1 like Mac OS X) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko) Mobile/15E148",
+    "okhttp/4.3.1",
+]
+
+
+class LogGenerator:
+    """ Makes unique, reproducible events and deliveries for a seed.
+        `prefix` keeps the `log_id`s of separate runs apart.
+    """
+
+    def __init__(self, seed: int = 0, prefix: str = "900"):
+        self.random = random.Random(seed)
+        self.prefix = prefix
+        self.count = 0
+        self.types = list(LOG_TYPES)
+        self.weights = [TYPE_WEIGHTS.get(log_type, OTHER_WEIGHT) for log_type in self.types]
+
+    def event(self) -> dict:
+        rand = self.random
+        self.count += 1
+        log_id = f"{self.prefix}{self.count:053d}"
+        log_type = rand.choices(self.types, self.weights)[0]
+        client_id, client_name = rand.choice(CLIENTS)
+        connection, strategy, strategy_type = rand.choice(CONNECTIONS)
+        date = datetime.datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
+
+        data = {
+            "date": date,
+            "type": log_type,
+            "description": LOG_TYPES[log_type].get("event", ""),
+            "client_id": client_id,
+            "client_name": client_name,
+            "ip": f"203.0.{rand.randrange(256)}.{rand.randrange(256)}",
+            "user_agent": rand.choice(USER_AGENTS),
+            "log_id": log_id,
+        }
+        if log_type not in ("seccft", "sapi"):
+            data.update(
+                connection=connection,
+                strategy=strategy,
+                strategy_type=strategy_type,
+                user_id=f"{strategy}|{rand.getrandbits(96):024x}",
+                user_name=f"user{rand.randrange(10 ** 6)}@example.com",
+            )
+        if log_type == "sapi":
+            # Management API calls carry the request and response bodies
+            data["details"] = {
+                "request": {
+                    "method": rand.choice(["post", "patch", "delete"]),
+                    "path": f"/api/v2/users/auth0|{rand.getrandbits(96):024x}",
+                    "body": {"app_metadata": {"plan": "pro", "seats": rand.randrange(100)}},
+                },
+                "response": {"statusCode": 200, "body": {"x": "y" * rand.randrange(200, 2000)}},
+            }
+        elif rand.random() < 0.5:
+            data["details"] = {
+                "prompts": [
+                    {"name": "lock-password-authenticate", "elapsedTime": rand.randrange(500)},
+                    {"name": "login", "flow": "universal-login", "elapsedTime": rand.randrange(2000)},
+                ][:rand.randrange(1, 3)],
+                "initiatedAt": int(time.time() * 1000),
+                "session_id": f"{rand.getrandbits(128):032x}",
+            }
+
+        return {"log_id": log_id, "data": data}
+
+    def delivery(self, size: Optional[int] = None) -> Tuple[List[str], bytes]:
+        """ Returns the `log_id`s and body of a delivery of `size` events,
+            or of a random size skewed towards small deliveries.
+        """
+
+        if size is None:
+            size = min(MAX_DELIVERY_SIZE, 1 + int(self.random.expovariate(1 / 30)))
+        events = [self.event() for _ in range(size)]
+        return [event["log_id"] for event in events], ujson.dumps({"logs": events}).encode()
+
+
+async def run_load(
+    url: str,
+    token: str,
+    generator: LogGenerator,
+    total_events: int,
+    concurrency: int = 16,
+    rate: Optional[float] = None,
+) -> dict:
+    """ Posts deliveries of about `total_events` events to `url`, as fast
+        as `concurrency` connections allow or at `rate` deliveries per
+        second. Deliveries turned away with a 429 or 503 are retried
+        after a short wait, like Auth0 does.
+
+        Returns counts, plus `accepted_at`: the time each accepted event's
+        delivery was sent, by `log_id`.
+    """
+
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    accepted_at: Dict[str, float] = {}
+    counts = {"deliveries": 0, "events": 0, "bytes": 0, "throttled": 0, "unavailable": 0}
+    interval = 1 / rate if rate else 0
+    next_send = time.monotonic()
+
+    async def post(session: aiohttp.ClientSession):
+        nonlocal next_send
+        while counts["events"] < total_events:
+            log_ids, body = generator.delivery()
+            counts["events"] += len(log_ids)
+            if interval:
+                next_send += interval
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+
+            while True:
+                sent = time.monotonic()
+                async with session.post(url, data=body, headers=headers) as resp:
+                    status = resp.status
+                if status == 200:
+                    break
+                counts["throttled" if status == 429 else "unavailable"] += 1
+                assert status in (429, 503), status
+                await asyncio.sleep(0.05)
+
+            counts["deliveries"] += 1
+            counts["bytes"] += len(body)
+            for log_id in log_ids:
+                accepted_at[log_id] = sent
+
+    began = time.monotonic()
+    sessions = [aiohttp.ClientSession() for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*map(post, sessions))
+    finally:
+        for session in sessions:
+            await session.close()
+
+    counts["seconds"] = time.monotonic() - began
+    counts["accepted_at"] = accepted_at
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Posts synthetic Auth0 log stream deliveries.")
+    parser.add_argument("url")
+    parser.add_argument("--token", default="benchmark")
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--rate", type=float, default=None, help="deliveries per second")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = LogGenerator(args.seed, prefix=f"9{int(time.time()):010d}"[:11])
+    result = asyncio.run(run_load(args.url, args.token, generator, args.events, args.concurrency, args.rate))
+    del result["accepted_at"]
+    result["events_per_s"] = round(result["events"] / result["seconds"])
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
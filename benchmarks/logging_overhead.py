@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+""" What logging costs the event loop. First the time a log call takes
+    in the calling thread, for loguru writing JSON to stdout directly
+    versus the background sink with and without sampling, and for stdlib
+    records (like aiohttp's access log) going through the old
+    frame-walking intercept handler versus the new one. Then the end to
+    end benchmark's baseline scenario with logging off, at INFO (an
+    access log line per delivery) and at DEBUG, written directly or from
+    the background thread, and sampled.
+
+    A single end to end run varies by 20% or more from the next on a
+    small machine, more than logging costs, so the scenarios are run in
+    turn `ROUNDS` times and the median and range of each are reported.
+
+    Usage: python benchmarks/logging_overhead.py [events] [rounds]
+"""
+
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import time
+
+from loguru import logger
+
+import e2e
+from auth0_streams_elasticsearch.log import BackgroundSink, InterceptHandler, Sampler
+
+CALLS = 20_000
+ROUNDS = 3
+SAMPLE_RATE = 0.01
+
+END_TO_END = (
+    ("off", {"LOG_LEVEL": "ERROR"}),
+    ("info_direct", {"LOG_LEVEL": "INFO", "LOG_BACKGROUND": "false"}),
+    ("info_background", {"LOG_LEVEL": "INFO"}),
+    ("info_sampled", {"LOG_LEVEL": "INFO", "LOG_SAMPLE_RATE": "0.01"}),
+    ("debug_direct", {"LOG_LEVEL": "DEBUG", "LOG_BACKGROUND": "false"}),
+    ("debug_background", {"LOG_LEVEL": "DEBUG"}),
+    ("debug_sampled", {"LOG_LEVEL": "DEBUG", "LOG_SAMPLE_RATE": "0.01"}),
+)
+
+
+class FrameWalkingHandler(logging.Handler):
+    """ The intercept handler as it was, for comparison.
+    """
+
+    def emit(self, record):
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+
+        frame, depth = logging.currentframe(), 2
+        while frame.f_code.co_filename == logging.__file__:
+            frame = frame.f_back
+            depth += 1
+
+        logger.opt(depth=depth, exception=record.exc_info).log(level, record.getMessage())
+
+
+def per_call(log) -> float:
+    began = time.perf_counter()
+    for n in range(CALLS):
+        log(n)
+    return (time.perf_counter() - began) / CALLS
+
+
+def measure_calls():
+    devnull = open(os.devnull, "w")
+    response = {"took": 3, "errors": False, "items": [{"index": {"_id": str(n), "status": 201}} for n in range(20)]}
+    access = logging.getLogger("aiohttp.access")
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+
+    def loguru_call(n):
+        logger.bind(result=response).info(f"Completed successfully {n}")
+
+    def loguru_debug_call(n):
+        logger.bind(result=response).debug(f"Completed successfully {n}")
+
+    def stdlib_call(n):
+        access.info('127.0.0.1 "POST / HTTP/1.1" 200 %d', n)
+
+    for sink_name in ("direct", "background", "sampled"):
+        logger.remove()
+        sink = None
+        sampler = Sampler(SAMPLE_RATE) if sink_name == "sampled" else None
+        if sink_name == "direct":
+            logger.add(devnull, format="{message}", serialize=True, level="DEBUG")
+        else:
+            sink = BackgroundSink(devnull)
+            logger.add(sink, format="{message}", level="DEBUG", filter=sampler)
+
+        handlers = [("intercept", InterceptHandler(sampler))]
+        if sampler is None:
+            handlers.insert(0, ("frame_walking", FrameWalkingHandler()))
+        for handler_name, handler in handlers:
+            root.handlers[:] = [handler]
+            print(
+                f"sink={sink_name} handler={handler_name} "
+                f"stdlib_us_per_call={per_call(stdlib_call) * 1e6:.1f}"
+            )
+        print(
+            f"sink={sink_name} loguru_us_per_call={per_call(loguru_call) * 1e6:.1f} "
+            f"loguru_debug_us_per_call={per_call(loguru_debug_call) * 1e6:.1f}"
+        )
+
+        began = time.perf_counter()
+        logger.remove()
+        if sink is not None:
+            print(f"sink={sink_name} write_out_s={time.perf_counter() - began:.2f} dropped={sink.dropped}")
+
+    root.handlers[:] = []
+
+
+def measure_end_to_end(events: int, rounds: int):
+    results = {name: [] for name, _ in END_TO_END}
+    for _ in range(rounds):
+        for name, overrides in END_TO_END:
+            results[name].append(asyncio.run(e2e.run("baseline", events, None, 1, overrides)))
+
+    for name, runs in results.items():
+        received = [result["received_events_per_s"] for result in runs]
+        print(
+            f"logging={name} received_events_per_s={statistics.median(received):.0f} "
+            f"range={min(received):.0f}-{max(received):.0f} "
+            f"indexed_events_per_s={statistics.median(result['indexed_events_per_s'] for result in runs):.0f} "
+            f"latency_p99_ms={statistics.median(result['latency_p99_ms'] for result in runs)} "
+            f"loop_lag_mean_ms={statistics.median(result['loop_lag_mean_ms'] for result in runs)}"
+        )
+
+
+if __name__ == "__main__":
+    measure_calls()
+    measure_end_to_end(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 20_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else ROUNDS,
+    )
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+""" Runs the batcher and sender with several sinks: a fast fake
+    Elasticsearch as the primary, a second one (as when dual-writing to a
+    cluster being migrated to) which is slow or briefly down, and a
+    gzipped NDJSON archive. Events are queued at a steady rate, and for
+    each sink we report how long after the last event it had everything.
+
+    The fast cluster and the archive should keep up as well as with the
+    fast cluster alone unless the second cluster is more than
+    `SINK_MAX_BACKLOG` events behind, and each batch's bulk body should
+    be built once for both clusters. Every sink must end up with every
+    event.
+
+    Usage: python benchmarks/multi_sink.py
+"""
+
+import asyncio
+import glob
+import gzip
+import os
+import tempfile
+import time
+
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.metrics import BULK_BYTES
+from auth0_streams_elasticsearch.sender import SenderService
+from auth0_streams_elasticsearch.sinks import ElasticsearchSink, FileSink
+from fake_es import FakeElasticsearch
+
+TOTAL_EVENTS = 50_000
+EVENTS_PER_SECOND = 20_000
+INDEX = "auth0-events"
+
+SCENARIOS = (
+    # name, sinks, second cluster latency, seconds it is down for, sink backlog
+    ("fast_only", ("fast",), 0, 0, 50_000),
+    ("fast_and_archive", ("fast", "archive"), 0, 0, 50_000),
+    ("all_second_slow", ("fast", "second", "archive"), 0.5, 0, 50_000),
+    ("all_second_down", ("fast", "second", "archive"), 0.005, 2, 50_000),
+    ("all_second_down_small_backlog", ("fast", "second", "archive"), 0.005, 2, 5_000),
+)
+
+
+def archived(directory: str) -> int:
+    count = 0
+    for path in glob.glob(os.path.join(directory, "*.ndjson.gz")):
+        with gzip.open(path) as f:
+            count += sum(1 for _ in f)
+
+    return count
+
+
+async def feed(context) -> float:
+    batcher: Batcher = await context["batcher"]
+    began = time.monotonic()
+    for start in range(0, TOTAL_EVENTS, 100):
+        await batcher.insert_many(
+            {"log_id": str(n), "data": {"type": "s", "date": "2020-01-01T00:00:00.000Z"}}
+            for n in range(start, start + 100)
+        )
+        await asyncio.sleep(max(0.0, began + (start + 100) / EVENTS_PER_SECOND - time.monotonic()))
+
+    return time.monotonic()
+
+
+async def outage(fake: FakeElasticsearch, seconds: float):
+    fake.unavailable_rate = 1
+    await asyncio.sleep(seconds)
+    fake.unavailable_rate = 0
+
+
+async def behind(done, finished: float) -> float:
+    while not done():
+        await asyncio.sleep(0.05)
+
+    return round(time.monotonic() - finished, 2)
+
+
+def run(name: str, sink_names, second_latency: float, down: float, backlog: int) -> dict:
+    archive = tempfile.mkdtemp()
+    loop = aiomisc.new_event_loop()
+    fast = FakeElasticsearch(latency=0.005)
+    second = FakeElasticsearch(latency=second_latency, workers=1)
+    fast_url = loop.run_until_complete(fast.start())
+    second_url = loop.run_until_complete(second.start())
+
+    sinks = {
+        "fast": ElasticsearchSink("fast", "client"),
+        "second": ElasticsearchSink("second", "second_client"),
+        "archive": FileSink("archive", os.path.join(archive, "auth0-%Y-%m-%d.ndjson.gz")),
+    }
+    done = {
+        "fast": lambda: fast.indexed >= TOTAL_EVENTS,
+        "second": lambda: second.indexed >= TOTAL_EVENTS,
+        "archive": lambda: archived(archive) >= TOTAL_EVENTS,
+    }
+    services = [
+        BatcherService(queue_max_size=TOTAL_EVENTS, flush_size=100, flush_after=0.1),
+        ClientService(username="", password="", hosts=fast_url, index_name=INDEX, ssl_verify=False),
+        ClientService(
+            username="", password="", hosts=second_url, index_name=INDEX, ssl_verify=False,
+            context_key="second_client",
+        ),
+        SenderService(
+            send_after_events=100,
+            send_max_in_flight=2,
+            sink_max_backlog=backlog,
+            retry_max_attempts=100,
+            retry_backoff_base=0.05,
+            retry_backoff_max=0.5,
+            sinks=[sinks[sink] for sink in sink_names],
+        ),
+    ]
+    bodies_built = BULK_BYTES.count
+    with aiomisc.entrypoint(*services, loop=loop, log_config=False) as loop:
+        context = aiomisc.get_context()
+        if down:
+            loop.create_task(outage(second, down))
+        began = time.monotonic()
+        finished = loop.run_until_complete(feed(context))
+        result = {"scenario": name, "feed_s": round(finished - began, 2)}
+        delays = loop.run_until_complete(asyncio.gather(*(behind(done[sink], finished) for sink in sink_names)))
+        for sink, delay in zip(sink_names, delays):
+            result[f"{sink}_behind_s"] = delay
+
+    result["batches"] = fast.requests
+    result["bulk_bodies_built"] = BULK_BYTES.count - bodies_built
+    result["archived"] = archived(archive) if "archive" in sink_names else None
+    loop.run_until_complete(fast.close())
+    loop.run_until_complete(second.close())
+
+    # Leaving the entrypoint stopped the services; nothing of theirs
+    # should still be running when the loop is closed
+    pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    assert not pending, pending
+    loop.close()
+    return result
+
+
+def main():
+    logger.remove()
+    for scenario in SCENARIOS:
+        result = run(*scenario)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+""" Runs the whole app with a varying number of worker processes against
+    a fake Elasticsearch in its own process, and drives it with a load
+    generator spread over several client processes. Reports how fast
+    deliveries were accepted, how long until every event was indexed,
+    and how long the coordinated shutdown took.
+
+    Scaling with workers needs as many free cores as workers, on top of
+    the load generator and the fake Elasticsearch.
+
+    Usage: python benchmarks/multicore_throughput.py [workers ...]
+"""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import ujson
+
+from fake_es import FakeElasticsearch
+
+TOKEN = "benchmark"
+TOTAL_EVENTS = 200_000
+EVENTS_PER_REQUEST = 100
+CLIENT_PROCESSES = 4
+CONCURRENCY = 16
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def run_fake_es(port: int):
+    async def serve():
+        fake = FakeElasticsearch()
+        await fake.start(port=port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def make_delivery(start: int) -> bytes:
+    return ujson.dumps({"logs": [
+        {"log_id": str(n), "data": {"type": "s", "date": "2020-01-01T00:00:00.000Z", "description": "x" * 200}}
+        for n in range(start, start + EVENTS_PER_REQUEST)
+    ]}).encode()
+
+
+async def post_all(url: str, starts: list):
+    bodies = [make_delivery(start) for start in starts]
+    headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+
+    async def post(session: aiohttp.ClientSession):
+        while bodies:
+            body = bodies.pop()
+            while True:
+                async with session.post(url, data=body, headers=headers) as resp:
+                    if resp.status == 200:
+                        break
+                    assert resp.status == 429, resp.status
+                await asyncio.sleep(0.05)
+
+    # One session per coroutine, so connections are spread over workers
+    sessions = [aiohttp.ClientSession() for _ in range(CONCURRENCY)]
+    try:
+        await asyncio.gather(*map(post, sessions))
+    finally:
+        for session in sessions:
+            await session.close()
+
+
+def generate_load(url: str, starts: list, ready, go):
+    ready.wait()
+    go.wait()
+    asyncio.run(post_all(url, starts))
+
+
+def indexed(es_url: str) -> int:
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{es_url}/_fake/stats") as resp:
+                return (await resp.json())["indexed"]
+
+    return asyncio.run(fetch())
+
+
+def run(workers: int, es_url: str) -> dict:
+    port = free_port()
+    env = dict(
+        os.environ,
+        BEARER_TOKEN=TOKEN,
+        BIND_ADDRESS="127.0.0.1",
+        BIND_PORT=str(port),
+        ELASTICSEARCH_HOSTS=es_url,
+        ELASTICSEARCH_INDEX_NAME=f"workers-{workers}",
+        LOG_LEVEL="WARNING",
+        QUEUE_MAX_SIZE="20000",
+        SEND_AFTER_TIME="1",
+        WORKERS=str(workers),
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-c", "import auth0_streams_elasticsearch; auth0_streams_elasticsearch.start()"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+
+    url = f"http://127.0.0.1:{port}/"
+    starts = list(range(0, TOTAL_EVENTS, EVENTS_PER_REQUEST))
+    ready = multiprocessing.Event()
+    go = multiprocessing.Event()
+    clients = [
+        multiprocessing.Process(target=generate_load, args=(url, starts[n::CLIENT_PROCESSES], ready, go))
+        for n in range(CLIENT_PROCESSES)
+    ]
+    for client in clients:
+        client.start()
+    ready.set()
+
+    before = indexed(es_url)
+    began = time.monotonic()
+    go.set()
+    for client in clients:
+        client.join()
+    received = time.monotonic() - began
+
+    while indexed(es_url) - before < TOTAL_EVENTS:
+        time.sleep(0.05)
+    done = time.monotonic() - began
+
+    stopping = time.monotonic()
+    app.send_signal(signal.SIGTERM)
+    exit_code = app.wait(timeout=60)
+
+    return {
+        "workers": workers,
+        "received_events_per_s": round(TOTAL_EVENTS / received),
+        "indexed_events_per_s": round(TOTAL_EVENTS / done),
+        "shutdown_s": round(time.monotonic() - stopping, 2),
+        "exit_code": exit_code,
+    }
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4]
+
+    es_port = free_port()
+    fake_es = multiprocessing.Process(target=run_fake_es, args=(es_port,), daemon=True)
+    fake_es.start()
+    wait_for_port(es_port)
+    es_url = f"http://127.0.0.1:{es_port}"
+
+    print(f"cpus={os.cpu_count()} events={TOTAL_EVENTS}")
+    try:
+        for workers in counts:
+            result = run(workers, es_url)
+            print(" ".join(f"{key}={value}" for key, value in result.items()))
+    finally:
+        fake_es.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+""" Runs the batcher and sender against a cluster of three fake
+    Elasticsearch nodes, one of which is slow, answering 503s, refusing
+    connections or (with all the others) down for a while. Events are
+    queued at a steady rate.
+
+    For each scenario we report how long after the last event everything
+    was indexed, how many bulk requests each node got (failed ones
+    included), and the most deliveries the sender had under way at once,
+    which should stay at the in-flight limit or below even while every
+    node is down. In the `sniffed` scenario only the first node is
+    configured and the others are found by sniffing.
+
+    Usage: python benchmarks/node_selection.py
+"""
+
+import asyncio
+import time
+
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.sender import SenderService
+from fake_es import FakeElasticsearch
+
+TOTAL_EVENTS = 40_000
+EVENTS_PER_SECOND = 20_000
+INDEX = "auth0-events"
+OPEN_TIME = 0.5
+FAST = 0.005
+
+SCENARIOS = (
+    # name, latency of each node, how each node fails, sniff
+    ("even", (FAST, FAST, FAST), (None, None, None), False),
+    ("one_slow", (FAST, FAST, 0.3), (None, None, None), False),
+    ("one_503", (FAST, FAST, FAST), (None, None, "503"), False),
+    ("one_refusing", (FAST, FAST, FAST), (None, None, "refuse"), False),
+    ("all_down_2s", (FAST, FAST, FAST), ("2s", "2s", "2s"), False),
+    ("sniffed", (FAST, FAST, FAST), (None, None, None), True),
+)
+
+
+async def feed(context) -> float:
+    batcher: Batcher = await context["batcher"]
+    began = time.monotonic()
+    for start in range(0, TOTAL_EVENTS, 100):
+        await batcher.insert_many(
+            {"log_id": str(n), "data": {"type": "s", "date": "2020-01-01T00:00:00.000Z"}}
+            for n in range(start, start + 100)
+        )
+        await asyncio.sleep(max(0.0, began + (start + 100) / EVENTS_PER_SECOND - time.monotonic()))
+
+    return time.monotonic()
+
+
+async def outage(node: FakeElasticsearch, seconds: float):
+    node.unavailable_rate = 1
+    await asyncio.sleep(seconds)
+    node.unavailable_rate = 0
+
+
+async def watch_in_flight(sender: SenderService, peak: list):
+    while True:
+        peak[0] = max(peak[0], sum(len(worker.tasks) for worker in sender.workers))
+        await asyncio.sleep(0.005)
+
+
+def run(name: str, latencies, failures, sniff: bool) -> dict:
+    loop = aiomisc.new_event_loop()
+    nodes = [FakeElasticsearch(latency=latency) for latency in latencies]
+    urls = [loop.run_until_complete(node.start()) for node in nodes]
+    for node in nodes:
+        node.cluster = urls
+    for node, failure in zip(nodes, failures):
+        if failure == "503":
+            node.unavailable_rate = 1
+        elif failure == "refuse":
+            loop.run_until_complete(node.close())
+
+    sender = SenderService(
+        send_after_events=100,
+        send_max_in_flight=4,
+        retry_max_attempts=100,
+        retry_backoff_base=0.05,
+        retry_backoff_max=0.5,
+    )
+    services = [
+        BatcherService(queue_max_size=TOTAL_EVENTS, flush_size=100, flush_after=0.1),
+        ClientService(
+            username="", password="", hosts=urls[0] if sniff else ",".join(urls),
+            index_name=INDEX, ssl_verify=False,
+            circuit_open_time=OPEN_TIME,
+            sniff_interval=60 if sniff else 0,
+        ),
+        sender,
+    ]
+    peak = [0]
+    with aiomisc.entrypoint(*services, loop=loop, log_config=False) as loop:
+        context = aiomisc.get_context()
+        for node, failure in zip(nodes, failures):
+            if failure == "2s":
+                loop.create_task(outage(node, 2))
+        watcher = loop.create_task(watch_in_flight(sender, peak))
+
+        began = time.monotonic()
+        finished = loop.run_until_complete(feed(context))
+        while sum(node.indexed for node in nodes) < TOTAL_EVENTS:
+            loop.run_until_complete(asyncio.sleep(0.01))
+        done = time.monotonic()
+        watcher.cancel()
+
+    result = {
+        "scenario": name,
+        "feed_s": round(finished - began, 2),
+        "behind_s": round(done - finished, 2),
+        "peak_in_flight": peak[0],
+    }
+    for number, node in enumerate(nodes):
+        result[f"node{number}_requests"] = node.requests
+        if node._runner.server is not None:
+            loop.run_until_complete(node.close())
+
+    return result
+
+
+def main():
+    logger.remove()
+    for scenario in SCENARIOS:
+        result = run(*scenario)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+""" Queues synthetic Auth0 events in the batcher the way the receiver
+    does, as parsed and transformed events and as compact events, and
+    reports how much memory the queue takes per event. Each mode runs in
+    a process of its own, so RSS is measured from a clean start.
+
+    Also reports how fast events were queued, and how fast the queue
+    was emptied in sender-sized batches. Compact events are expanded and
+    transformed at that point.
+
+    Usage: python benchmarks/queue_memory.py [events] [--tracemalloc]
+
+    `--tracemalloc` also reports the Python heap allocated for the queue,
+    which takes several times longer.
+"""
+
+import asyncio
+import gc
+import multiprocessing
+import sys
+import time
+import tracemalloc
+
+from auth0_streams_elasticsearch.batcher import Batcher
+from auth0_streams_elasticsearch.compact import expand, pack
+from auth0_streams_elasticsearch.parsing import parse_logs
+from auth0_streams_elasticsearch.transform import LogTypeStage, Pipeline
+from loadgen import LogGenerator
+
+DELIVERY_SIZE = 100
+BATCH_SIZE = 5000
+
+
+def rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+    return 0
+
+
+async def fill(batcher: Batcher, events: int, compact: bool, pipeline: Pipeline) -> float:
+    generator = LogGenerator(seed=0)
+    elapsed = 0.0
+    for _ in range(events // DELIVERY_SIZE):
+        _, body = generator.delivery(DELIVERY_SIZE)
+        began = time.perf_counter()
+        parsed = parse_logs(body)
+        if compact:
+            queued, size = pack(parsed)
+        else:
+            await pipeline.run(parsed)
+            queued, size = parsed, len(body)
+        await batcher.insert_many(queued, size=size)
+        elapsed += time.perf_counter() - began
+
+    return elapsed
+
+
+async def empty(batcher: Batcher, compact: bool, pipeline: Pipeline) -> float:
+    began = time.perf_counter()
+    while batch := batcher.get_batch(BATCH_SIZE):
+        if compact:
+            expand(batch)
+            await pipeline.run(batch)
+
+    return time.perf_counter() - began
+
+
+def run(events: int, compact: bool, trace: bool, results):
+    pipeline = Pipeline([LogTypeStage()])
+    batcher = Batcher(queue_max_size=events)
+    loop = asyncio.new_event_loop()
+
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    rss_before = rss_kb()
+    fill_s = loop.run_until_complete(fill(batcher, events, compact, pipeline))
+    gc.collect()
+    rss_after = rss_kb()
+    heap = tracemalloc.get_traced_memory()[0] if trace else None
+    queued_bytes = batcher.stats()["queued_bytes"]
+    empty_s = loop.run_until_complete(empty(batcher, compact, pipeline))
+
+    results.put({
+        "mode": "compact" if compact else "dicts",
+        "events": events,
+        "rss_mb": round((rss_after - rss_before) / 1024),
+        "rss_bytes_per_event": round((rss_after - rss_before) * 1024 / events),
+        "heap_bytes_per_event": round(heap / events) if trace else None,
+        "serialized_bytes_per_event": round(queued_bytes / events),
+        "queue_events_per_s": round(events / fill_s),
+        "take_events_per_s": round(events / empty_s),
+    })
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    events = int(args[0]) if args else 1_000_000
+    trace = "--tracemalloc" in sys.argv
+
+    for compact in (False, True):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(events, compact, trace, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+""" Many small concurrent deliveries, as Auth0 sends at low volume per
+    tenant, queued one delivery at a time versus gathered by the ingest
+    coalescer, with and without a spool. The load comes from a separate
+    process, so the event loop lag measured is the receiver's own.
+
+    Reports deliveries per second, the mean and worst event loop lag
+    and how many deliveries each coalescer flush took on average.
+
+    Usage: python benchmarks/receiver_coalescing.py [deliveries]
+"""
+
+import asyncio
+import multiprocessing
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.metrics import INGEST_FLUSH_DELIVERIES
+from auth0_streams_elasticsearch.receiver import ReceiverService
+from loadgen import LogGenerator
+
+TOKEN = "benchmark"
+CONCURRENCY = 64
+EVENTS_PER_DELIVERY = 2
+LAG_INTERVAL = 0.01
+
+SCENARIOS = (
+    # name, coalesce_events, spool
+    ("direct", 0, False),
+    ("coalesced", 1000, False),
+    ("direct_spool", 0, True),
+    ("coalesced_spool", 1000, True),
+)
+
+
+def post_deliveries(url: str, deliveries: int, results):
+    """ Runs in a separate process: posts `deliveries` small deliveries
+        over `CONCURRENCY` connections and reports how long it took.
+    """
+
+    generator = LogGenerator(seed=0)
+    bodies = [generator.delivery(EVENTS_PER_DELIVERY)[1] for _ in range(deliveries)]
+    headers = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+
+    async def post(session: aiohttp.ClientSession):
+        while bodies:
+            async with session.post(url, data=bodies.pop(), headers=headers) as resp:
+                assert resp.status == 200, resp.status
+
+    async def load():
+        connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            began = time.perf_counter()
+            await asyncio.gather(*(post(session) for _ in range(CONCURRENCY)))
+            return time.perf_counter() - began
+
+    results.put(asyncio.run(load()))
+
+
+async def measure_lag(lags: list, stop: asyncio.Event):
+    loop = asyncio.get_event_loop()
+    while not stop.is_set():
+        began = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - began - LAG_INTERVAL))
+
+
+async def drain(batcher: Batcher, stop: asyncio.Event):
+    """ Stands in for the sender.
+    """
+
+    while not stop.is_set():
+        await batcher.wait_ready()
+        batcher.ack(batcher.get_batch(5000))
+
+
+def run(name: str, coalesce_events: int, spool: bool, deliveries: int) -> dict:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+
+    services = [
+        BatcherService(
+            queue_max_size=100_000,
+            flush_size=1000,
+            flush_after=0.1,
+            spool_directory=tempfile.mkdtemp() if spool else None,
+        ),
+        ReceiverService(sock=sock, bearer_token=TOKEN, coalesce_events=coalesce_events),
+    ]
+    flushes = INGEST_FLUSH_DELIVERIES.count
+    with aiomisc.entrypoint(*services, log_config=False) as loop:
+        context = aiomisc.get_context()
+        batcher: Batcher = loop.run_until_complete(context["batcher"])
+        stop = asyncio.Event()
+        lags = []
+        tasks = [loop.create_task(measure_lag(lags, stop)), loop.create_task(drain(batcher, stop))]
+
+        results = multiprocessing.Queue()
+        client = multiprocessing.Process(target=post_deliveries, args=(url, deliveries, results))
+        client.start()
+        while results.empty():
+            loop.run_until_complete(asyncio.sleep(0.05))
+        elapsed = results.get()
+        client.join()
+
+        stop.set()
+        batcher.wake()
+        loop.run_until_complete(asyncio.wait(tasks))
+        accepted = batcher.accepted
+
+    flushes = INGEST_FLUSH_DELIVERIES.count - flushes
+    assert accepted == deliveries * EVENTS_PER_DELIVERY, accepted
+    return {
+        "scenario": name,
+        "deliveries_per_s": round(deliveries / elapsed),
+        "loop_lag_mean_ms": round(sum(lags) / len(lags) * 1000, 2),
+        "loop_lag_max_ms": round(max(lags) * 1000, 2),
+        "deliveries_per_flush": round(deliveries / flushes, 1) if flushes else None,
+    }
+
+
+def main():
+    deliveries = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    logger.remove()
+    for scenario in SCENARIOS:
+        result = run(*scenario, deliveries)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+""" Measures peak RSS growth and the longest event loop stall while the
+    receiver handles 1MB and 10MB Auth0 deliveries, for the old buffered
+    `request.json()` parse, the streaming parser and the thread-pool
+    offload. Each case runs in a fresh subprocess so peak RSS is its own.
+
+    Usage: python benchmarks/receiver_large_payloads.py
+"""
+
+import asyncio
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import aiomisc
+import ujson
+from aiohttp import web
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.receiver import ReceiverService
+
+TOKEN = "benchmark"
+MODES = ("buffered", "streaming", "offload")
+SIZES_MB = (1, 10)
+
+
+class BufferedReceiverService(ReceiverService):
+    """ The receiver as it parsed bodies before streaming was added.
+    """
+
+    async def receive_streaming(self, request: web.Request) -> int:
+        events = await request.json(loads=ujson.loads)
+        return await self.queue_events(events["logs"], request.content_length)
+
+
+def make_body(size_mb: int) -> bytes:
+    event = {
+        "log_id": "",
+        "data": {
+            "date": "2020-01-01T00:00:00.000Z",
+            "type": "s",
+            "client_id": "AaiyAPdpYdesoKnqjj8HJqRn4T5titww",
+            "ip": "203.0.113.5",
+            "user_agent": "Mozilla/5.0 (X11; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0",
+            "details": {"prompts": [{"name": "lock-password-authenticate", "elapsedTime": 120}]},
+        },
+    }
+    count = size_mb * 1024 * 1024 // len(ujson.dumps(event))
+    return ujson.dumps({"logs": [
+        {**event, "log_id": str(n)} for n in range(count)
+    ]}).encode()
+
+
+async def ticker(lag: list):
+    while True:
+        began = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lag[0] = max(lag[0], time.perf_counter() - began - 0.001)
+
+
+async def run(url: str, body: bytes, context) -> dict:
+    batcher: Batcher = await context["batcher"]
+    lag = [0.0]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tick = asyncio.ensure_future(ticker(lag))
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=body, headers={
+            "Authorization": f"Bearer {TOKEN}",
+            "Content-Type": "application/json",
+        }) as resp:
+            assert resp.status == 200, resp.status
+    tick.cancel()
+
+    return {
+        "events": batcher.remaining(),
+        "peak_rss_growth_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024,
+        "max_loop_stall_ms": lag[0] * 1000,
+    }
+
+
+def child(mode: str, size_mb: int):
+    logger.remove()
+    body = make_body(size_mb)
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+
+    receiver_class = BufferedReceiverService if mode == "buffered" else ReceiverService
+    services = [
+        BatcherService(queue_max_size=10 ** 6),
+        receiver_class(
+            sock=sock,
+            bearer_token=TOKEN,
+            parse_offload_size=0 if mode == "offload" else 10 ** 9,
+        ),
+    ]
+    with aiomisc.entrypoint(*services, log_config=False) as loop:
+        result = loop.run_until_complete(run(url, body, aiomisc.get_context()))
+
+    print(f"{mode} {size_mb}MB", " ".join(f"{k}={v:.1f}" for k, v in result.items()))
+
+
+def main():
+    if len(sys.argv) == 3:
+        return child(sys.argv[1], int(sys.argv[2]))
+
+    for size_mb in SIZES_MB:
+        for mode in MODES:
+            subprocess.run([sys.executable, __file__, mode, str(size_mb)], check=True)
+
+
+if __name__ == "__main__":
+    main()
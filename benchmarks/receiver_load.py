@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+""" Pushes a burst of Auth0 deliveries through `ReceiverService.handler`
+    into a small batcher queue, retrying on 429 the way Auth0 does, and
+    checks that every event sent was queued exactly once.
+
+    Usage: python benchmarks/receiver_load.py [total_events]
+"""
+
+import asyncio
+import socket
+import sys
+import time
+
+import aiohttp
+import aiomisc
+import ujson
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.receiver import ReceiverService
+
+TOKEN = "benchmark"
+EVENTS_PER_REQUEST = 100
+CONCURRENCY = 32
+QUEUE_MAX_SIZE = 2000
+DRAIN_BATCH = 500
+
+
+def make_delivery(start: int) -> bytes:
+    return ujson.dumps({"logs": [
+        {"log_id": str(n), "data": {"type": "s", "date": "2020-01-01T00:00:00.000Z"}}
+        for n in range(start, start + EVENTS_PER_REQUEST)
+    ]}).encode()
+
+
+async def drain(batcher: Batcher, seen: set, stop: asyncio.Event):
+    """ Stands in for the sender, pulling batches as fast as possible.
+    """
+
+    while not stop.is_set() or not batcher.is_empty():
+        batch = batcher.get_batch(DRAIN_BATCH)
+        seen.update(event["log_id"] for event in batch)
+        await asyncio.sleep(0)
+
+
+async def post(session: aiohttp.ClientSession, url: str, body: bytes, counters: dict):
+    while True:
+        async with session.post(url, data=body, headers={
+            "Authorization": f"Bearer {TOKEN}",
+            "Content-Type": "application/json",
+        }) as resp:
+            if resp.status == 200:
+                return
+            assert resp.status == 429, resp.status
+            assert resp.headers["Retry-After"]
+            counters["retried"] += 1
+        await asyncio.sleep(0.01)
+
+
+async def run(url: str, total: int, context) -> dict:
+    batcher: Batcher = await context["batcher"]
+    seen: set = set()
+    stop = asyncio.Event()
+    drainer = asyncio.ensure_future(drain(batcher, seen, stop))
+    counters = {"retried": 0}
+
+    bodies = [make_delivery(start) for start in range(0, total, EVENTS_PER_REQUEST)]
+    connector = aiohttp.TCPConnector(limit=CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        began = time.perf_counter()
+        await asyncio.gather(*(post(session, url, body, counters) for body in bodies))
+        elapsed = time.perf_counter() - began
+
+    stop.set()
+    await drainer
+
+    sent = len(bodies) * EVENTS_PER_REQUEST
+    assert len(seen) == sent, f"lost {sent - len(seen)} events"
+    return {
+        "events": sent,
+        "events_per_s": sent / elapsed,
+        "requests_retried": counters["retried"],
+        **batcher.stats(),
+    }
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    logger.remove()
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    url = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+
+    services = [
+        BatcherService(queue_max_size=QUEUE_MAX_SIZE),
+        ReceiverService(sock=sock, bearer_token=TOKEN, insert_timeout=0.05, retry_after=1),
+    ]
+    with aiomisc.entrypoint(*services, log_config=False) as loop:
+        result = loop.run_until_complete(run(url, total, aiomisc.get_context()))
+
+    print(" ".join(f"{k}={v:.0f}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+""" Replays a large synthetic NDJSON file of Auth0 log events into a fake
+    Elasticsearch with the replay CLI, plain and gzipped, and reports the
+    wall time, events and megabytes per second and the peak RSS of the
+    replay and its worker processes.
+
+    The file is mostly events as archived or spilled, dated over a month
+    so they go to many daily indices, with some dead letters, bare Auth0
+    log export events and unreadable lines mixed in. The `resume`
+    scenarios interrupt a replay of the plain and the gzipped file once
+    a third of it has been indexed, in small chunks so most of the file
+    is still unread, and run it again from its checkpoint. They report how
+    much had been indexed when it was interrupted and where the
+    checkpoint had it resume from, and check that the checkpoint is
+    exactly at the last event indexed.
+
+    Each scenario checks that every event ended up indexed, and that
+    none was sent twice.
+    The fake Elasticsearch runs in a process of its own and only keeps
+    document IDs. It takes `LATENCY` over each bulk request, about what
+    a cluster takes over a few thousand documents.
+
+    Usage: python benchmarks/replay_throughput.py [megabytes] [--keep]
+"""
+
+import asyncio
+import datetime
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import ujson
+
+from e2e import rss_kb
+from fake_es import FakeElasticsearch
+from loadgen import LogGenerator
+from multicore_throughput import free_port, wait_for_port
+
+REPLAY = "from auth0_streams_elasticsearch.replay import main; main()"
+DAYS = 30
+# One in this many lines is a dead letter, and one a bare exported event
+WRAPPED_EVERY = 100
+UNREADABLE_EVERY = 100_000
+LATENCY = 0.2
+# Small chunks and few of them under way, so an interrupted replay
+# stops soon after the signal
+RESUME_ARGS = ["--workers", "1", "--chunk-size", str(1024 * 1024), "--in-flight", "4"]
+
+SCENARIOS = (
+    # name, gzipped, replay arguments
+    ("plain", False, ["--workers", "1"]),
+    ("plain_in_loop", False, ["--workers", "0"]),
+    ("plain_one_in_flight", False, ["--workers", "1", "--in-flight", "1"]),
+    ("gzip", True, ["--workers", "1"]),
+    ("resume", False, RESUME_ARGS),
+    ("resume_gzip", True, RESUME_ARGS),
+)
+
+
+def generate(path: str, size: int) -> int:
+    """ Writes at least `size` bytes of events to `path`. Returns how many
+        readable events there are.
+    """
+
+    generator = LogGenerator(seed=0)
+    first = datetime.datetime(2020, 1, 1)
+    events = 0
+    written = 0
+    with open(path, "w") as f:
+        while written < size:
+            event = generator.event()
+            # Spread over the month, like a backfill of it
+            seconds = generator.count * 7 % (DAYS * 86400)
+            event["data"]["date"] = (first + datetime.timedelta(seconds=seconds)).isoformat() + ".000Z"
+
+            if generator.count % UNREADABLE_EVERY == 0:
+                line = ujson.dumps(event)[:100]
+            elif generator.count % WRAPPED_EVERY == 0:
+                line = ujson.dumps({"event": event, "error": {"type": "es_rejected_execution_exception"}})
+                events += 1
+            elif generator.count % WRAPPED_EVERY == WRAPPED_EVERY // 2:
+                line = ujson.dumps(event["data"])
+                events += 1
+            else:
+                line = ujson.dumps(event)
+                events += 1
+
+            f.write(line)
+            f.write("\n")
+            written += len(line) + 1
+
+    return events
+
+
+def compress(path: str) -> str:
+    with open(path, "rb") as source, gzip.open(f"{path}.gz", "wb", compresslevel=1) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+    return f"{path}.gz"
+
+
+def events_before(path: str, offset: int) -> int:
+    """ Counts the readable events in the first `offset` bytes of the
+        plain file.
+    """
+
+    events = 0
+    with open(path, "rb") as f:
+        for line in f:
+            offset -= len(line)
+            if offset < 0:
+                break
+            try:
+                ujson.loads(line)
+            except ValueError:
+                continue
+            events += 1
+
+    return events
+
+
+def run_fake_es(port: int):
+    async def serve():
+        fake = FakeElasticsearch(latency=LATENCY, store_sources=False)
+        await fake.start(port=port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def fake_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_fake/stats") as response:
+        return json.load(response)
+
+
+def replay(path: str, args: list, env: dict, stop_after: float = None) -> dict:
+    """ Runs the replay CLI until it exits, or sends it SIGINT once
+        `stop_after` of the file has been indexed.
+    """
+
+    began = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-c", REPLAY, path, "--progress-interval", "1", *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    peak = 0
+    while process.poll() is None:
+        peak = max(peak, rss_kb(process.pid))
+        if stop_after is not None and fake_stats(int(env["FAKE_PORT"]))["indexed"] >= stop_after:
+            process.send_signal(signal.SIGINT)
+            stop_after = None
+        time.sleep(0.2)
+
+    return {"seconds": time.monotonic() - began, "peak_rss_mb": round(peak / 1024), "status": process.returncode}
+
+
+def run(name: str, path: str, events: int, args: list, directory: str) -> dict:
+    port = free_port()
+    fake = multiprocessing.Process(target=run_fake_es, args=(port,), daemon=True)
+    fake.start()
+    wait_for_port(port)
+
+    env = {
+        **os.environ,
+        "ELASTICSEARCH_HOSTS": f"http://127.0.0.1:{port}",
+        "ELASTICSEARCH_SSL_VERIFY": "false",
+        "LOG_LEVEL": "INFO",
+        "FAKE_PORT": str(port),
+    }
+    checkpoint = os.path.join(directory, f"{name}.checkpoint")
+    args = [*args, "--checkpoint", checkpoint, "--dead-letter", os.path.join(directory, f"{name}.dead")]
+
+    try:
+        if name.startswith("resume"):
+            first = replay(path, args, env, stop_after=events // 3)
+            interrupted_at = fake_stats(port)["indexed"]
+            with open(checkpoint) as f:
+                resumed_from = next(iter(json.load(f).values()))["offset"]
+            # Stopped partway, with every event before the checkpoint
+            # indexed and none after it
+            assert first["status"] == 1 and 0 < interrupted_at < events * 2 // 3, (first, interrupted_at)
+            assert events_before(path.replace(".gz", ""), resumed_from) == interrupted_at, resumed_from
+            second = replay(path, args, env)
+            seconds = first["seconds"] + second["seconds"]
+            peak = max(first["peak_rss_mb"], second["peak_rss_mb"])
+            status = (first["status"], second["status"])
+        else:
+            result = replay(path, args, env)
+            seconds, peak, status = result["seconds"], result["peak_rss_mb"], result["status"]
+        stats = fake_stats(port)
+    finally:
+        fake.terminate()
+        fake.join()
+
+    result = {
+        "scenario": name,
+        "seconds": round(seconds, 1),
+        "events_per_s": round(events / seconds),
+        "mb_per_s": round(os.path.getsize(path.replace(".gz", "")) / seconds / 1e6, 1),
+        "peak_rss_mb": peak,
+        "bulk_requests": stats["requests"],
+        "indexed": stats["indexed"],
+        "missing": events - stats["indexed"],
+        "resent": stats["received"] - stats["indexed"],
+        "exit_status": status,
+    }
+    assert result["missing"] == result["resent"] == 0, result
+    if name.startswith("resume"):
+        result.update(
+            interrupted_at=interrupted_at,
+            resumed_from_mb=round(resumed_from / 1e6),
+        )
+
+    return result
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    size = int(args[0] if args else 2048) * 1024 * 1024
+    directory = tempfile.mkdtemp(prefix="replay-benchmark-")
+    try:
+        plain = os.path.join(directory, "auth0-logs.ndjson")
+        began = time.monotonic()
+        events = generate(plain, size)
+        gzipped = compress(plain)
+        print(
+            f"generated {events} events, {os.path.getsize(plain) / 1e6:.0f} MB "
+            f"({os.path.getsize(gzipped) / 1e6:.0f} MB gzipped) in {time.monotonic() - began:.0f}s"
+        )
+
+        for name, compressed, replay_args in SCENARIOS:
+            result = run(name, gzipped if compressed else plain, events, replay_args, directory)
+            print(" ".join(f"{key}={value}" for key, value in result.items()))
+    finally:
+        if "--keep" in sys.argv:
+            print(f"kept {directory}")
+        else:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+""" Runs the batcher, client and sender against a fake Elasticsearch which
+    rejects and fails a share of bulk items, and checks that every event
+    ends up either indexed or in the dead-letter file.
+
+    Usage: python benchmarks/retry_partial_failures.py
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.sender import SenderService
+from fake_es import FakeElasticsearch
+
+TOTAL_EVENTS = 20_000
+INDEX = "auth0-events"
+
+
+async def run(fake: FakeElasticsearch, dead_letter_path: str, context) -> dict:
+    batcher: Batcher = await context["batcher"]
+
+    began = time.perf_counter()
+    for start in range(0, TOTAL_EVENTS, 100):
+        await batcher.insert_many(
+            {"log_id": str(n), "data": {"type": "s"}}
+            for n in range(start, start + 100)
+        )
+
+    dead = 0
+    while fake.indexed + dead < TOTAL_EVENTS:
+        await asyncio.sleep(0.05)
+        if os.path.exists(dead_letter_path):
+            with open(dead_letter_path) as f:
+                dead = sum(1 for _ in f)
+
+    return {
+        "seconds": time.perf_counter() - began,
+        "indexed": fake.indexed,
+        "dead_lettered": dead,
+        "bulk_requests": fake.requests,
+    }
+
+
+def main():
+    logger.remove()
+    dead_letter_path = os.path.join(tempfile.mkdtemp(), "dead-letter.ndjson")
+
+    loop = aiomisc.new_event_loop()
+    fake = FakeElasticsearch(reject_rate=0.2, error_rate=0.01, unavailable_rate=0.05, seed=1)
+    url = loop.run_until_complete(fake.start())
+
+    services = [
+        BatcherService(queue_max_size=TOTAL_EVENTS, flush_size=500, flush_after=0.1),
+        ClientService(username="", password="", hosts=url, index_name=INDEX, ssl_verify=False),
+        SenderService(
+            send_after_events=500,
+            retry_backoff_base=0.01,
+            retry_backoff_max=0.2,
+            dead_letter_path=dead_letter_path,
+        ),
+    ]
+    with aiomisc.entrypoint(*services, loop=loop, log_config=False):
+        result = loop.run_until_complete(run(fake, dead_letter_path, aiomisc.get_context()))
+
+    loop.run_until_complete(fake.close())
+
+    assert result["indexed"] + result["dead_lettered"] == TOTAL_EVENTS
+    print(" ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
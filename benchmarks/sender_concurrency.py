@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+""" Drives the sender against a fake Elasticsearch with injected latency,
+    comparing a bounded number of in-flight bulk requests against an
+    effectively unbounded one. Reports throughput, the most concurrent
+    bulk requests the server saw, and peak RSS during the run.
+
+    The fake only processes a few bulk requests at a time, so piling on
+    more requests only makes them queue, as with a real cluster.
+
+    Usage: python benchmarks/sender_concurrency.py [latency_seconds]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.sender import SenderService
+from fake_es import FakeElasticsearch
+
+TOTAL_EVENTS = 100_000
+EVENTS_PER_REQUEST = 100
+PRODUCERS = 16
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+async def produce(batcher: Batcher, start: int, step: int):
+    for offset in range(start, TOTAL_EVENTS, step):
+        await batcher.insert_many(
+            {"log_id": str(n), "data": {"type": "s", "description": "x" * 200}}
+            for n in range(offset, offset + EVENTS_PER_REQUEST)
+        )
+
+
+async def run(fake: FakeElasticsearch, context) -> dict:
+    batcher: Batcher = await context["batcher"]
+    peak = rss()
+
+    began = time.perf_counter()
+    step = EVENTS_PER_REQUEST * PRODUCERS
+    producers = asyncio.gather(*(
+        produce(batcher, n * EVENTS_PER_REQUEST, step) for n in range(PRODUCERS)
+    ))
+    while fake.indexed < TOTAL_EVENTS:
+        peak = max(peak, rss())
+        await asyncio.sleep(0.01)
+    await producers
+
+    return {
+        "events_per_s": TOTAL_EVENTS / (time.perf_counter() - began),
+        "max_in_flight": fake.max_in_flight,
+        "bulk_requests": fake.requests,
+        "peak_rss_mb": peak / 1024 / 1024,
+    }
+
+
+def bench(max_in_flight: int, queue_max_size: int, latency: float) -> dict:
+    loop = aiomisc.new_event_loop()
+    fake = FakeElasticsearch(latency=latency, workers=4)
+    url = loop.run_until_complete(fake.start())
+
+    services = [
+        BatcherService(queue_max_size=queue_max_size, flush_size=500, flush_after=0.05),
+        ClientService(
+            username="", password="", hosts=url, index_name="bench", ssl_verify=False,
+            pool_size=max_in_flight,
+        ),
+        SenderService(send_after_events=500, send_max_events=500, send_max_in_flight=max_in_flight),
+    ]
+    with aiomisc.entrypoint(*services, loop=loop, log_config=False):
+        result = loop.run_until_complete(run(fake, aiomisc.get_context()))
+
+    loop.run_until_complete(fake.close())
+    return result
+
+
+def main():
+    logger.remove()
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+
+    for name, max_in_flight, queue_max_size in (
+        ("bounded", 8, 10_000),
+        ("unbounded", 10_000, TOTAL_EVENTS),
+    ):
+        result = bench(max_in_flight, queue_max_size, latency)
+        print(name, " ".join(f"{k}={v:.1f}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+""" Compares the old 100ms polling sender loop against the event-driven
+    batcher wakeups: flush latency for a full batch, and CPU burned
+    while idle.
+
+    Usage: python benchmarks/sender_wakeup.py
+"""
+
+import asyncio
+import time
+
+from auth0_streams_elasticsearch.batcher import Batcher
+
+FLUSH_SIZE = 10
+FLUSH_AFTER = 5
+POLL_WAIT = 0.1
+ROUNDS = 50
+IDLE_SECONDS = 5
+
+
+async def polling_consumer(batcher: Batcher, flushed: asyncio.Queue, stop: asyncio.Event):
+    """ Reproduction of the previous `SenderService.start` polling loop.
+    """
+
+    begin = None
+    while not stop.is_set():
+        if not batcher.is_empty():
+            if begin is None:
+                begin = time.monotonic()
+                await asyncio.sleep(POLL_WAIT)
+                continue
+            if batcher.remaining() > FLUSH_SIZE - 1:
+                batcher.get_batch(FLUSH_SIZE)
+            elif time.monotonic() > (begin + FLUSH_AFTER):
+                batcher.get_batch(FLUSH_SIZE)
+            else:
+                await asyncio.sleep(POLL_WAIT)
+                continue
+            begin = None
+            flushed.put_nowait(time.perf_counter())
+        await asyncio.sleep(POLL_WAIT)
+
+
+async def event_consumer(batcher: Batcher, flushed: asyncio.Queue, stop: asyncio.Event):
+    while not stop.is_set():
+        await batcher.wait_ready()
+        if stop.is_set():
+            break
+        if batcher.get_batch(FLUSH_SIZE):
+            flushed.put_nowait(time.perf_counter())
+
+
+async def run(consumer) -> dict:
+    batcher = Batcher(queue_max_size=1000, flush_size=FLUSH_SIZE, flush_after=FLUSH_AFTER)
+    flushed: asyncio.Queue = asyncio.Queue()
+    stop = asyncio.Event()
+    task = asyncio.ensure_future(consumer(batcher, flushed, stop))
+
+    latencies = []
+    for _ in range(ROUNDS):
+        # Land the first events, then cross the threshold at a random
+        # point relative to the poll interval.
+        await batcher.insert_many({"n": n} for n in range(FLUSH_SIZE - 1))
+        await asyncio.sleep(POLL_WAIT * 0.37)
+        sent = time.perf_counter()
+        await batcher.insert({"n": FLUSH_SIZE})
+        latencies.append(await flushed.get() - sent)
+
+    cpu = time.process_time()
+    await asyncio.sleep(IDLE_SECONDS)
+    idle_cpu = time.process_time() - cpu
+
+    stop.set()
+    batcher.wake()
+    await asyncio.wait_for(task, POLL_WAIT * 2)
+
+    latencies.sort()
+    return {
+        "flush_p50_ms": latencies[len(latencies) // 2] * 1000,
+        "flush_max_ms": latencies[-1] * 1000,
+        "idle_cpu_ms_per_s": idle_cpu * 1000 / IDLE_SECONDS,
+    }
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    for name, consumer in (("polling", polling_consumer), ("event", event_consumer)):
+        result = loop.run_until_complete(run(consumer))
+        print(name, " ".join(f"{k}={v:.3f}" for k, v in result.items()))
+
+
+if __name__ == "__main__":
+    main()
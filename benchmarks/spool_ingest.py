@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+""" Compares batcher ingest throughput with and without the on-disk spool.
+    Concurrent writers stand in for receiver requests, and a drain task
+    stands in for the sender, acknowledging every batch it takes.
+
+    Usage: python benchmarks/spool_ingest.py [spool_directory]
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher
+from auth0_streams_elasticsearch.spool import Spool
+
+TOTAL_EVENTS = 200_000
+EVENTS_PER_REQUEST = 100
+CONCURRENCY = 64
+DRAIN_BATCH = 500
+
+EVENT = {
+    "log_id": "90020200101000000000000000000000000000000000000000000000",
+    "data": {
+        "date": "2020-01-01T00:00:00.000Z",
+        "type": "s",
+        "client_id": "AaiyAPdpYdesoKnqjj8HJqRn4T5titww",
+        "ip": "203.0.113.5",
+        "user_agent": "Mozilla/5.0 (X11; Linux x86_64) Firefox/72.0",
+        "details": {"prompts": [], "initiatedAt": 1577836800000},
+    },
+}
+
+
+async def writer(batcher: Batcher, requests: int):
+    for _ in range(requests):
+        await batcher.insert_many([EVENT] * EVENTS_PER_REQUEST)
+
+
+async def drain(batcher: Batcher, stop: asyncio.Event):
+    while not stop.is_set() or not batcher.is_empty():
+        batch = batcher.get_batch(DRAIN_BATCH)
+        batcher.ack(batch)
+        await asyncio.sleep(0)
+
+
+async def run(spool: Spool = None) -> float:
+    if spool is not None:
+        spool.open()
+
+    batcher = Batcher(queue_max_size=TOTAL_EVENTS, spool=spool)
+    stop = asyncio.Event()
+    drainer = asyncio.ensure_future(drain(batcher, stop))
+
+    requests = TOTAL_EVENTS // EVENTS_PER_REQUEST // CONCURRENCY
+    began = time.perf_counter()
+    await asyncio.gather(*(writer(batcher, requests) for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - began
+
+    stop.set()
+    await drainer
+    if spool is not None:
+        await spool.close()
+
+    return requests * CONCURRENCY * EVENTS_PER_REQUEST / elapsed
+
+
+def main():
+    logger.remove()
+    directory = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+
+    memory = loop.run_until_complete(run())
+    spooled = loop.run_until_complete(run(Spool(directory, segment_size=8 * 1024 * 1024)))
+
+    print(f"memory events_per_s={memory:.0f}")
+    print(f"spool events_per_s={spooled:.0f} ratio={spooled / memory:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+""" Starts the client against a fake Elasticsearch whose cluster state
+    updates (putting a template, creating an index) take
+    `CREATE_LATENCY`, with the index template missing, up to date, up
+    to date and cached locally, and out of date. Reports how long
+    startup took and which requests it made.
+
+    Then writes the first batch of the next day's events, with and
+    without indices pre-created, and reports how long that took.
+
+    Usage: python benchmarks/template_bootstrap.py
+"""
+
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import aiomisc
+from loguru import logger
+
+from auth0_streams_elasticsearch.client import Client, ClientService
+from fake_es import FakeElasticsearch
+
+INDEX = "auth0-events-%Y.%m.%d"
+TEMPLATE = "auth0-events"
+CREATE_LATENCY = 0.2
+
+SCENARIOS = (
+    # name, what to do to the cluster's template first, use the cache
+    # (written by the up to date start, read by the cached one)
+    ("missing", None, False),
+    ("up_to_date", None, True),
+    ("cached", None, True),
+    ("out_of_date", "bump", False),
+)
+
+
+def start(loop, url: str, cache_path: str, template: bool = True):
+    service = ClientService(
+        username="", password="", hosts=url, index_name=INDEX, ssl_verify=False,
+        template_name=TEMPLATE if template else "",
+        template_cache_path=cache_path,
+    )
+    return aiomisc.entrypoint(service, loop=loop, log_config=False)
+
+
+def startup(loop, fake: FakeElasticsearch, url: str, name: str, change, cache: bool, cache_path: str) -> dict:
+    if change == "bump":
+        fake.templates[TEMPLATE]["version"] = 1
+    fake.admin_requests.clear()
+
+    began = time.perf_counter()
+    with start(loop, url, cache_path if cache else ""):
+        elapsed = time.perf_counter() - began
+
+    mappings = fake.templates[TEMPLATE]["template"]["mappings"]["properties"]
+    assert mappings["type"]["type"] == mappings["ip"]["type"] == "keyword", mappings
+    assert mappings["details"]["dynamic"] is False, mappings
+    return {"scenario": name, "startup_s": round(elapsed, 3), **fake.admin_requests}
+
+
+def first_write(loop, template: bool) -> dict:
+    fake = FakeElasticsearch(create_latency=CREATE_LATENCY)
+    url = loop.run_until_complete(fake.start())
+    tomorrow = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%dT00:00:01.000Z")
+    events = [
+        {"log_id": str(n), "data": {"type": "s", "date": tomorrow}}
+        for n in range(1000)
+    ]
+
+    with start(loop, url, "", template=template) as loop:
+        client: Client = loop.run_until_complete(aiomisc.get_context()["client"])
+        began = time.perf_counter()
+        loop.run_until_complete(client.send(events))
+        elapsed = time.perf_counter() - began
+
+    loop.run_until_complete(fake.close())
+    return {
+        "scenario": "first_write_precreated" if template else "first_write",
+        "first_bulk_s": round(elapsed, 3),
+    }
+
+
+def main():
+    logger.remove()
+    loop = aiomisc.new_event_loop()
+    fake = FakeElasticsearch(create_latency=CREATE_LATENCY)
+    url = loop.run_until_complete(fake.start())
+    cache_path = os.path.join(tempfile.mkdtemp(), "templates.json")
+
+    for scenario in SCENARIOS:
+        result = startup(loop, fake, url, *scenario, cache_path)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+    loop.run_until_complete(fake.close())
+
+    for template in (False, True):
+        result = first_write(loop, template)
+        print(" ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
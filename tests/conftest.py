@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+# The fake Elasticsearch is shared with the benchmarks
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks"))
+
+from fake_es import FakeElasticsearch  # noqa: E402
+
+
+class FakeElasticsearchThread:
+    """ Runs a `FakeElasticsearch` on an event loop of its own, so it can
+        be started before the services under test are.
+    """
+
+    def __init__(self, **options):
+        self.loop = asyncio.new_event_loop()
+        self.options = options
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self) -> FakeElasticsearch:
+        self.thread.start()
+        self.fake = self.call(self._create())
+        self.call(self.fake.start())
+        self.port = int(self.fake.url.rsplit(":", 1)[1])
+        return self.fake
+
+    def pause(self):
+        """ Stops serving, as a node going down does.
+        """
+
+        self.call(self.fake.close())
+
+    def resume(self):
+        """ Serves again on the same port.
+        """
+
+        self.call(self.fake.start(port=self.port))
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(10)
+
+    def stop(self):
+        self.call(self.fake.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _create(self) -> FakeElasticsearch:
+        # Its semaphore must belong to the loop it runs on
+        return FakeElasticsearch(**self.options)
+
+
+@pytest.fixture
+def fake_es_options() -> dict:
+    return {}
+
+
+class FakeElasticsearchFactory:
+    """ Starts fake Elasticsearch clusters (or nodes) with the given
+        options when called, and can take them down and bring them back.
+    """
+
+    def __init__(self):
+        self.runners = {}
+
+    def __call__(self, **options) -> FakeElasticsearch:
+        runner = FakeElasticsearchThread(**options)
+        fake = runner.start()
+        self.runners[fake] = runner
+        return fake
+
+    def pause(self, fake: FakeElasticsearch):
+        self.runners[fake].pause()
+
+    def resume(self, fake: FakeElasticsearch):
+        self.runners[fake].resume()
+
+    def stop(self):
+        for runner in self.runners.values():
+            runner.stop()
+
+
+@pytest.fixture
+def fake_es_factory():
+    """ Starts fake Elasticsearch clusters, and stops them after the test.
+    """
+
+    factory = FakeElasticsearchFactory()
+    yield factory
+    factory.stop()
+
+
+@pytest.fixture
+def fake_es(fake_es_factory, fake_es_options):
+    return fake_es_factory(**fake_es_options)
+
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from auth0_streams_elasticsearch.batcher import COALESCE_SIZE, Batcher
+from auth0_streams_elasticsearch.spool import Spool
+
+
+def events(start: int, count: int) -> list:
+    return [{"log_id": str(n)} for n in range(start, start + count)]
+
+
+def ids(batch: list) -> list:
+    return [int(event["log_id"]) for event in batch]
+
+
+async def test_small_inserts_are_coalesced_into_the_last_chunk():
+    batcher = Batcher(queue_max_size=10_000)
+    for n in range(10):
+        await batcher.insert_many(events(n, 1), size=10)
+
+    assert len(batcher._chunks) == 1
+    assert batcher.stats()["queued_bytes"] == 100
+
+    # Until the last chunk is full enough
+    await batcher.insert_many(events(10, COALESCE_SIZE), size=10)
+    await batcher.insert_many(events(10 + COALESCE_SIZE, 1), size=10)
+    assert len(batcher._chunks) == 2
+    assert ids(batcher.get_batch(10_000)) == list(range(11 + COALESCE_SIZE))
+
+
+async def test_whole_chunk_is_handed_out_as_is():
+    batcher = Batcher(queue_max_size=10_000)
+    inserted = events(0, 300)
+    await batcher.insert_many(inserted)
+    chunk = batcher._chunks[0].events
+
+    assert batcher.get_batch(300) is chunk
+
+
+async def test_chunk_is_split_by_max_events():
+    batcher = Batcher(queue_max_size=10_000)
+    await batcher.insert_many(events(0, 300))
+    await batcher.insert_many(events(300, 300))
+
+    assert ids(batcher.get_batch(100)) == list(range(100))
+    # The rest of the first chunk and the start of the next
+    assert ids(batcher.get_batch(250)) == list(range(100, 350))
+    assert batcher.remaining() == 250
+    assert ids(batcher.get_batch(1000)) == list(range(350, 600))
+    assert batcher.is_empty()
+
+
+async def test_chunk_is_split_by_bytes_at_its_average_event_size():
+    batcher = Batcher(queue_max_size=10_000)
+    await batcher.insert_many(events(0, 300), size=30_000)
+    await batcher.insert_many(events(300, 300), size=60_000)
+
+    # 100 bytes each in the first chunk
+    assert ids(batcher.get_batch(1000, max_bytes=1050)) == list(range(10))
+    # The rest of the first, then 200 bytes each in the second
+    assert ids(batcher.get_batch(1000, max_bytes=30_000)) == list(range(10, 305))
+    # At least one event, however small the budget
+    assert ids(batcher.get_batch(1000, max_bytes=1)) == [305]
+
+
+async def test_bytes_are_accounted_after_partial_pops():
+    batcher = Batcher(queue_max_size=10_000)
+    await batcher.insert_many(events(0, 300), size=3000)
+    await batcher.insert_many(events(300, 300), size=6000)
+
+    batcher.get_batch(100)
+    assert batcher.stats()["queued_bytes"] == 8000
+    batcher.get_batch(7)
+    assert batcher.stats()["queued_bytes"] == 7930
+    batcher.get_batch(193)
+    assert batcher.stats()["queued_bytes"] == 6000
+    batcher.get_batch(299)
+    assert batcher.stats()["queued_bytes"] == 20
+    batcher.get_batch(1)
+    assert batcher.stats() == {
+        "queued": 0, "queued_bytes": 0, "accepted": 600, "delayed": 0, "dropped": 0, "popped": 600,
+    }
+
+
+async def test_insert_nowait_queues_only_if_there_is_room():
+    batcher = Batcher(queue_max_size=10, queue_max_bytes=1000)
+
+    assert batcher.insert_nowait(events(0, 8), size=800)
+    assert not batcher.insert_nowait(events(8, 3), size=30)
+    assert not batcher.insert_nowait(events(8, 2), size=300)
+    assert batcher.insert_nowait(events(8, 2), size=200)
+    assert ids(batcher.get_batch(100)) == list(range(10))
+    assert batcher.stats()["accepted"] == 10
+
+
+async def test_insert_nowait_refuses_with_a_spool(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.open()
+    batcher = Batcher(queue_max_size=10, spool=spool)
+
+    assert not batcher.insert_nowait(events(0, 1))
+    assert batcher.is_empty()
+    await spool.close()
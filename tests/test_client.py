@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+
+import aiomisc
+import pytest
+from aioelasticsearch.connection import AIOHttpConnection
+
+from auth0_streams_elasticsearch.client import ClientService
+
+
+@pytest.fixture
+def compression() -> str:
+    return "none"
+
+
+@pytest.fixture
+def services(fake_es, compression):
+    return [
+        ClientService(
+            username="", password="", hosts=fake_es.url, index_name="auth0",
+            ssl_verify=False, compression=compression,
+        ),
+    ]
+
+
+@pytest.fixture
+async def client():
+    return await aiomisc.get_context()["client"]
+
+
+@pytest.fixture
+def sent(monkeypatch) -> list:
+    """ The bodies of the bulk requests, as they go on the wire.
+    """
+
+    bodies = []
+    perform_request = AIOHttpConnection.perform_request
+
+    async def record(self, method, url, params=None, body=None, **kwargs):
+        if url.endswith("/_bulk"):
+            bodies.append(body)
+        return await perform_request(self, method, url, params, body, **kwargs)
+
+    monkeypatch.setattr(AIOHttpConnection, "perform_request", record)
+    return bodies
+
+
+def events(count: int) -> list:
+    return [{"log_id": str(n), "data": {"type": "s"}} for n in range(count)]
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+async def test_bulk_body_is_sent_as_prepared(client, fake_es, sent, compression):
+    _, body = await client.prepare(events(10))
+
+    response = await client.bulk(body)
+
+    assert not response["errors"]
+    assert sent == [body]
+    assert body.endswith(b"\n") if compression == "none" else gzip.decompress(body).endswith(b"\n")
+    assert len(fake_es.docs["auth0"]) == 10
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import ujson
+
+from auth0_streams_elasticsearch.batcher import Batcher
+from auth0_streams_elasticsearch.compact import CompactEvent, expand, pack
+from auth0_streams_elasticsearch.spill import take_spill, write_spill
+from auth0_streams_elasticsearch.spool import Spool
+
+EVENTS = [
+    {"log_id": "1", "data": {"type": "s", "description": "Zürich ✓", "details": {"n": 1.5, "ok": True}}},
+    {"log_id": "2", "data": {"type": "f", "description": None, "scope": ["openid", "email"]}},
+]
+
+
+def test_pack_measures_the_serialized_events():
+    packed, size = pack(EVENTS)
+
+    assert all(type(event) is CompactEvent for event in packed)
+    assert size == len(ujson.dumps(EVENTS)) - len("[,]") == sum(len(event.raw.encode()) for event in packed)
+    # Non-ASCII is escaped, for one byte per character
+    assert all(event.raw.isascii() for event in packed)
+
+
+def test_compact_events_serialize_as_their_text():
+    packed, _ = pack(EVENTS)
+
+    assert ujson.dumps(packed) == ujson.dumps(EVENTS)
+    assert ujson.loads(ujson.dumps({"event": packed[0]})) == {"event": EVENTS[0]}
+
+
+def test_expand_in_place():
+    packed, _ = pack(EVENTS)
+    batch = [packed[0], {"log_id": "plain"}, packed[1]]
+
+    assert expand(batch)
+    assert batch == [EVENTS[0], {"log_id": "plain"}, EVENTS[1]]
+    assert not expand(batch)
+
+
+async def test_round_trip_through_the_batcher_and_spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    spool.open()
+    batcher = Batcher(queue_max_size=10, spool=spool, queue_max_bytes=10_000)
+    packed, size = pack(EVENTS)
+
+    await batcher.insert_many(packed, size=size)
+    assert batcher.stats()["queued_bytes"] == size
+
+    batch = batcher.get_batch(10)
+    assert expand(batch)
+    assert batch == EVENTS
+    await spool.close()
+
+    # Replayed unacked from the spool as plain events
+    assert Spool(str(tmp_path / "spool")).open()[0][1] == EVENTS
+
+
+def test_round_trip_through_a_spill(tmp_path):
+    path = str(tmp_path / "spill.ndjson")
+    packed, _ = pack(EVENTS)
+
+    write_spill(path, packed)
+
+    assert take_spill(path) == EVENTS
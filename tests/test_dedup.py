@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from auth0_streams_elasticsearch.dedup import HASH_MASK, BloomFilter, DedupCache, HashSet
+from auth0_streams_elasticsearch.metrics import DEDUP_HITS, DEDUP_MISSES
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def events(*log_ids: str) -> list:
+    return [{"log_id": log_id} for log_id in log_ids]
+
+
+def ids(events: list) -> list:
+    return [event["log_id"] for event in events]
+
+
+def key(log_id: str) -> int:
+    return hash(log_id) & HASH_MASK
+
+
+def test_hash_set_membership():
+    keys = HashSet()
+    keys.add(key("a"))
+
+    assert key("a") in keys
+    assert key("b") not in keys
+    assert len(keys) == 1
+
+
+def test_bloom_filter_membership():
+    bloom = BloomFilter(10_000, 0.01)
+    for n in range(10_000):
+        bloom.add(key(f"in-{n}"))
+
+    assert len(bloom) == 10_000
+    assert all(key(f"in-{n}") in bloom for n in range(10_000))
+    false_positives = sum(key(f"out-{n}") in bloom for n in range(10_000))
+    assert false_positives < 300
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        DedupCache(mode="fuzzy")
+
+
+@pytest.mark.parametrize("mode", ["exact", "bloom"])
+def test_drops_queued_ids_and_repeats_within_a_delivery(mode):
+    cache = DedupCache(mode=mode)
+
+    unseen = cache.unseen(events("a", "b", "a"))
+    assert ids(unseen) == ["a", "b"]
+    cache.add(unseen)
+
+    assert ids(cache.unseen(events("b", "c"))) == ["c"]
+
+
+def test_ids_being_queued_are_dropped():
+    cache = DedupCache()
+
+    assert ids(cache.unseen(events("a"))) == ["a"]
+    # Redelivered before the first delivery was queued
+    assert cache.unseen(events("a")) == []
+
+
+def test_rejected_delivery_is_not_remembered():
+    cache = DedupCache()
+
+    cache.release(cache.unseen(events("a", "b")))
+
+    assert ids(cache.unseen(events("a", "b"))) == ["a", "b"]
+    assert len(cache) == 0
+
+
+def test_ids_are_forgotten_after_two_windows():
+    clock = Clock()
+    cache = DedupCache(window=10, clock=clock)
+    cache.add(cache.unseen(events("a")))
+
+    # Rotated into the previous generation, still remembered
+    clock.now = 10
+    cache.add(cache.unseen(events("b")))
+    assert cache.unseen(events("a", "b")) == []
+
+    clock.now = 20
+    cache.add(cache.unseen(events("c")))
+    assert ids(cache.unseen(events("a", "b", "c"))) == ["a"]
+
+
+def test_ids_are_forgotten_past_max_size():
+    cache = DedupCache(max_size=4)
+    for log_id in "abcde":
+        cache.add(cache.unseen(events(log_id)))
+
+    # Generations of two: "a" and "b" were dropped to make room for "e"
+    assert len(cache) == 3
+    assert ids(cache.unseen(events(*"abcde"))) == ["a", "b"]
+
+
+def test_counts_hits_and_misses():
+    cache = DedupCache()
+    hits = DEDUP_HITS.value
+    misses = DEDUP_MISSES.value
+
+    cache.add(cache.unseen(events("a", "b", "a")))
+    cache.unseen(events("a", "c"))
+
+    assert DEDUP_HITS.value - hits == 2
+    assert DEDUP_MISSES.value - misses == 3
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+from loguru import logger
+
+from auth0_streams_elasticsearch.batcher import Batcher, BatcherFull
+from auth0_streams_elasticsearch.ingest import IngestCoalescer, IngestFailed
+
+
+@pytest.fixture
+def records():
+    records = []
+    handler = logger.add(lambda message: records.append(message.record), level="DEBUG")
+    yield records
+    logger.remove(handler)
+
+
+def submissions(coalescer: IngestCoalescer, *log_ids: str) -> list:
+    return [coalescer.submit([{"log_id": log_id}]) for log_id in log_ids]
+
+
+async def test_batch_failure_retries_each_delivery(records):
+    calls = []
+
+    async def ingest(events, size, timeout):
+        calls.append(events)
+        if len(events) > 1:
+            raise RuntimeError("batch")
+
+    coalescer = IngestCoalescer(ingest)
+    futures = submissions(coalescer, "a", "b")
+    await coalescer.flush(coalescer._take())
+
+    assert calls == [[{"log_id": "a"}, {"log_id": "b"}], [{"log_id": "a"}], [{"log_id": "b"}]]
+    assert all(future.result() is None for future in futures)
+    assert [record["level"].name for record in records] == ["ERROR", "INFO"]
+    assert "queued on their own" in records[-1]["message"]
+
+
+async def test_failed_deliveries_are_logged(records):
+    async def ingest(events, size, timeout):
+        if len(events) > 1 or events[0]["log_id"] == "b":
+            raise RuntimeError("bad")
+
+    coalescer = IngestCoalescer(ingest)
+    futures = submissions(coalescer, "a", "b")
+    await coalescer.flush(coalescer._take())
+
+    assert futures[0].result() is None
+    assert isinstance(futures[1].exception(), IngestFailed)
+    assert [record["level"].name for record in records] == ["ERROR", "ERROR"]
+    assert records[-1]["message"].startswith("1 of 2 deliveries")
+
+
+async def test_staged_deliveries_wait_one_timeout_in_all():
+    batcher = Batcher(queue_max_size=1)
+    await batcher.insert({"log_id": "full"})
+
+    async def ingest(events, size, timeout):
+        await batcher.insert_many(events, timeout=timeout)
+
+    # Every delivery a batch of its own, each waiting on the one before
+    coalescer = IngestCoalescer(ingest, max_events=1)
+    coalescer.start()
+    loop = asyncio.get_event_loop()
+    began = loop.time()
+    futures = []
+    for log_id in "abcd":
+        futures.append(coalescer.submit([{"log_id": log_id}], timeout=0.2))
+        await asyncio.sleep(0.01)
+
+    await asyncio.wait(futures)
+    assert loop.time() - began < 0.35
+    assert all(isinstance(future.exception(), BatcherFull) for future in futures)
+    await coalescer.close()
+
+
+async def test_staged_delivery_is_queued_once_there_is_room():
+    batcher = Batcher(queue_max_size=1)
+    await batcher.insert({"log_id": "full"})
+
+    async def ingest(events, size, timeout):
+        await batcher.insert_many(events, timeout=timeout)
+
+    coalescer = IngestCoalescer(ingest)
+    coalescer.start()
+    future = coalescer.submit([{"log_id": "a"}], timeout=1)
+    await asyncio.sleep(0.05)
+    batcher.ack(batcher.get_batch(1))
+
+    await asyncio.wait_for(future, 1)
+    assert [event["log_id"] for event in batcher.get_batch(1)] == ["a"]
+    await coalescer.close()
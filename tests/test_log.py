@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+from loguru import logger
+
+from auth0_streams_elasticsearch.log import BackgroundSink
+
+
+class BrokenStream(io.StringIO):
+    def write(self, text: str) -> int:
+        raise OSError("EPIPE")
+
+
+def log_to(sink: BackgroundSink, count: int):
+    handler = logger.add(sink.write, format="{message}", level="INFO")
+    for n in range(count):
+        logger.info(f"message {n}")
+    logger.remove(handler)
+
+
+def test_messages_are_written_in_batches():
+    stream = io.StringIO()
+    sink = BackgroundSink(stream, flush_interval=60)
+
+    log_to(sink, 3)
+    sink.stop()
+
+    assert len(stream.getvalue().splitlines()) == 3
+    assert sink.dropped == 0
+
+
+def test_messages_the_stream_fails_to_take_are_counted():
+    sink = BackgroundSink(BrokenStream(), flush_interval=0.01, max_pending=4)
+
+    log_to(sink, 6)
+    sink._stopped = True
+    sink._wake.set()
+    sink._thread.join()
+
+    # Those over the limit, and those lost with the failed writes
+    assert sink.dropped == 6
+    assert not sink._pending
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from auth0_streams_elasticsearch.metrics import LOOP_LAG, LoopLagService
+
+
+async def test_loop_lag_service_stops_its_task():
+    service = LoopLagService(interval=0.01)
+    service.set_loop(asyncio.get_event_loop())
+    count = LOOP_LAG.count
+
+    await service.start()
+    await asyncio.sleep(0.05)
+    await service.stop()
+
+    assert LOOP_LAG.count > count
+    assert service._task.done()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from collections import Counter
+
+import pytest
+from elasticsearch.exceptions import ConnectionError
+
+from auth0_streams_elasticsearch.nodes import NodeHealth
+
+
+class FakeConnection:
+    """ Answers probes, or fails them while `failing` is set.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.failing = False
+        self.probes = 0
+
+    async def perform_request(self, method, url, timeout=None):
+        self.probes += 1
+        if self.failing:
+            raise ConnectionError("N/A", "refused", None)
+
+
+def health(*hosts: str, **options) -> NodeHealth:
+    health = NodeHealth(asyncio.get_event_loop(), **options)
+    health.set_connections([FakeConnection(host) for host in hosts])
+    return health
+
+
+def respond(health: NodeHealth, connection, elapsed: float, ok: bool = True):
+    stats = health.begin(connection)
+    if ok:
+        health.succeeded(connection, stats, elapsed)
+    else:
+        health.failed(connection, stats, elapsed)
+
+
+def picks(health: NodeHealth, times: int = 100) -> Counter:
+    return Counter(health.select().host for _ in range(times))
+
+
+async def test_latency_is_a_moving_average():
+    nodes = health("a", alpha=0.5)
+    connection = nodes.select()
+
+    respond(nodes, connection, 0.1)
+    assert nodes.nodes["a"].latency == pytest.approx(0.1)
+    respond(nodes, connection, 0.3)
+    assert nodes.nodes["a"].latency == pytest.approx(0.2)
+    # A fast failure counts as twice the average, not as fast
+    respond(nodes, connection, 0.001, ok=False)
+    assert nodes.nodes["a"].latency == pytest.approx(0.3)
+    assert nodes.nodes["a"].in_flight == 0
+
+
+async def test_faster_node_is_picked():
+    nodes = health("slow", "fast")
+    slow, fast = nodes._connections
+    respond(nodes, slow, 0.1)
+    respond(nodes, fast, 0.01)
+
+    assert picks(nodes) == {"fast": 100}
+
+
+async def test_busy_node_waits_its_turn():
+    nodes = health("slow", "fast")
+    slow, fast = nodes._connections
+    respond(nodes, slow, 0.1)
+    respond(nodes, fast, 0.01)
+
+    # 0.01 * 20 in flight is worse than 0.1 with none
+    for _ in range(19):
+        nodes.begin(fast)
+
+    assert picks(nodes) == {"slow": 100}
+
+
+async def test_similar_nodes_take_turns():
+    nodes = health("a", "b", "c")
+    for connection, elapsed in zip(nodes._connections, (0.1, 0.11, 0.12)):
+        respond(nodes, connection, elapsed)
+
+    assert picks(nodes, 99) == {"a": 33, "b": 33, "c": 33}
+
+
+async def test_new_node_is_assumed_as_fast_as_the_fastest():
+    nodes = health("known", "new")
+    respond(nodes, nodes._connections[0], 0.05)
+
+    assert set(picks(nodes)) == {"known", "new"}
+
+
+async def test_circuit_opens_then_closes_on_a_probe():
+    nodes = health("a", "b", failure_threshold=2, open_time=0.05)
+    a, b = nodes._connections
+    changes = []
+    nodes.watch(lambda: changes.append(nodes.available()))
+
+    respond(nodes, a, 0.01, ok=False)
+    assert nodes.nodes["a"].open_until is None
+    respond(nodes, a, 0.01, ok=False)
+    assert nodes.nodes["a"].open_until is not None
+    assert changes == [True]
+    assert picks(nodes) == {"b": 100}
+
+    # While open, the node is probed rather than sent anything
+    a.failing = True
+    await asyncio.sleep(0.07)
+    assert a.probes == 1
+    assert nodes.nodes["a"].open_until is not None
+    assert nodes.nodes["a"].trips == 2
+
+    # The pause doubled, so the next probe is 0.1s later
+    a.failing = False
+    await asyncio.sleep(0.05)
+    assert a.probes == 1
+    await asyncio.sleep(0.1)
+    assert a.probes == 2
+    assert nodes.nodes["a"].open_until is None
+    assert nodes.nodes["a"].failures == nodes.nodes["a"].trips == 0
+    assert set(picks(nodes)) == {"a", "b"}
+    await nodes.close()
+
+
+async def test_every_node_open_is_unavailable():
+    nodes = health("a", failure_threshold=1, open_time=0.05)
+    (a,) = nodes._connections
+    changes = []
+    nodes.watch(lambda: changes.append(nodes.available()))
+
+    respond(nodes, a, 0.01, ok=False)
+    assert changes == [False]
+    with pytest.raises(ConnectionError):
+        nodes.select()
+
+    await asyncio.sleep(0.1)
+    assert changes == [False, True]
+    assert nodes.select() is a
+
+
+async def test_probe_does_not_bring_back_a_removed_node():
+    nodes = health("a", "b", failure_threshold=1, open_time=0.05)
+    a, b = nodes._connections
+    respond(nodes, a, 0.01, ok=False)
+    stats = nodes.nodes["a"]
+
+    # Sniffed away while its circuit is open
+    nodes.set_connections([b])
+    changes = []
+    nodes.watch(lambda: changes.append(nodes.available()))
+    await asyncio.sleep(0.1)
+
+    assert a.probes == 1
+    assert "a" not in nodes.nodes
+    assert stats.open_until is not None
+    assert changes == []
+    assert not nodes._probes
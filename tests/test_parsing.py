@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from auth0_streams_elasticsearch.parsing import InvalidEvent, LogsStreamParser, StreamParseError, parse_logs
+
+
+def event(n: int) -> dict:
+    return {"log_id": str(n), "data": {"type": "s", "description": "é" * (n % 3)}}
+
+
+def feed_bytewise(body: bytes) -> list:
+    parser = LogsStreamParser()
+    events = []
+    for offset in range(len(body)):
+        events.extend(parser.feed(body[offset:offset + 1]))
+    events.extend(parser.close())
+
+    return events
+
+
+def test_parses_events_whole_and_split_anywhere():
+    events = [event(n) for n in range(5)]
+    body = json.dumps({"before": [1, {"a": "]"}], "logs": events, "after": 1.5}).encode()
+
+    assert parse_logs(body) == events
+    assert feed_bytewise(body) == events
+
+
+def test_hands_back_events_as_they_complete():
+    parser = LogsStreamParser()
+
+    assert parser.feed(b'{"logs": [{"log_id": "1", "data": {}}, {"log_id": "2", "da') == [{"log_id": "1", "data": {}}]
+    assert parser.feed(b'ta": {}}]}') == [{"log_id": "2", "data": {}}]
+    assert parser.close() == []
+
+
+@pytest.mark.parametrize("body", [
+    b'{"logs": [{"log_id": "1", "data": {}},]}',
+    b'{"logs": [,]}',
+    b'{"logs": [], }',
+    b'{"logs": [],}',
+    b'{"logs": [{"log_id": "1", "data": {}}] ',
+    b'["logs"]',
+    b'{"logs": {}}',
+    b'{"logs": [] } x',
+])
+def test_rejects_malformed_bodies(body):
+    with pytest.raises(StreamParseError):
+        parse_logs(body)
+    with pytest.raises(StreamParseError):
+        feed_bytewise(body)
+
+
+def test_rejects_trailing_commas_before_the_body_ends():
+    parser = LogsStreamParser()
+
+    with pytest.raises(StreamParseError):
+        parser.feed(b'{"logs": [{"log_id": "1", "data": {}}, ]')
+
+
+@pytest.mark.parametrize("element", [
+    "1",
+    '"event"',
+    "null",
+    '[{"log_id": "1", "data": {}}]',
+    '{"data": {}}',
+    '{"log_id": 1, "data": {}}',
+    '{"log_id": "1"}',
+    '{"log_id": "1", "data": "s"}',
+])
+def test_rejects_elements_which_are_not_log_events(element):
+    with pytest.raises(InvalidEvent):
+        parse_logs(f'{{"logs": [{{"log_id": "0", "data": {{}}}}, {element}]}}'.encode())
+
+
+def test_limits_pending_values():
+    parser = LogsStreamParser(max_pending=100)
+
+    with pytest.raises(StreamParseError):
+        parser.feed(b'{"logs": [{"log_id": "1", "data": "' + b"x" * 200)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import socket
+import time
+
+import aiohttp
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.batcher import BatcherService
+from auth0_streams_elasticsearch.dedup import DedupCache
+from auth0_streams_elasticsearch.receiver import CHUNK_SIZE, ReceiverService
+
+TOKEN = "test"
+QUEUE_MAX_SIZE = 1000
+
+
+def event(n: int) -> dict:
+    return {"log_id": str(n), "data": {"type": "s", "description": "x" * 100}}
+
+
+@pytest.fixture
+def receiver_socket():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def url(receiver_socket) -> str:
+    return "http://127.0.0.1:%d/" % receiver_socket.getsockname()[1]
+
+
+@pytest.fixture
+def receiver_options() -> dict:
+    return {"insert_timeout": 0.01}
+
+
+@pytest.fixture
+def services(receiver_socket, receiver_options):
+    return [
+        BatcherService(queue_max_size=QUEUE_MAX_SIZE, flush_size=QUEUE_MAX_SIZE, flush_after=60),
+        ReceiverService(sock=receiver_socket, bearer_token=TOKEN, **receiver_options),
+    ]
+
+
+@pytest.fixture
+async def batcher():
+    return await aiomisc.get_context()["batcher"]
+
+
+async def post(url: str, body: bytes) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=body, headers={"Authorization": f"Bearer {TOKEN}"}) as response:
+            return response.status
+
+
+async def test_queues_a_delivery(url, batcher):
+    events = [event(n) for n in range(10)]
+
+    assert await post(url, json.dumps({"logs": events}).encode()) == 200
+
+    queued = batcher.get_batch(100)
+    assert [e["log_id"] for e in queued] == [e["log_id"] for e in events]
+    assert queued[0]["data"]["type_description"] == "Success Login"
+
+
+@pytest.mark.parametrize("logs", [
+    [{"data": {"type": "s"}}],
+    [{"log_id": 1, "data": {"type": "s"}}],
+    [{"log_id": "1"}],
+    ["s"],
+])
+async def test_rejects_invalid_events(url, batcher, logs):
+    assert await post(url, json.dumps({"logs": logs}).encode()) == 422
+    assert batcher.is_empty()
+
+
+async def test_rejects_trailing_commas(url, batcher):
+    assert await post(url, b'{"logs": [{"log_id": "1", "data": {}},]}') == 422
+    assert batcher.is_empty()
+
+
+async def test_rejected_delivery_is_not_partly_queued(url, batcher):
+    # Several chunks of good events before the bad one
+    events = [event(n) for n in range(CHUNK_SIZE * 4 // 120)]
+    body = json.dumps({"logs": events}).encode()[:-2] + b', {"data": {}}]}'
+
+    assert await post(url, body) == 422
+    assert batcher.is_empty()
+
+
+async def test_delivery_over_queue_capacity_is_not_partly_queued(url, batcher):
+    assert await post(url, json.dumps({"logs": [event(n) for n in range(QUEUE_MAX_SIZE - 10)]}).encode()) == 200
+
+    events = [event(n) for n in range(QUEUE_MAX_SIZE, QUEUE_MAX_SIZE + CHUNK_SIZE * 2 // 120)]
+    assert await post(url, json.dumps({"logs": events}).encode()) == 429
+    assert batcher.remaining() == QUEUE_MAX_SIZE - 10
+
+    # Once there is room, the redelivery is queued whole
+    batcher.ack(batcher.get_batch(QUEUE_MAX_SIZE))
+    assert await post(url, json.dumps({"logs": events}).encode()) == 200
+    assert batcher.remaining() == len(events)
+
+
+# Each delivery its own flush of the coalescer, one after another
+@pytest.mark.parametrize("receiver_options", [{"insert_timeout": 0.5, "coalesce_events": 1}])
+async def test_deliveries_staged_behind_a_full_queue_wait_one_timeout(url, batcher):
+    assert await post(url, json.dumps({"logs": [event(n) for n in range(QUEUE_MAX_SIZE)]}).encode()) == 200
+
+    async def timed(n: int) -> tuple:
+        status = await post(url, json.dumps({"logs": [event(QUEUE_MAX_SIZE + n)]}).encode())
+        return status, time.monotonic() - began
+
+    began = time.monotonic()
+    results = await asyncio.gather(*(timed(n) for n in range(4)))
+
+    assert [status for status, _ in results] == [429] * 4
+    assert max(elapsed for _, elapsed in results) < 0.8
+    assert batcher.remaining() == QUEUE_MAX_SIZE
+
+
+@pytest.mark.parametrize("receiver_options", [{"insert_timeout": 5, "dedup": DedupCache()}])
+async def test_redelivery_while_the_delivery_waits_is_dropped(url, batcher):
+    assert await post(url, json.dumps({"logs": [event(n) for n in range(QUEUE_MAX_SIZE)]}).encode()) == 200
+
+    body = json.dumps({"logs": [event(QUEUE_MAX_SIZE)]}).encode()
+    delivery = asyncio.ensure_future(post(url, body))
+    await asyncio.sleep(0.1)
+    assert not delivery.done()
+
+    # Auth0 timed out and redelivered while the first waits for room
+    assert await post(url, body) == 200
+    batcher.ack(batcher.get_batch(QUEUE_MAX_SIZE))
+    assert await delivery == 200
+    assert [e["log_id"] for e in batcher.get_batch(QUEUE_MAX_SIZE)] == [str(QUEUE_MAX_SIZE)]
+
+
+@pytest.mark.parametrize("receiver_options", [{"insert_timeout": 0.01, "dedup": DedupCache()}])
+async def test_redelivery_of_a_rejected_delivery_is_queued(url, batcher):
+    assert await post(url, json.dumps({"logs": [event(n) for n in range(QUEUE_MAX_SIZE)]}).encode()) == 200
+
+    body = json.dumps({"logs": [event(QUEUE_MAX_SIZE)]}).encode()
+    assert await post(url, body) == 429
+    batcher.ack(batcher.get_batch(QUEUE_MAX_SIZE))
+
+    assert await post(url, body) == 200
+    assert [e["log_id"] for e in batcher.get_batch(QUEUE_MAX_SIZE)] == [str(QUEUE_MAX_SIZE)]
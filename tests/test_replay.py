@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.replay import Checkpoint, Replay, init_parser
+from auth0_streams_elasticsearch.retry import DeadLetterSink
+from auth0_streams_elasticsearch.settings import Settings
+
+EVENTS = 200
+CHUNK_SIZE = 2000
+
+
+@pytest.fixture
+def services(fake_es):
+    init_parser(Settings.load({"BEARER_TOKEN": "", "ELASTICSEARCH_INDEX_NAME": "auth0"}), 25)
+    return [ClientService(username="", password="", hosts=fake_es.url, index_name="auth0", ssl_verify=False)]
+
+
+@pytest.fixture
+async def client():
+    return await aiomisc.get_context()["client"]
+
+
+@pytest.fixture(params=["plain", "gzip"])
+def path(request, tmp_path) -> str:
+    data = b"".join(
+        json.dumps({"log_id": str(n), "data": {"type": "s", "description": "x" * 50}}).encode() + b"\n"
+        for n in range(EVENTS)
+    )
+    if request.param == "gzip":
+        data = gzip.compress(data)
+
+    path = tmp_path / f"events.{request.param}"
+    path.write_bytes(data)
+    return str(path)
+
+
+class StoppedReplay(Replay):
+    """ Stops once `stop_after` bytes have been replayed, as if
+        interrupted.
+    """
+
+    stop_after = 3 * CHUNK_SIZE
+
+    async def replay_chunk(self, *args):
+        await super().replay_chunk(*args)
+        if self.replayed_bytes >= self.stop_after:
+            self.stop()
+
+
+def replay(cls, client, checkpoint_path: str) -> Replay:
+    return cls(
+        client, None, Checkpoint(checkpoint_path), DeadLetterSink(),
+        chunk_size=CHUNK_SIZE, max_in_flight=1, max_parsing=1,
+    )
+
+
+async def test_interrupted_replay_resumes_from_the_checkpoint(client, fake_es, path, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint")
+
+    assert not await replay(StoppedReplay, client, checkpoint_path).run([path])
+    (progress,) = Checkpoint(checkpoint_path).files.values()
+    assert not progress["complete"]
+    assert 0 < progress["offset"]
+    # Every line before the offset was indexed, and nothing after the
+    # chunks under way when stopped
+    first_run = set(fake_es.docs["auth0"])
+    with gzip.open(path) if path.endswith("gzip") else open(path, "rb") as f:
+        before = f.read(progress["offset"]).splitlines()
+    assert {json.loads(line)["log_id"] for line in before} == first_run
+    assert len(first_run) < EVENTS
+
+    assert await replay(Replay, client, checkpoint_path).run([path])
+    assert set(fake_es.docs["auth0"]) == {str(n) for n in range(EVENTS)}
+    # Only the rest was sent
+    assert fake_es.received == EVENTS
+    assert Checkpoint(checkpoint_path).offset(path) is None
+
+
+async def test_replayed_file_is_skipped(client, fake_es, path, tmp_path):
+    checkpoint_path = str(tmp_path / "checkpoint")
+
+    assert await replay(Replay, client, checkpoint_path).run([path])
+    assert await replay(Replay, client, checkpoint_path).run([path])
+    assert fake_es.received == EVENTS
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.batcher import BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.retry import DeadLetterSink, Retrier, partition_bulk_items
+from auth0_streams_elasticsearch.sender import SenderService
+
+TOTAL_EVENTS = 2000
+
+
+def item(status: int, error_type: str = None) -> dict:
+    result = {"_index": "auth0", "status": status}
+    if error_type:
+        result["error"] = {"type": error_type, "reason": "test"}
+
+    return {"index": result}
+
+
+def read_dead_letters(path) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_partition_without_errors_keeps_the_batch():
+    batch = [{"log_id": "1"}, {"log_id": "2"}]
+
+    succeeded, retryable, failed = partition_bulk_items(batch, {"errors": False, "items": [item(201), item(201)]})
+
+    assert succeeded is batch
+    assert retryable == [] and failed == []
+
+
+def test_partition_splits_items_by_status():
+    batch = [{"log_id": str(n)} for n in range(6)]
+    response = {"errors": True, "items": [
+        item(201),
+        item(429, "es_rejected_execution_exception"),
+        item(400, "mapper_parsing_exception"),
+        item(200),
+        item(503, "unavailable_shards_exception"),
+        item(409, "version_conflict_engine_exception"),
+    ]}
+
+    succeeded, retryable, failed = partition_bulk_items(batch, response)
+
+    assert succeeded == [batch[0], batch[3]]
+    assert retryable == [batch[1], batch[4]]
+    assert [event for event, _ in failed] == [batch[2], batch[5]]
+    assert failed[0][1]["error"]["type"] == "mapper_parsing_exception"
+
+
+def test_backoff_is_capped():
+    retrier = Retrier(lambda events, batch: None, DeadLetterSink(), backoff_base=0.5, backoff_max=4)
+
+    for attempt in range(1, 10):
+        cap = min(4, 0.5 * 2 ** attempt)
+        assert all(0 <= retrier.delay(attempt) <= cap for _ in range(100))
+
+
+async def test_retries_until_attempts_run_out(tmp_path):
+    requeued = []
+    dead_letter = DeadLetterSink(str(tmp_path / "dead"))
+    retrier = Retrier(
+        lambda events, batch: requeued.append((events, batch)),
+        dead_letter,
+        max_attempts=3,
+        backoff_base=0.001,
+        backoff_max=0.001,
+    )
+    events = [{"log_id": "a"}, {"log_id": "b"}]
+
+    # The first two failures are retried after a backoff, with their batch
+    for _ in range(2):
+        assert retrier.retry(events, "rejected", "batch")
+        assert retrier.waiting == 1
+        await asyncio.sleep(0.01)
+        assert requeued.pop() == (events, "batch")
+        assert retrier.waiting == 0
+
+    # The third runs out of attempts
+    assert not retrier.retry(events, "rejected", "batch")
+    await dead_letter.flush()
+
+    assert requeued == []
+    letters = read_dead_letters(tmp_path / "dead")
+    assert [letter["event"] for letter in letters] == events
+    assert letters[0]["error"] == {"type": "retries_exhausted", "reason": "rejected"}
+
+
+async def test_delivered_events_start_over():
+    retrier = Retrier(lambda events, batch: None, DeadLetterSink(), max_attempts=2, backoff_base=0.001)
+    events = [{"log_id": "a"}]
+
+    assert retrier.retry(events, "rejected", None)
+    retrier.completed(events)
+
+    assert retrier.retry(events, "rejected", None)
+    await retrier.close()
+
+
+async def test_permanent_failures_are_dead_lettered(tmp_path):
+    dead_letter = DeadLetterSink(str(tmp_path / "dead"))
+    retrier = Retrier(lambda events, batch: None, dead_letter)
+    error = {"status": 400, "error": {"type": "mapper_parsing_exception"}}
+
+    retrier.fail([({"log_id": "a"}, error)])
+    retrier.fail([({"log_id": "b"}, error)])
+    await dead_letter.flush()
+
+    letters = read_dead_letters(tmp_path / "dead")
+    assert letters == [
+        {"event": {"log_id": "a"}, "error": error},
+        {"event": {"log_id": "b"}, "error": error},
+    ]
+
+
+async def test_close_requeues_without_waiting():
+    requeued = []
+    retrier = Retrier(lambda events, batch: requeued.extend(events), DeadLetterSink(), backoff_base=60)
+
+    retrier.retry([{"log_id": "a"}], "rejected", None)
+    await asyncio.wait_for(retrier.close(), 1)
+
+    assert requeued == [{"log_id": "a"}]
+    assert retrier.waiting == 0
+
+
+@pytest.fixture
+def fake_es_options():
+    return {"reject_rate": 0.2, "error_rate": 0.02, "unavailable_rate": 0.05, "seed": 1}
+
+
+@pytest.fixture
+def dead_letter_path(tmp_path):
+    return str(tmp_path / "dead-letter.ndjson")
+
+
+@pytest.fixture
+def services(fake_es, dead_letter_path):
+    return [
+        BatcherService(queue_max_size=TOTAL_EVENTS, flush_size=100, flush_after=0.01),
+        ClientService(username="", password="", hosts=fake_es.url, index_name="auth0", ssl_verify=False),
+        SenderService(
+            send_after_events=100,
+            send_max_events=100,
+            retry_backoff_base=0.001,
+            retry_backoff_max=0.01,
+            dead_letter_path=dead_letter_path,
+        ),
+    ]
+
+
+async def test_every_event_is_indexed_or_dead_lettered(fake_es, dead_letter_path):
+    batcher = await aiomisc.get_context()["batcher"]
+    for start in range(0, TOTAL_EVENTS, 100):
+        await batcher.insert_many({"log_id": str(n), "data": {"type": "s"}} for n in range(start, start + 100))
+
+    letters = []
+    while fake_es.indexed + len(letters) < TOTAL_EVENTS:
+        await asyncio.sleep(0.05)
+        if os.path.exists(dead_letter_path):
+            letters = read_dead_letters(dead_letter_path)
+
+    indexed = set(fake_es.docs["auth0"])
+    dead = {letter["event"]["log_id"] for letter in letters}
+    assert len(dead) == len(letters)
+    assert not indexed & dead
+    assert indexed | dead == {str(n) for n in range(TOTAL_EVENTS)}
+    assert any(letter["error"]["error"]["type"] == "mapper_parsing_exception" for letter in letters)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import json
+from datetime import datetime
+
+import pytest
+
+from auth0_streams_elasticsearch.client import bulk_builder
+from auth0_streams_elasticsearch.routing import IndexRouter
+
+
+def event(log_id: str, date=None, **data) -> dict:
+    if date is not None:
+        data["date"] = date
+    return {"log_id": log_id, "data": {"type": "s", **data}}
+
+
+def lines(body: bytes) -> list:
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def test_daily_index_follows_the_event_date():
+    router = IndexRouter("auth0-%Y.%m.%d")
+
+    assert router.index_for(event("1", "2020-01-02T23:59:59.999Z")) == "auth0-2020.01.02"
+    assert router.index_for(event("2", "2019-12-31T00:00:00.000Z")) == "auth0-2019.12.31"
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    ("auth0-%Y.%m.%d-%H", "auth0-2020.01.02-13"),
+    ("auth0-%Y.%m.%d-%H%M", "auth0-2020.01.02-1345"),
+    ("auth0-%Y.%m", "auth0-2020.01"),
+])
+def test_daily_index_at_the_pattern_granularity(pattern, expected):
+    assert IndexRouter(pattern).index_for(event("1", "2020-01-02T13:45:30.000Z")) == expected
+
+
+@pytest.mark.parametrize("mode", ["alias", "data_stream"])
+def test_alias_and_data_stream_names_are_used_as_is(mode):
+    router = IndexRouter("auth0-%Y", mode)
+    events = [event("1", "2020-01-02T00:00:00.000Z"), event("2", "2021-01-02T00:00:00.000Z")]
+
+    assert router.static
+    assert router.index_for(events[0]) == "auth0-%Y"
+    assert router.group(events) == [("auth0-%Y", events)]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        IndexRouter("auth0", "rollover")
+
+
+def test_index_names_are_cached_per_day():
+    router = IndexRouter("auth0-%Y.%m.%d")
+    for hour in range(24):
+        router.index_for(event(str(hour), f"2020-01-02T{hour:02d}:00:00.000Z"))
+    router.index_for(event("next", "2020-01-03T00:00:00.000Z"))
+
+    info = router._expand.cache_info()
+    assert (info.misses, info.hits) == (2, 23)
+
+
+def test_index_names_are_cached_per_hour_for_an_hourly_pattern():
+    router = IndexRouter("auth0-%Y.%m.%d.%H")
+    for minute in range(0, 120, 10):
+        router.index_for(event(str(minute), f"2020-01-02T{minute // 60:02d}:{minute % 60:02d}:00.000Z"))
+
+    info = router._expand.cache_info()
+    assert (info.misses, info.hits) == (2, 10)
+
+
+@pytest.mark.parametrize("date", [None, 1577923200, "2020-01", "not a date at all"])
+def test_events_without_a_usable_date_go_to_todays_index(date):
+    router = IndexRouter("auth0-%Y.%m.%d")
+
+    before = datetime.utcnow().strftime(router.pattern)
+    index = router.index_for(event("1", date))
+    assert index in (before, datetime.utcnow().strftime(router.pattern))
+
+
+def test_groups_keep_the_order_of_first_appearance():
+    router = IndexRouter("auth0-%Y.%m.%d")
+    events = [
+        event("1", "2020-01-02T00:00:00.000Z"),
+        event("2", "2020-01-01T00:00:00.000Z"),
+        event("3", "2020-01-02T01:00:00.000Z"),
+    ]
+
+    assert router.group(events) == [
+        ("auth0-2020.01.02", [events[0], events[2]]),
+        ("auth0-2020.01.01", [events[1]]),
+    ]
+
+
+def test_index_actions():
+    events = [event("1", "2020-01-02T00:00:00.000Z")]
+
+    assert lines(bulk_builder("daily").build(events, "auth0-2020.01.02")) == [
+        {"index": {"_index": "auth0-2020.01.02", "_id": "1"}},
+        {"type": "s", "date": "2020-01-02T00:00:00.000Z"},
+    ]
+
+
+def test_data_stream_actions_create_with_a_timestamp():
+    events = [
+        event("1", "2020-01-02T00:00:00.000Z"),
+        event("2", "2020-01-02T00:00:00.000Z", **{"@timestamp": "2020-01-03T00:00:00.000Z"}),
+    ]
+
+    assert lines(bulk_builder("data_stream").build(events, "auth0")) == [
+        {"create": {"_index": "auth0", "_id": "1"}},
+        {"type": "s", "date": "2020-01-02T00:00:00.000Z", "@timestamp": "2020-01-02T00:00:00.000Z"},
+        {"create": {"_index": "auth0", "_id": "2"}},
+        {"type": "s", "date": "2020-01-02T00:00:00.000Z", "@timestamp": "2020-01-03T00:00:00.000Z"},
+    ]
+    # The events themselves are left alone
+    assert "@timestamp" not in events[0]["data"]
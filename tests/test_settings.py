@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from loguru import logger
+
+from auth0_streams_elasticsearch import reload_settings
+from auth0_streams_elasticsearch.settings import Settings, SettingUnset, WrongSettingType
+
+
+class Service:
+    def __init__(self):
+        self.applied = []
+
+    def reconfigure(self, s: Settings):
+        self.applied.append(s)
+
+
+@pytest.fixture
+def warnings():
+    messages = []
+    handler = logger.add(lambda message: messages.append(message.record["message"]), level="WARNING")
+    yield messages
+    logger.remove(handler)
+
+
+@pytest.fixture
+def settings_file(tmp_path):
+    path = tmp_path / "settings.env"
+    path.write_text("# Tuned for the big tenant\nQUEUE_MAX_SIZE=5000\n\nELASTICSEARCH_HOSTS=http://es-1:9200\n")
+    return path
+
+
+@pytest.fixture
+def environ(settings_file) -> dict:
+    return {"BEARER_TOKEN": "token", "QUEUE_MAX_SIZE": "100", "SETTINGS_FILE": str(settings_file)}
+
+
+def test_file_takes_precedence_over_the_environment(environ):
+    s = Settings.load(environ)
+
+    assert s.QUEUE_MAX_SIZE == 5000
+    assert s.ELASTICSEARCH_HOSTS == "http://es-1:9200"
+    assert s.BEARER_TOKEN == "token"
+
+
+def test_missing_and_invalid_settings():
+    with pytest.raises(SettingUnset):
+        Settings.load({})
+    with pytest.raises(WrongSettingType):
+        Settings.load({"BEARER_TOKEN": "token", "QUEUE_MAX_SIZE": "many"})
+
+
+def test_changes():
+    s = Settings.load({"BEARER_TOKEN": "token"})
+
+    assert s.changes(s) == set()
+    assert s.changes(Settings.load({"BEARER_TOKEN": "other", "SEND_MAX_EVENTS": "7"})) == {
+        "BEARER_TOKEN", "SEND_MAX_EVENTS",
+    }
+
+
+def test_reload_applies_hot_settings_and_keeps_cold_ones(environ, settings_file, warnings):
+    s = Settings.load(environ)
+    settings_file.write_text("QUEUE_MAX_SIZE=9000\nSEND_MAX_IN_FLIGHT=2\nELASTICSEARCH_HOSTS=http://es-2:9200\n")
+
+    reloaded = s.reload(environ)
+
+    assert reloaded.QUEUE_MAX_SIZE == 9000
+    assert reloaded.SEND_MAX_IN_FLIGHT == 2
+    assert reloaded.ELASTICSEARCH_HOSTS == "http://es-1:9200"
+    assert s.changes(reloaded) == {"QUEUE_MAX_SIZE", "SEND_MAX_IN_FLIGHT"}
+    assert warnings == ["Ignoring changes to ELASTICSEARCH_HOSTS until restarted"]
+
+
+def test_reload_settings_reconfigures_the_services(environ, settings_file, monkeypatch):
+    for name, value in environ.items():
+        monkeypatch.setenv(name, value)
+    s = Settings.load()
+    services = [Service(), Service()]
+
+    # Nothing changed
+    assert reload_settings(s, services) is s
+    assert services[0].applied == []
+
+    settings_file.write_text("QUEUE_MAX_SIZE=9000\n")
+    reloaded = reload_settings(s, services)
+    assert reloaded.QUEUE_MAX_SIZE == 9000
+    assert all(service.applied == [reloaded] for service in services)
+
+
+def test_reload_settings_keeps_the_settings_it_can_not_read(environ, settings_file, monkeypatch):
+    for name, value in environ.items():
+        monkeypatch.setenv(name, value)
+    s = Settings.load()
+    service = Service()
+
+    settings_file.write_text("QUEUE_MAX_SIZE\n")
+    assert reload_settings(s, [service]) is s
+    assert service.applied == []
+
+
+def test_reload_settings_without_a_settings_file(monkeypatch, warnings):
+    monkeypatch.setenv("BEARER_TOKEN", "token")
+    monkeypatch.delenv("SETTINGS_FILE", raising=False)
+    s = Settings.load()
+    service = Service()
+
+    monkeypatch.setenv("QUEUE_MAX_SIZE", "9000")
+    assert reload_settings(s, [service]) is s
+    assert service.applied == []
+    assert warnings == ["Got SIGHUP, but there is no SETTINGS_FILE to reload settings from"]
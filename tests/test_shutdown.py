@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+
+import aiohttp
+import pytest
+
+from auth0_streams_elasticsearch.batcher import BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.receiver import ReceiverService
+from auth0_streams_elasticsearch.sender import SenderService
+from auth0_streams_elasticsearch.spill import take_spill
+
+TOKEN = "test"
+EVENTS_PER_REQUEST = 100
+CONCURRENCY = 4
+
+
+@pytest.fixture
+def receiver_socket():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def spill_path(tmp_path) -> str:
+    return str(tmp_path / "spill.ndjson")
+
+
+@pytest.fixture
+def drain_timeout() -> float:
+    return 10
+
+
+@pytest.fixture
+def receiver(receiver_socket) -> ReceiverService:
+    return ReceiverService(sock=receiver_socket, bearer_token=TOKEN, coalesce_events=0)
+
+
+@pytest.fixture
+def sender(spill_path, drain_timeout) -> SenderService:
+    return SenderService(
+        send_after_events=EVENTS_PER_REQUEST,
+        send_max_events=500,
+        send_max_in_flight=2,
+        drain_timeout=drain_timeout,
+        spill_path=spill_path,
+    )
+
+
+@pytest.fixture
+def services(fake_es, receiver, sender):
+    return [
+        BatcherService(queue_max_size=100_000, flush_size=EVENTS_PER_REQUEST, flush_after=0.05),
+        ClientService(username="", password="", hosts=fake_es.url, index_name="auth0", ssl_verify=False),
+        receiver,
+        sender,
+    ]
+
+
+async def load(url: str, accepted: set, turned_away: asyncio.Event):
+    """ Posts deliveries from a few connections until the receiver turns
+        them away, recording the events of every delivery accepted.
+    """
+
+    async def post(session: aiohttp.ClientSession, connection: int):
+        number = 0
+        while True:
+            ids = [f"{connection}-{number}-{n}" for n in range(EVENTS_PER_REQUEST)]
+            body = json.dumps({"logs": [{"log_id": id, "data": {"type": "s"}} for id in ids]})
+            async with session.post(url, data=body, headers={"Authorization": f"Bearer {TOKEN}"}) as response:
+                if response.status == 503:
+                    turned_away.set()
+                    return
+                assert response.status == 200
+                accepted.update(ids)
+            number += 1
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, connection) for connection in range(CONCURRENCY)))
+
+
+async def sigterm_under_load(receiver_socket, receiver: ReceiverService, sender: SenderService) -> set:
+    """ Sends SIGTERM to the process while deliveries are coming in, and
+        drains the way the app does. Returns the accepted events.
+    """
+
+    loop = asyncio.get_event_loop()
+    url = "http://127.0.0.1:%d/" % receiver_socket.getsockname()[1]
+    accepted = set()
+    turned_away = asyncio.Event()
+    loader = asyncio.ensure_future(load(url, accepted, turned_away))
+    await asyncio.sleep(0.5)
+
+    drained = loop.create_future()
+
+    async def shutdown():
+        receiver.drain()
+        await sender.drain()
+        drained.set_result(None)
+
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(shutdown()))
+    try:
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(drained, 30)
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+
+    await loader
+    assert turned_away.is_set()
+    assert accepted
+    return accepted
+
+
+@pytest.mark.parametrize("fake_es_options", [{"latency": 0.05}])
+async def test_sigterm_drains_everything_accepted(fake_es, receiver_socket, receiver, sender, spill_path):
+    accepted = await sigterm_under_load(receiver_socket, receiver, sender)
+
+    assert set(fake_es.docs["auth0"]) == accepted
+    assert not os.path.exists(spill_path)
+
+
+@pytest.mark.parametrize("fake_es_options, drain_timeout", [({"latency": 1}, 0.3)])
+async def test_sigterm_spills_what_the_drain_timeout_cuts_off(fake_es, receiver_socket, receiver, sender, spill_path):
+    began = time.monotonic()
+    accepted = await sigterm_under_load(receiver_socket, receiver, sender)
+
+    indexed = set(fake_es.docs["auth0"])
+    spilled = {event["log_id"] for event in take_spill(spill_path)}
+    assert spilled
+    assert indexed | spilled == accepted
+    # Deliveries still in flight were abandoned rather than waited for
+    assert time.monotonic() - began < 3
+    assert not any(worker.tasks for worker in sender.workers)
+
+
+@pytest.mark.parametrize("fake_es_options, drain_timeout", [({"latency": 2}, 0.3)])
+async def test_stop_is_bounded_by_the_drain_timeout(fake_es, receiver_socket, receiver, sender, spill_path):
+    url = "http://127.0.0.1:%d/" % receiver_socket.getsockname()[1]
+    accepted = set()
+    loader = asyncio.ensure_future(load(url, accepted, asyncio.Event()))
+    await asyncio.sleep(0.5)
+    loader.cancel()
+    assert any(worker.tasks for worker in sender.workers)
+
+    began = time.monotonic()
+    await sender.stop()
+
+    assert time.monotonic() - began < 1.5
+    assert not any(worker.tasks for worker in sender.workers)
+    # Nothing was indexed; a delivery cut off by cancelling the load may
+    # still have been queued
+    spilled = {event["log_id"] for event in take_spill(spill_path)}
+    assert accepted <= spilled
+
+
+async def test_stop_before_start():
+    await SenderService(send_after_events=1).stop()
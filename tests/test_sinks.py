@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import gzip
+import json
+import os
+
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.batcher import BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.sender import SenderService
+from auth0_streams_elasticsearch.sinks import ElasticsearchSink, FileSink, Sink
+
+TOTAL_EVENTS = 2000
+
+
+def test_sink_needs_prepare_combine_and_deliver():
+    class Incomplete(Sink):
+        async def prepare(self, events):
+            return events
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.fixture
+def primary(fake_es_factory):
+    return fake_es_factory()
+
+
+@pytest.fixture
+def secondary(fake_es_factory):
+    # Down until the test brings it back
+    return fake_es_factory(unavailable_rate=1)
+
+
+@pytest.fixture
+def archive_path(tmp_path) -> str:
+    return str(tmp_path / "auth0-%Y-%m-%d.ndjson.gz")
+
+
+@pytest.fixture
+def services(primary, secondary, archive_path):
+    return [
+        BatcherService(queue_max_size=TOTAL_EVENTS, flush_size=100, flush_after=0.01),
+        ClientService(username="", password="", hosts=primary.url, index_name="auth0", ssl_verify=False),
+        ClientService(
+            username="", password="", hosts=secondary.url, index_name="auth0", ssl_verify=False,
+            context_key="secondary_client", circuit_open_time=0.1,
+        ),
+        SenderService(
+            send_after_events=100,
+            send_max_events=100,
+            sink_max_backlog=TOTAL_EVENTS,
+            retry_max_attempts=1000,
+            retry_backoff_base=0.001,
+            retry_backoff_max=0.05,
+            sinks=[
+                ElasticsearchSink("elasticsearch"),
+                ElasticsearchSink("secondary_elasticsearch", "secondary_client"),
+                FileSink("file", archive_path),
+            ],
+        ),
+    ]
+
+
+def archived(archive_path: str) -> set:
+    path = archive_path.replace("%Y-%m-%d", "2020-01-01")
+    if not os.path.exists(path):
+        return set()
+
+    with gzip.open(path) as f:
+        return {json.loads(line)["log_id"] for line in f}
+
+
+async def wait_for(condition, timeout: float = 10):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_event_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+async def test_failing_sink_does_not_hold_up_the_others(primary, secondary, archive_path):
+    batcher = await aiomisc.get_context()["batcher"]
+    ids = {str(n) for n in range(TOTAL_EVENTS)}
+    for start in range(0, TOTAL_EVENTS, 100):
+        await batcher.insert_many(
+            {"log_id": str(n), "data": {"type": "s", "date": "2020-01-01T00:00:00.000Z"}}
+            for n in range(start, start + 100)
+        )
+
+    # The primary cluster and the archive get everything while the
+    # secondary cluster fails every request
+    await wait_for(lambda: primary.indexed == TOTAL_EVENTS and archived(archive_path) == ids)
+    assert set(primary.docs["auth0"]) == ids
+    assert secondary.indexed == 0
+    assert secondary.requests > 0
+
+    # Once it is back, it catches up
+    secondary.unavailable_rate = 0
+    await wait_for(lambda: secondary.indexed == TOTAL_EVENTS)
+    assert set(secondary.docs["auth0"]) == ids
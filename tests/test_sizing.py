@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from auth0_streams_elasticsearch.sizing import BatchSizer
+
+
+def test_grows_under_target_and_cuts_over_it():
+    sizer = BatchSizer(min_events=100, max_events=1000, target_latency=1)
+
+    for _ in range(20):
+        sizer.observe(0.2)
+    assert sizer.size == 1000
+    assert sizer.last_latency == 0.2
+
+    sizer.observe(2)
+    assert sizer.size == 500
+    sizer.observe(0.1, rejected=True)
+    assert sizer.size == 250
+    assert sizer.last_latency == 0.1
+
+    assert dict((labels, count) for _, labels, count in sizer.cuts.samples()) == {
+        '{reason="latency"}': 1,
+        '{reason="rejected"}': 1,
+    }
+    assert sizer.latency.count == 22
+
+
+def test_reconfigure_keeps_the_size_in_bounds():
+    sizer = BatchSizer(min_events=100, max_events=1000, target_latency=1)
+    for _ in range(20):
+        sizer.observe(0.2)
+
+    sizer.reconfigure(50, 400, 1)
+
+    assert sizer.size == 400
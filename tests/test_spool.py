@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from auth0_streams_elasticsearch.spool import CHECKPOINT_NAME, FRAME_HEADER, SEGMENT_SUFFIX, Spool
+
+
+def records(n: int) -> list:
+    return [[{"log_id": f"{n}-{i}"} for i in range(3)] for n in range(n)]
+
+
+def segments(directory) -> list:
+    return sorted(path.name for path in directory.iterdir() if path.name.endswith(SEGMENT_SUFFIX))
+
+
+def checkpoint(directory) -> int:
+    return int((directory / CHECKPOINT_NAME).read_text())
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return tmp_path / "spool"
+
+
+async def test_unacked_records_are_replayed_after_a_crash(directory):
+    spool = Spool(str(directory))
+    assert spool.open() == []
+    written = records(4)
+    offsets = [await spool.append(events) for events in written]
+    spool.ack(offsets[1])
+    while not (directory / CHECKPOINT_NAME).exists():
+        await asyncio.sleep(0.01)
+
+    # Never closed, as after a crash
+    reopened = Spool(str(directory))
+    assert reopened.open() == list(zip(offsets[2:], written[2:]))
+
+    # Appends carry on after the replayed records
+    offset = await reopened.append([{"log_id": "new"}])
+    assert offset > offsets[-1]
+    reopened.ack(offsets[3])
+    await reopened.close()
+
+    assert Spool(str(directory)).open() == [(offset, [{"log_id": "new"}])]
+
+
+@pytest.mark.parametrize("damage", ["torn", "crc"])
+async def test_damaged_last_record_is_truncated(directory, damage):
+    spool = Spool(str(directory))
+    spool.open()
+    written = records(3)
+    offsets = [await spool.append(events) for events in written]
+    await spool.close()
+
+    (segment,) = directory.iterdir()
+    if damage == "torn":
+        # A record cut short by a crash mid-write
+        with open(segment, "ab") as f:
+            f.write(FRAME_HEADER.pack(100, 0) + b'[{"log_id"')
+        expected = list(zip(offsets, written))
+        valid = offsets[-1]
+    else:
+        with open(segment, "r+b") as f:
+            f.seek(offsets[-1] - 2)
+            f.write(b"X")
+        expected = list(zip(offsets[:-1], written[:-1]))
+        valid = offsets[-2]
+
+    reopened = Spool(str(directory))
+    assert reopened.open() == expected
+    assert segment.stat().st_size == valid
+
+    offset = await reopened.append([{"log_id": "new"}])
+    await reopened.close()
+    assert Spool(str(directory)).open() == expected + [(offset, [{"log_id": "new"}])]
+
+
+async def test_acked_segments_are_removed(directory):
+    # Every record after the first starts a segment of its own
+    spool = Spool(str(directory), segment_size=1)
+    spool.open()
+    written = records(4)
+    offsets = [await spool.append(events) for events in written]
+    assert len(segments(directory)) == 4
+
+    spool.ack(offsets[1])
+    await spool.close()
+
+    assert checkpoint(directory) == offsets[1]
+    assert segments(directory) == [f"{offsets[1]:020d}{SEGMENT_SUFFIX}", f"{offsets[2]:020d}{SEGMENT_SUFFIX}"]
+    assert Spool(str(directory)).open() == list(zip(offsets[2:], written[2:]))
+
+
+async def test_close_waits_for_the_checkpoint(directory):
+    spool = Spool(str(directory))
+    spool.open()
+    offsets = [await spool.append(events) for events in records(3)]
+    write_checkpoint = spool._write_checkpoint
+    writes = []
+
+    def slow_write_checkpoint(offset: int):
+        time.sleep(0.1)
+        write_checkpoint(offset)
+        writes.append(offset)
+
+    spool._write_checkpoint = slow_write_checkpoint
+    spool.ack(offsets[0])
+    await asyncio.sleep(0.02)
+    # Acked while the first checkpoint is being written
+    spool.ack(offsets[1])
+    spool.ack(offsets[2])
+    await spool.close()
+
+    assert writes == [offsets[0], offsets[2]]
+    assert checkpoint(directory) == offsets[2]
+    assert Spool(str(directory)).open() == []
+    assert not os.path.exists(directory / f"{CHECKPOINT_NAME}.tmp")
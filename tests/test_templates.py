@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.templates import CACHE_TTL, TemplateBootstrap, build_template
+
+INDEX = "auth0-events-%Y.%m.%d"
+TEMPLATE = "auth0-events"
+
+
+def test_version_changes_with_the_template():
+    template = build_template(INDEX)
+
+    assert template["index_patterns"] == ["auth0-events-*.*.*"]
+    assert build_template(INDEX)["version"] == template["version"]
+    assert build_template(INDEX, shards=2)["version"] != template["version"]
+    assert build_template(INDEX, refresh_interval="1s")["version"] != template["version"]
+    assert 0 <= template["version"] < 2 ** 31
+
+
+@pytest.fixture
+def cache_path(tmp_path) -> str:
+    return str(tmp_path / "templates.json")
+
+
+@pytest.fixture
+def services(fake_es):
+    return [
+        ClientService(username="", password="", hosts=fake_es.url, index_name=INDEX, ssl_verify=False),
+    ]
+
+
+@pytest.fixture
+async def bootstrap(fake_es):
+    client = await aiomisc.get_context()["client"]
+
+    def create(cache_path: str = "", **options) -> TemplateBootstrap:
+        return TemplateBootstrap(client.es, client.router, TEMPLATE, fake_es.url, cache_path=cache_path, **options)
+
+    return create
+
+
+async def test_template_is_put_only_when_missing_or_out_of_date(fake_es, bootstrap):
+    assert await bootstrap().ensure_template()
+    assert fake_es.templates[TEMPLATE]["version"] == build_template(INDEX)["version"]
+
+    assert not await bootstrap().ensure_template()
+    assert fake_es.admin_requests == {"get_template": 2, "put_template": 1}
+
+    fake_es.templates[TEMPLATE]["version"] = 1
+    assert await bootstrap().ensure_template()
+    assert fake_es.templates[TEMPLATE]["version"] == build_template(INDEX)["version"]
+
+    assert await bootstrap(shards=3).ensure_template()
+    assert fake_es.admin_requests == {"get_template": 4, "put_template": 3}
+
+
+async def test_cached_template_is_not_checked_until_the_ttl_runs_out(fake_es, bootstrap, cache_path):
+    assert await bootstrap(cache_path).ensure_template()
+
+    # Found up to date in the cache, without asking the cluster
+    cached = bootstrap(cache_path)
+    assert not await cached.ensure_template()
+    assert cached.installed
+    assert fake_es.admin_requests == {"get_template": 1, "put_template": 1}
+
+    # Another version of the template is not in the cache
+    assert await bootstrap(cache_path, replicas=0).ensure_template()
+    assert fake_es.admin_requests == {"get_template": 2, "put_template": 2}
+
+    # Nor is one checked longer than the TTL ago
+    with open(cache_path) as f:
+        entries = json.load(f)
+    with open(cache_path, "w") as f:
+        json.dump({key: checked - CACHE_TTL - 1 for key, checked in entries.items()}, f)
+
+    stale = bootstrap(cache_path, replicas=0)
+    assert not stale.cached()
+    assert not await stale.ensure_template()
+    assert fake_es.admin_requests == {"get_template": 3, "put_template": 2}
+    # and checking it again starts a new TTL
+    assert bootstrap(cache_path, replicas=0).cached()
+
+
+async def test_unreadable_cache_is_ignored(fake_es, bootstrap, cache_path):
+    with open(cache_path, "w") as f:
+        f.write("not json")
+
+    assert await bootstrap(cache_path).ensure_template()
+    assert bootstrap(cache_path).cached()
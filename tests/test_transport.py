@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import aiomisc
+import pytest
+
+from auth0_streams_elasticsearch.batcher import BatcherService
+from auth0_streams_elasticsearch.client import ClientService
+from auth0_streams_elasticsearch.sender import SenderService
+
+OPEN_TIME = 0.3
+
+
+@pytest.fixture
+def latencies() -> tuple:
+    return (0, 0, 0)
+
+
+@pytest.fixture
+def nodes(fake_es_factory, latencies) -> list:
+    return [fake_es_factory(latency=latency) for latency in latencies]
+
+
+@pytest.fixture
+def sender() -> SenderService:
+    return SenderService(
+        send_after_events=100,
+        send_max_events=100,
+        retry_max_attempts=1000,
+        retry_backoff_base=0.001,
+        retry_backoff_max=0.05,
+    )
+
+
+@pytest.fixture
+def services(nodes, sender):
+    return [
+        BatcherService(queue_max_size=10_000, flush_size=100, flush_after=0.01),
+        ClientService(
+            username="", password="", hosts=",".join(node.url for node in nodes), index_name="auth0",
+            ssl_verify=False, circuit_failures=2, circuit_open_time=OPEN_TIME,
+        ),
+        sender,
+    ]
+
+
+@pytest.fixture
+async def client():
+    return await aiomisc.get_context()["client"]
+
+
+def events(start: int, count: int = 10) -> list:
+    return [{"log_id": str(n), "data": {"type": "s"}} for n in range(start, start + count)]
+
+
+def stats(client, node):
+    return client.health.nodes[node.url]
+
+
+def indexed(nodes) -> set:
+    return {id for node in nodes for id in node.docs["auth0"]}
+
+
+async def wait_for(condition, timeout: float = 10):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_event_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.02)
+
+
+@pytest.mark.parametrize("latencies", [(0.2, 0.005, 0.005)])
+async def test_slow_node_gets_less_traffic(client, nodes):
+    for round in range(20):
+        await asyncio.gather(*(client.send(events(round * 40 + n * 10)) for n in range(4)))
+
+    slow, *fast = nodes
+    assert len(indexed(nodes)) == 800
+    assert slow.requests <= 8
+    assert stats(client, slow).latency > 10 * max(stats(client, node).latency for node in fast)
+
+
+async def test_stopped_node_fails_over_and_is_probed_back(fake_es_factory, client, nodes):
+    down, *up = nodes
+    fake_es_factory.pause(down)
+
+    # Enough at once for the load to spread to the stopped node
+    for round in range(5):
+        responses = await asyncio.gather(*(client.send(events(round * 80 + n * 10)) for n in range(8)))
+        assert not any(response["errors"] for response in responses)
+
+    assert stats(client, down).open_until is not None
+    assert len(indexed(up)) == 400
+    assert client.available()
+
+    fake_es_factory.resume(down)
+    await wait_for(lambda: stats(client, down).open_until is None)
+    await asyncio.gather(*(client.send(events(400 + n * 10)) for n in range(30)))
+
+    assert down.requests > 0
+    assert len(indexed(nodes)) == 700
+
+
+async def test_sender_pauses_while_every_node_is_open(fake_es_factory, client, nodes, sender):
+    for node in nodes:
+        fake_es_factory.pause(node)
+
+    batcher = await aiomisc.get_context()["batcher"]
+    await batcher.insert_many(events(0, 500))
+    await wait_for(lambda: not client.available())
+
+    # Nothing is sent while the circuits are open; events wait
+    (worker,) = sender.workers
+    for _ in range(5):
+        assert not worker.tasks
+        await asyncio.sleep(0.02)
+    assert worker.backlog_events + batcher.remaining() > 0
+
+    for node in nodes:
+        fake_es_factory.resume(node)
+    await wait_for(lambda: len(indexed(nodes)) == 500)
+    assert client.available()